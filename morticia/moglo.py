@@ -96,7 +96,16 @@ long_name = {
     'up_fluxU': 'Global Upwelling Irradiance Stokes U',
     'up_fluxV': 'Global Upwelling Irradiance Stokes V',
     'brightness': 'Brightness Temperature',
-    'od': 'Optical Depth'
+    'od': 'Optical Depth',
+    'ssa': 'Single Scattering Albedo',
+    'asy': 'Asymmetry Parameter',
+    'ext': 'Extinction Coefficient',
+    'shc': 'Spherical Harmonic Coefficient Index',  # n**2 + n + m for degree n and order m
+    'shn': 'Spherical Harmonic Degree',
+    'shm': 'Spherical Harmonic Order',
+    'hpx': 'HEALPix Pixel Number',  # RING ordering
+    'alm': 'Spherical Harmonic Coefficient Index (healpy Ordering)',
+    'pc': 'Principal Component Number'
 
     # TODO : Include all libRadtran definitions as well from rad.librad.py
 }
@@ -169,6 +178,55 @@ default_units = {
     'brightness': 'K'
 }
 
+# Cache of unit conversion factors, keyed on (from_units, to_units). Values are (scale, offset) tuples, such that
+# converted_value = value * scale + offset, or None if the conversion is not affine and must be done by pint.
+_unit_conversion_cache = {}
+
+
+def convert_units(value, from_units, to_units):
+    """ Convert a numeric value or numpy array from one set of units to another. If the units are identical, pint
+    is not used at all. Otherwise the multiplicative and offset factors for the pair of units are computed using
+    pint on first use and cached, so that subsequent conversions are simple arithmetic.
+
+    :param value: Numeric value or numpy array.
+    :param from_units: String providing the units of the value. Must be recognised by pint.
+    :param to_units: String providing the units to which to convert. Must be recognised by pint.
+    :return: Numpy array of the value in the new units. If the units are identical, this is a copy of the value.
+    """
+    if from_units == to_units:
+        return np.array(value)
+    cache_key = (from_units, to_units)
+    if cache_key not in _unit_conversion_cache:
+        # Will blow up if units unknown to pint or cannot be converted
+        offset = Q_(0.0, from_units).to(to_units).magnitude
+        if offset == 0.0:
+            scale = Q_(1.0, from_units).to(to_units).magnitude
+        else:
+            # Take the scale from two distant points, since the difference of the converted values of 1 and 0 loses
+            # precision to cancellation against the offset (e.g. degF to K)
+            scale = (Q_(1.0e9, from_units).to(to_units).magnitude - offset) / 1.0e9
+        check = Q_(10.0, from_units).to(to_units).magnitude  # Confirm that the conversion is affine
+        if np.isclose(check, 10.0 * scale + offset, rtol=1.0e-12, atol=0.0):
+            _unit_conversion_cache[cache_key] = (scale, offset)
+        else:
+            _unit_conversion_cache[cache_key] = None
+    factors = _unit_conversion_cache[cache_key]
+    if factors is None:
+        return Q_(np.asarray(value), from_units).to(to_units).magnitude
+    scale, offset = factors
+    if offset == 0.0:
+        return np.asarray(value) * scale
+    return np.asarray(value) * scale + offset
+
+
+def unit_conversion_cache_clear():
+    """ Clear the cache of unit conversion factors used by `convert_units`.
+
+    :return:
+    """
+    _unit_conversion_cache.clear()
+
+
 class Scalar(object):
     """ The Scalar class is for representation of scalar numeric values, together with units of measure, a
     mnemonic, being one of those listed in the MORTICIA long_name vocabulary.
@@ -183,13 +241,15 @@ class Scalar(object):
 
     @data.setter
     def data(self, data_and_units):
-        value = Q_(np.asarray(data_and_units[0], dtype=np.float64), data_and_units[1]) # Will blow up if units unknown to pint
+        value = np.asarray(data_and_units[0], dtype=np.float64)
         self.__units = data_and_units[1]
         if self.mnemonic in default_units:
             # Convert units
-            value = value.to(default_units[self.mnemonic])  # Will blow up if units cannot be converted to default
-            self.__units = default_units[self.mnemonic]
-        self.__data = value.magnitude
+            value = convert_units(value, data_and_units[1], default_units[self.mnemonic])  # Will blow up if units
+            self.__units = default_units[self.mnemonic]  # unknown to pint or cannot be converted to default
+        else:
+            Q_(value, data_and_units[1])  # Will blow up if units unknown to pint
+        self.__data = value
 
     @property
     def units(self):
@@ -229,12 +289,14 @@ class Scalar(object):
             self.attrs['long_name'] = long_name[mnemonic]  # Will blow up if the mnemonic is not known
         except KeyError:
             raise KeyError('Unknown scalar mnemonic ' + mnemonic + ' provided in Scalar instantiation.')
-        value = Q_(np.asarray(data, dtype=np.float64), units)  # Will blow up if units unknown to pint
+        value = np.asarray(data, dtype=np.float64)
         if mnemonic in default_units:
             # Convert units
-            value = value.to(default_units[mnemonic])  # Will blow up if units cannot be converted to default
-            self.__units = default_units[mnemonic]
-        self.__data = value.magnitude
+            value = convert_units(value, units, default_units[mnemonic])  # Will blow up if units unknown to pint
+            self.__units = default_units[mnemonic]  # or cannot be converted to default
+        else:
+            Q_(value, units)  # Will blow up if units unknown to pint
+        self.__data = value
 
     def __repr__(self):  #  TODO : Should we be using __repr__ or __str__
         return self.attrs['long_name'] + ' : ' + str(self.__data) + ' ' + self.__units
@@ -74,7 +74,8 @@ import warnings
 from morticia.moglo import *
 from morticia.tools.xd import *
 import copy
-from itertools import chain  #Used in RadEnv constructor
+from itertools import chain, product  #Used in RadEnv and HyperRadEnv constructors
+from collections import OrderedDict
 import matplotlib.pyplot as plt
 
 _isfloatnum = '^[-+]?[0-9]*\\.?[0-9]+([eE][-+]?[0-9]+)?$'  # regular expression for matching tokens to floating point
@@ -358,6 +359,258 @@ def koschmieder_vis(ext_550=None, aot_550=None, scale_height=None, rayleigh_ext=
             return None
     return vis
 
+
+def real_sph_harm_basis(degree, pza, paz):
+    """ Compute the real spherical harmonic basis functions of Sloan with the Ramamoorthi and Hanrahan normalisation
+    (see RadEnv.sph_harm_fit) up to a given degree, at a set of propagation zenith and azimuth angles.
+
+    The basis functions are ordered by degree :math:`n` and then by order :math:`m = -n, ..., n`, so that the
+    basis function :math:`y_{n}^{m}` has index :math:`n^2 + n + m`.
+
+    :param degree: Maximum degree :math:`n` of the basis functions.
+    :param pza: Numpy array of propagation zenith (polar) angles in radians.
+    :param paz: Numpy array of propagation azimuth angles in radians. Must be broadcastable against `pza`.
+    :return: Tuple (shn, shm, basis), where `shn` and `shm` are integer vectors of the degree and order of each of
+        the :math:`(n+1)^2` basis functions, and `basis` is a numpy array having the basis functions in the first
+        dimension, followed by the broadcast shape of `pza` and `paz`.
+    """
+    from scipy.special import sph_harm
+    pza, paz = np.broadcast_arrays(np.asarray(pza, dtype=np.float64), np.asarray(paz, dtype=np.float64))
+    shn = np.concatenate([np.repeat(n, 2 * n + 1) for n in range(degree + 1)])
+    shm = np.concatenate([np.arange(-n, n + 1) for n in range(degree + 1)])
+    # Evaluate the complex harmonics for non-negative orders only, all at once by broadcasting
+    n_pos = np.concatenate([np.repeat(n, n + 1) for n in range(degree + 1)])
+    m_pos = np.concatenate([np.arange(0, n + 1) for n in range(degree + 1)])
+    expand = (slice(None),) + (np.newaxis,) * pza.ndim
+    y_nm = sph_harm(m_pos[expand], n_pos[expand], paz[np.newaxis, ...], pza[np.newaxis, ...])
+    condon_short = np.where(m_pos > 0, (-1.0)**m_pos * np.sqrt(2.0), 1.0)[expand]  # Ramamoorthi normalisation
+    y_nm = condon_short * y_nm
+    basis = np.empty((shn.size,) + pza.shape)
+    i_pos = n_pos**2 + n_pos  # Index of the m = 0 basis function for each degree
+    basis[i_pos + m_pos, ...] = y_nm.real
+    basis[i_pos[m_pos > 0] - m_pos[m_pos > 0], ...] = y_nm[m_pos > 0, ...].imag
+    return shn, shm, basis
+
+
+def _quadrature_weights(angles, method='trapz'):
+    """ Compute one-dimensional quadrature weights for integration over a vector of angles.
+
+    :param angles: Vector of angles (increasing or decreasing).
+    :param method: 'trapz' for the trapezoidal rule (may be non-uniform), 'sum' for simple summation with the
+        interval of the first two angles and 'simpson' for Simpson's Rule (uniform angles only).
+    :return: Vector of weights, the same size as `angles`.
+    """
+    angles = np.asarray(angles, dtype=np.float64)
+    delta = abs(angles[1] - angles[0])
+    if method == 'trapz':
+        steps = np.abs(np.diff(angles))
+        weights = np.zeros(angles.size)
+        weights[:-1] += steps / 2.0
+        weights[1:] += steps / 2.0
+    elif method == 'sum':
+        weights = np.ones(angles.size) * delta
+    elif method == 'simpson':
+        weights = np.ones(angles.size)
+        weights[1:-1:2] = 4.0
+        weights[2:-2:2] = 2.0
+        weights *= delta / 3.0
+    else:
+        raise ValueError('Unknown integration method ' + method + ' encountered in sph_harm_fit.')
+    return weights
+
+
+def _shift_along_axis(data, shift, axis):
+    """ Shift a numpy array by one or more places along an axis, filling vacated positions with zero.
+
+    :param data: Numpy array.
+    :param shift: Number of places to shift. A shift of -1 places the element at index i+1 at index i (i.e. the
+        value from the next level up), while a shift of 1 places the element at index i-1 at index i.
+    :param axis: The axis along which to shift.
+    :return: Shifted copy of the array.
+    """
+    shifted = np.zeros_like(data)
+    source = [slice(None)] * data.ndim
+    target = [slice(None)] * data.ndim
+    if shift < 0:
+        source[axis] = slice(-shift, None)
+        target[axis] = slice(None, shift)
+    elif shift > 0:
+        source[axis] = slice(None, -shift)
+        target[axis] = slice(shift, None)
+    shifted[tuple(target)] = data[tuple(source)]
+    return shifted
+
+
+def _optimal_batch_counts(n_pol, n_azi, mxumu, mxphi, n_workers=1, batch_cost=(1.0, 0.01, 0.001, 0.0)):
+    """ Determine the number of batches in polar and azimuth angle that minimise the estimated time to run all the
+    cases of a radiant environment map, and then the number of cases. The angles are assumed to be split as evenly as
+    possible into the batches (e.g. using np.array_split).
+
+    The estimated cost of a single case is `overhead + per_umu * n_umu + per_phi * n_phi + per_sightline * n_umu *
+    n_phi`, with the four coefficients given by `batch_cost` in arbitrary (but consistent) units. The estimated
+    elapsed time is the number of rounds of cases required on `n_workers` workers, multiplied by the cost of the
+    largest case.
+
+    :param n_pol: Number of polar angles.
+    :param n_azi: Number of azimuth angles.
+    :param mxumu: Maximum number of polar angles per case.
+    :param mxphi: Maximum number of azimuth angles per case.
+    :param n_workers: Number of workers (engines) available to run cases concurrently. Default 1.
+    :param batch_cost: Tuple of (overhead, per_umu, per_phi, per_sightline) cost coefficients.
+    :return: Tuple (n_pol_batch, n_azi_batch).
+    """
+    overhead, per_umu, per_phi, per_sightline = batch_cost
+    n_pol_batch, n_azi_batch = np.meshgrid(np.arange(int(np.ceil(float(n_pol) / mxumu)), n_pol + 1),
+                                           np.arange(int(np.ceil(float(n_azi) / mxphi)), n_azi + 1), indexing='ij')
+    max_umu = np.ceil(float(n_pol) / n_pol_batch)  # Largest batch sizes with even splitting
+    max_phi = np.ceil(float(n_azi) / n_azi_batch)
+    max_case_cost = overhead + per_umu * max_umu + per_phi * max_phi + per_sightline * max_umu * max_phi
+    n_cases = n_pol_batch * n_azi_batch
+    elapsed = np.ceil(n_cases / float(max(n_workers, 1))) * max_case_cost
+    # Minimise elapsed time first, then the number of cases
+    i_best = np.lexsort((n_cases.ravel(), np.round(elapsed.ravel(), 12)))[0]
+    return int(n_pol_batch.ravel()[i_best]), int(n_azi_batch.ravel()[i_best])
+
+
+def _interval_interp_error(data, angles, axis):
+    """ Estimate the maximum error of linear interpolation within each interval of an angular axis, using the
+    second difference of the data on the (possibly non-uniform) grid. The error estimate for an interval of width
+    :math:`h` is :math:`h^2 |f''| / 8`, taking the larger of the second derivative estimates at the two ends.
+
+    :param data: Numpy array of data values.
+    :param angles: Vector of angles of the axis in question.
+    :param axis: Axis number of `data` corresponding to the angles.
+    :return: Vector of error estimates for each of the intervals, being the maximum over all other axes.
+    """
+    n_angles = angles.size
+    if n_angles < 3:
+        return np.zeros(max(n_angles - 1, 0))
+    values = np.moveaxis(data, axis, 0).reshape((n_angles, -1))
+    step = np.diff(angles)[:, np.newaxis]
+    step_1, step_2 = step[:-1], step[1:]
+    curvature = np.abs(2.0 * (values[:-2] / (step_1 * (step_1 + step_2)) - values[1:-1] / (step_1 * step_2) +
+                              values[2:] / (step_2 * (step_1 + step_2))))
+    curvature = np.vstack((curvature[:1], curvature, curvature[-1:]))  # Ends take the curvature of the neighbour
+    error = step**2 / 8.0 * np.maximum(curvature[:-1], curvature[1:])
+    return np.nanmax(error, axis=1)
+
+
+def _refinement_angles(angles, interval_error, tol, min_step, avoid=None):
+    """ Compute new angles to add to an angular axis by bisecting the intervals where the estimated interpolation
+    error exceeds a tolerance.
+
+    :param angles: Vector of angles of the axis.
+    :param interval_error: Vector of error estimates for each interval (see _interval_interp_error).
+    :param tol: Error tolerance.
+    :param min_step: Intervals narrower than this are not refined.
+    :param avoid: An angle that must not be added (e.g. the horizontal at pi/2, which is illegal in libRadtran).
+        If the midpoint of an interval is at this angle, the points at a quarter and three quarters of the interval
+        are added instead.
+    :return: Vector of new angles.
+    """
+    new_angles = []
+    for i_interval in np.nonzero(interval_error > tol)[0]:
+        lower, upper = angles[i_interval], angles[i_interval + 1]
+        if abs(upper - lower) < min_step:
+            continue
+        midpoint = (lower + upper) / 2.0
+        if avoid is not None and abs(midpoint - avoid) < abs(upper - lower) / 8.0:
+            new_angles.extend([(3.0 * lower + upper) / 4.0, (lower + 3.0 * upper) / 4.0])
+        else:
+            new_angles.append(midpoint)
+    return np.array(new_angles)
+
+
+def _mirrored_angles(new_angles, angles, mirror=np.pi):
+    """ Extend a set of new angles for an axis with their mirror images, so that an axis which is symmetric (e.g.
+    polar angles symmetric about the horizontal) remains symmetric after the new angles are added.
+
+    :param new_angles: Vector of new angles.
+    :param angles: Vector of the existing angles of the axis.
+    :param mirror: The mirror image of angle x is mirror - x. Default pi.
+    :return: Sorted vector of the new angles and their mirror images, omitting angles already on the axis and
+        duplicates.
+    """
+    mirrored = []
+    for angle in np.sort(np.concatenate((new_angles, mirror - np.asarray(new_angles)))):
+        if np.min(np.abs(angles - angle)) > 1.0e-9 and (not mirrored or angle - mirrored[-1] > 1.0e-9):
+            mirrored.append(angle)
+    return np.array(mirrored)
+
+
+def _angle_indices(grid, angles):
+    """ Find the indices of angles in a monotonic grid of angles, which is known to contain them.
+
+    :param grid: Monotonic (increasing or decreasing) vector of angles.
+    :param angles: Vector of angles, all of which are in the grid.
+    :return: Integer vector of indices into the grid.
+    """
+    if grid[-1] < grid[0]:
+        return grid.size - 1 - np.searchsorted(grid[::-1], angles)
+    return np.searchsorted(grid, angles)
+
+
+# OpenEXR compression methods accepted by RadEnv.write_openexr and the corresponding Imath.Compression constants
+_openexr_compression_names = OrderedDict([('none', 'NO_COMPRESSION'), ('rle', 'RLE_COMPRESSION'),
+                                          ('zips', 'ZIPS_COMPRESSION'), ('zip', 'ZIP_COMPRESSION'),
+                                          ('piz', 'PIZ_COMPRESSION'), ('pxr24', 'PXR24_COMPRESSION'),
+                                          ('b44', 'B44_COMPRESSION'), ('b44a', 'B44A_COMPRESSION'),
+                                          ('dwaa', 'DWAA_COMPRESSION'), ('dwab', 'DWAB_COMPRESSION')])
+
+
+def _openexr_compression(compression):
+    """ Obtain the Imath.Compression for an OpenEXR compression method name.
+
+    :param compression: Name of the compression method, one of the keys of `_openexr_compression_names` (case
+        insensitive). The dwaa and dwab methods require a version of OpenEXR that supports them.
+    :return: Imath.Compression object.
+    """
+    import Imath
+    compression_constants = OrderedDict((name, getattr(Imath.Compression, constant))
+                                        for name, constant in _openexr_compression_names.items()
+                                        if hasattr(Imath.Compression, constant))
+    if compression.lower() not in compression_constants:
+        raise ValueError('Unknown or unsupported OpenEXR compression ' + compression + ' in RadEnv.write_openexr. '
+                         'Use one of ' + ', '.join(compression_constants.keys()) + '.')
+    return Imath.Compression(compression_constants[compression.lower()])
+
+
+# Cache of spherical harmonic fitting matrices, keyed on the degree, integration method, hemi flag and angle grids
+_sph_harm_matrix_cache = LRUCache(maxsize=8)
+
+
+def _sph_harm_fit_matrix(degree, pza, paz, method='trapz', hemi=False):
+    """ Obtain the matrix which maps a REM on a (pza, paz) grid to real spherical harmonic coefficients, including
+    the quadrature weights and the :math:`\sin\theta` factor. The matrix is kept in a bounded, least-recently-used
+    cache, so that fitting of further REMs on the same grid requires only a single matrix product. The returned
+    arrays are shared and are read-only.
+
+    :param degree: Maximum degree of the spherical harmonics.
+    :param pza: Vector of propagation zenith angles in radians.
+    :param paz: Vector of propagation azimuth angles in radians.
+    :param method: Integration method, 'trapz', 'sum' or 'simpson'.
+    :param hemi: If True, the REM covers only the hemisphere on one side of the solar principal plane and the
+        coefficients are computed for the REM reflected into the other hemisphere.
+    :return: Tuple (shn, shm, fit_matrix) with fit_matrix of shape ((degree+1)**2, pza.size * paz.size).
+    """
+    pza = np.asarray(pza, dtype=np.float64)
+    paz = np.asarray(paz, dtype=np.float64)
+    cache_key = (degree, method, bool(hemi), pza.tobytes(), paz.tobytes())
+    cached = _sph_harm_matrix_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    shn, shm, basis = real_sph_harm_basis(degree, pza[:, np.newaxis], paz[np.newaxis, :])
+    weights = (_quadrature_weights(pza, method) * np.sin(pza))[:, np.newaxis] * _quadrature_weights(paz, method)
+    fit_matrix = (basis * weights[np.newaxis, ...]).reshape((shn.size, -1))
+    if hemi:
+        # Sine (m < 0) terms vanish for a REM symmetric about the solar principal plane and the cosine terms double
+        fit_matrix[shm < 0, :] = 0.0
+        fit_matrix[shm >= 0, :] *= 2.0
+    for matrix_array in [shn, shm, fit_matrix]:
+        matrix_array.flags.writeable = False
+    _sph_harm_matrix_cache.put(cache_key, (shn, shm, fit_matrix))
+    return shn, shm, fit_matrix
+
 class Case(object):
     """ Class which encapsulates a run case of libRadtran/uvspec.
     This class has methods to read libRadtran/uvspec input files, write uvspec input files, run uvspec in parallel on
@@ -409,6 +662,12 @@ class Case(object):
         self.name = casename
         self.error_txt = []
         self.stderr = ''  # Error output from the uvspec run may be read into this
+        self.stderr_full = False  # If True, readerr keeps all lines of the error output, otherwise only the tail
+        self.stderr_tail_lines = 100  # Number of lines at the end of the error output kept by readerr
+        self.stderr_max_messages = 200  # Maximum number of warning/error messages extracted by readerr
+        self.stderr_messages = []  # Warning and error messages extracted from the error output
+        self.stderr_n_lines = 0  # Total number of lines in the error output
+        self.stderr_truncated = False  # True if not all lines of the error output are kept in self.stderr
         self.run_return_code = -1  # Will be set when uvspec run is executed
         self.purge = True  # This will purge uvspec input, output and error files after run, unless set False
         self.options = []  # options is a list [option_name (string), option_tokens (list of strings),
@@ -430,6 +689,7 @@ class Case(object):
         self.n_umu = 0  # number of zenith angles (actually cosine of zenith angle)
         self.umu = []  # zenith angles for radiance calculations
         self.uu = np.array([])  # This will be populated if there is radiance data output by the case
+        self.u0u = np.array([])  # Azimuthally averaged radiance, populated if there is radiance data output
         self.n_phi = 0  # number of azimuth radiance angles
         self.phi = [] # np.zeros(1)  # azimuth angles for radiance calculations
         self.n_levels_out = 1  # Assume only one output level, unless zout/zout_sea/pressure_out keyword is used.
@@ -456,6 +716,7 @@ class Case(object):
         self.has_water_clouds = False  # ditto
         self.has_clouds = False  # either water or ice clouds
         self.verbose = False  # Default verbose output to false
+        self.read_optprop = False  # If True, optical property profiles are read from verbose stderr output after runs
         if filename is not None:
             if not filename:
                 # Open a dialog to get the filename
@@ -1430,12 +1691,20 @@ class Case(object):
         self.process_outputs()
 
 
-    def readerr(self, filename=None):
+    def readerr(self, filename=None, full=None):
         """ Read any error output from the uvspec run and attach it to the self object in the self.stderr property
 
         It is important to check error output to see if the uvspec run was successful or what diagnostics were
         provided.
 
+        The error output file is read line by line. Unless full capture is requested, only the last
+        `self.stderr_tail_lines` lines are kept in self.stderr, so that memory (and the cost of transferring the
+        case back from a compute engine) does not grow with the size of the error output. Lines containing the words
+        'error' or 'warning' (case insensitive) are extracted into self.stderr_messages as dictionaries with keys
+        'line_no', 'level' ('error' or 'warning') and 'text'. At most `self.stderr_max_messages` messages are kept.
+        The total number of lines is placed in self.stderr_n_lines and self.stderr_truncated is set True if
+        self.stderr does not contain all of the lines.
+
         WARNING : If the 'verbose' option is used in the uvspec input file, the error output file can be VERY large.
         The 'verbose' option prints a large amount of information relating to setup of the RT problem. Please refer to
         the libRadtran manual in respect of using 'verbose'. It is encouraged in the beginning stages of setting up
@@ -1444,22 +1713,144 @@ class Case(object):
 
         :param filename: The name of te error file to read. If not provided, the default filename will be used. If
             provided as the empty string '', a file/open dialog will be presented.
+        :param full: If True, all lines of the error output are kept in self.stderr. Default is None, in which case
+            the self.stderr_full attribute (default False) is used.
         :return: True if a file was read and False if the file was not found.
         """
+        from collections import deque
         if filename is None:
             filename = self.errfile
         elif filename == '':
             import easygui
             filename = easygui.fileopenbox(msg='Please select the uvspec error output file.', filetypes=["*.ERR"])
+        if full is None:
+            full = self.stderr_full
+        self.stderr_messages = []
+        self.stderr_n_lines = 0
+        self.stderr_truncated = False
         if not os.path.isfile(filename):
             print('Error output file does not exist. Run uvspec with stderr redirected to an output file.')  ##TODO use an exception
             self.stderr = ''
             return False
-        # Read the entire error file and attach as the stderr field
+        if full:
+            stderr_lines = []
+        else:
+            stderr_lines = deque(maxlen=self.stderr_tail_lines)
+        message_pattern = re.compile('\\b(error|warning)', re.IGNORECASE)
+        with open(filename, 'rt') as sterrfid:
+            for line_no, line in enumerate(sterrfid):
+                stderr_lines.append(line)
+                message_match = message_pattern.search(line)
+                if message_match and len(self.stderr_messages) < self.stderr_max_messages:
+                    self.stderr_messages.append({'line_no': line_no, 'level': message_match.group(1).lower(),
+                                                 'text': line.strip()})
+                self.stderr_n_lines = line_no + 1
+        self.stderr = list(stderr_lines)
+        self.stderr_truncated = len(self.stderr) < self.stderr_n_lines
+        return True
+
+    def read_verbose_optprop(self, filename=None, z_col=1, od_col=-3, ssa_col=-2, g_col=-1, wvl_regex=None):
+        """ Read the profiles of layer optical thickness, single scattering albedo and asymmetry parameter for each
+        wavelength from the `verbose` standard error output of a uvspec run.
+
+        The file is read line by line, so that the very large error output produced by the `verbose` option need
+        not be held in memory. For each wavelength, the optical properties table is identified by a line matching
+        the wavelength regular expression, followed by a table header line containing 'z[km]'. Numeric table rows
+        are read until the first line that is not entirely numeric (column separators '|' are ignored).
+
+        Only monochromatic calculations (`mol_abs_param crs`) are supported, for which uvspec prints a single table
+        per wavelength. Band, representative wavelength (reptran) and correlated-k parametrisations print a table
+        for each sub-band, which must be combined with the sub-band weights, and for which a single optical depth
+        per wavelength does not obey Beer's Law. A ValueError is raised if the case uses any of these, or if the
+        table for any wavelength is found more than once.
+
+        The layout of the table differs between libRadtran versions, so the column numbers must match the version in
+        use. The defaults assume that the altitude is in the second column and that the last three columns are the
+        total layer optical thickness, single scattering albedo and asymmetry parameter. Each row is assumed to give
+        the altitude (above sea level) of the top of a layer.
+
+        The results are attached as the xr.DataArray attributes `xd_optprop_od`, `xd_optprop_ssa`, `xd_optprop_g`
+        and `xd_optprop_ext` (extinction coefficient in units of inverse km), each having dimensions of
+        wavelength (`wvl`) and altitude above sea level of the layer top (`zout_sea`).
+
+        :param filename: The name of the error file to read. If not provided, the default filename will be used.
+        :param z_col: Column number of the altitude in the optical properties table. Default 1.
+        :param od_col: Column number of the layer optical thickness. Default -3.
+        :param ssa_col: Column number of the layer single scattering albedo. Default -2.
+        :param g_col: Column number of the layer asymmetry parameter. Default -1.
+        :param wvl_regex: Regular expression identifying the start of the output for a wavelength, with the
+            wavelength in nm as the first group. The default matches e.g. 'at 550.000 nm' or 'lambda = 550.0 nm'.
+        :return: True if any optical property tables were read and False otherwise.
+        """
+        if self.mol_abs_param != 'crs':
+            raise ValueError('Optical property profiles can only be read from verbose output of monochromatic '
+                             'calculations (mol_abs_param crs), not ' + self.mol_abs_param + '.')
+        if filename is None:
+            filename = self.errfile
+        if wvl_regex is None:
+            wvl_regex = '(?:\\bat|lambda\\s*=)\\s*([-+]?[0-9]*\\.?[0-9]+(?:[eE][-+]?[0-9]+)?)\\s*nm'
+        wvl_pattern = re.compile(wvl_regex)
+        if not os.path.isfile(filename):
+            warnings.warn('Verbose error output file ' + filename + ' does not exist.')
+            return False
+        tables = OrderedDict()  # Optical property table for each wavelength
+        columns = [z_col, od_col, ssa_col, g_col]
+        wvl = None
+        rows = None  # Becomes a list once a table header has been found
         with open(filename, 'rt') as sterrfid:
-            self.stderr = sterrfid.readlines()
+            for line in sterrfid:
+                if rows is not None:  # Reading a table
+                    try:
+                        row = [float(token) for token in line.replace('|', ' ').split()]
+                    except ValueError:
+                        row = []
+                    if row:
+                        rows.append([row[col] for col in columns])
+                        continue
+                    if rows:  # End of the table, lines preceding the first numeric row are skipped
+                        Case._add_optprop_table(tables, wvl, rows, filename)
+                        rows = None
+                wvl_match = wvl_pattern.search(line)
+                if wvl_match:
+                    wvl = float(wvl_match.group(1))
+                    rows = None
+                elif wvl is not None and 'z[km]' in line:
+                    rows = []
+            if rows:  # Table running to the end of the file
+                Case._add_optprop_table(tables, wvl, rows, filename)
+        if not tables:
+            warnings.warn('No optical property tables found in verbose error output file ' + filename)
+            return False
+        wvl = np.array(list(tables.keys()))
+        z_top = tables[wvl[0]][:, 0]
+        if any([table.shape[0] != z_top.size for table in tables.values()]):
+            raise ValueError('Inconsistent number of layers in verbose optical property tables.')
+        optprop = np.array(list(tables.values()))
+        # Layer thickness from the layer top altitudes, with the bottom of the lowest layer at the surface
+        z_bottom = np.append(z_top[1:], np.atleast_1d(self.altitude)[0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ext = optprop[:, :, 1] / np.abs(z_top - z_bottom)
+        coords = [xd_identity(wvl, 'wvl', 'nm'), xd_identity(z_top, 'zout_sea', 'km')]
+        self.xd_optprop_od = xr.DataArray(optprop[:, :, 1], coords, name='od', attrs={'long_name': long_name['od'],
+                                                                                      'units': ''})
+        self.xd_optprop_ssa = xr.DataArray(optprop[:, :, 2], coords, name='ssa', attrs={'long_name': long_name['ssa'],
+                                                                                        'units': ''})
+        self.xd_optprop_g = xr.DataArray(optprop[:, :, 3], coords, name='asy', attrs={'long_name': long_name['asy'],
+                                                                                      'units': ''})
+        self.xd_optprop_ext = xr.DataArray(ext, coords, name='ext', attrs={'long_name': long_name['ext'],
+                                                                           'units': '1/km'})
         return True
 
+    @staticmethod
+    def _add_optprop_table(tables, wvl, rows, filename):
+        """ Add an optical property table read from verbose output to the dictionary of tables for each wavelength.
+        A repeated table for the same wavelength (e.g. sub-band tables) is an error.
+        """
+        if wvl in tables:
+            raise ValueError('More than one optical property table found for wavelength ' + str(wvl) + ' nm in ' +
+                             filename + '. Sub-band (band or correlated-k) tables are not supported.')
+        tables[wvl] = np.array(rows)
+
     def run(self, stderr_to_file=True, write_input=True, read_output=True, block=True, purge=True, check_output=False):
         """ Run the libRadtran/uvspec case.
 
@@ -1515,6 +1906,8 @@ class Case(object):
             self.readout(filename=self.name+'.OUT')  # Read the output into the instance if the return code OK
         if stderr_to_file and read_output:
             self.readerr(filename=self.name+'.ERR')  # Read and attach any error output
+            if self.read_optprop and self.verbose:  # Extract optical property profiles before any purge
+                self.read_verbose_optprop(filename=self.name+'.ERR')
         if self.purge and purge and read_output:  # Delete the input and output files
             try:
                 os.remove(self.name+'.INP')
@@ -1579,6 +1972,12 @@ class Case(object):
             xd_uu = xr.DataArray(self.uu, [pza, paz, spectral_axis, levels, stokes],
                                     name=qty_name, attrs={'units': uu_units})
             self.xd_uu = xd_uu
+        # Convert azimuthally averaged radiance output to xr.DataArray
+        if self.n_umu and np.ndim(self.u0u) == 4:
+            qty_name = {'radiance': 'specrad', 'transmittance': 'trnx', 'reflectivity': 'reflx',
+                        'brightness': 'brightness'}[self.output_quantity]
+            self.xd_u0u = xr.DataArray(self.u0u, [self.pza, spectral_axis, levels, stokes],
+                                       name=qty_name, attrs={'units': self.rad_units_str()})
         # Try to process fluxline data into xr.DataArray objects
         single_col_flux_fields = ['edir', 'edn', 'eup', 'uavgdir', 'uavgdn', 'uavgup', 'uavgglo', 'down_fluxI',
                                   'down_fluxQ', 'down_fluxU', 'down_fluxV', 'up_fluxI',
@@ -1684,7 +2083,8 @@ class RadEnv(object):
 
     """
 
-    def __init__(self, base_case, n_pol, n_azi, mxumu=48, mxphi=19, hemi=False, n_sza=0):
+    def __init__(self, base_case, n_pol, n_azi, mxumu=48, mxphi=19, hemi=False, n_sza=0, trans_mode='sza',
+                 batching='fixed', n_workers=1, batch_cost=(1.0, 0.01, 0.001, 0.0), azi_symmetric=None):
         """ Create a set of uvspec runs covering the whole sphere to calculate a full radiant environment map.
         Where the base_case is the uvspec case on which to base the environmental map, Name is the name to give the
         environmental map and n_pol and n_azi are the number of polar and azimuthal sightline angles to generate. The
@@ -1712,6 +2112,25 @@ class RadEnv(object):
             This is the recommended mode (hemi=True) for MORTICIA purposes, since it reduces execution time.
         :param n_sza: The number of solar zenith angles (SZA) at which to perform transmittance and path radiance
             computations. Each SZA will result in another run of the base case (no radiances)
+        :param trans_mode: The manner in which the transmittance cases are run. See `RadEnv.setup_trans_cases`.
+            Default is 'sza'.
+        :param batching: The manner in which sightlines are split into batches (cases). If 'fixed' (the default),
+            the angles are tiled into batches of exactly mxumu polar and mxphi azimuth angles, with any remainder in
+            the last batch. If 'optimal', the number of batches is chosen to minimise the estimated elapsed time
+            on `n_workers` workers and then the number of cases, within the mxumu and mxphi limits, and angles are
+            split as evenly as possible into the batches.
+        :param n_workers: Number of workers (e.g. cluster engines) available to run cases concurrently. Only used
+            if batching='optimal'. Default 1.
+        :param batch_cost: Tuple of (overhead, per_umu, per_phi, per_sightline) coefficients of the estimated cost
+            of a uvspec run with a given number of polar (umu) and azimuth (phi) angles. Only used if
+            batching='optimal'. The units are arbitrary. The default assumes that the cost of a run is dominated by
+            a fixed overhead (optical property setup and the RT solution), with a smaller cost per umu and smaller
+            still per phi.
+        :param azi_symmetric: Boolean. If True, the REM is taken to have no azimuthal dependence, as is the case for
+            `source thermal` REMs and fully overcast conditions. Only polar angle (umu) sightlines are then run and
+            the azimuthally averaged radiance (`u0u`) is broadcast along the azimuth axis of `xd_uu` without
+            copying. Default is None, in which case the REM is taken as azimuthally symmetric if the base case has
+            `source thermal`. Overcast conditions are not detected automatically and the flag should be set True.
 
 
         The solver cdisort may have dynamic memory allocation, so the warning is still issued because the situation
@@ -1766,18 +2185,37 @@ class RadEnv(object):
             prop_azi_angles = np.linspace(0.0, 360.0, n_azi)
             view_azi_angles = np.linspace(-180.0, 180.0,  n_azi)
         phi = prop_azi_angles
-        n_azi_batch = np.int(np.ceil(np.float64(len(prop_azi_angles))/mxphi))
-        n_pol_batch = np.int(np.ceil(np.float64(len(prop_zen_angles))/mxumu))
+        if azi_symmetric is None:
+            azi_symmetric = self.base_case.source == 'thermal'
+        self.azi_symmetric = azi_symmetric
+        if batching == 'fixed':
+            azi_batches = [phi[iazi_start:np.minimum(iazi_start+mxphi, len(phi))]
+                           for iazi_start in range(0, len(phi), mxphi)]
+            pol_batches = [umu[ipol_start:np.minimum(ipol_start+mxumu, len(umu))]
+                           for ipol_start in range(0, len(umu), mxumu)]
+        elif batching == 'optimal':
+            n_pol_batch, n_azi_batch = _optimal_batch_counts(len(umu), len(phi), mxumu, mxphi, n_workers=n_workers,
+                                                             batch_cost=batch_cost)
+            azi_batches = np.array_split(phi, n_azi_batch)
+            pol_batches = np.array_split(umu, n_pol_batch)
+        else:
+            raise ValueError('Unknown batching ' + batching + ' in RadEnv. Use fixed or optimal.')
+        if azi_symmetric:
+            azi_batches = [[]]  # A single batch with no phi keyword, to obtain u0u only
+        n_azi_batch = len(azi_batches)
+        n_pol_batch = len(pol_batches)
         # Create an list of lists with all these batches of librad.Case
         self.cases = [[copy.deepcopy(base_case) for i_azi in range(n_azi_batch)] for j_pol in range(n_pol_batch)]
 
         # TODO : Take care of phi0 input in the case of hemi=True
-        for iazi, iazi_start in enumerate(range(0, len(phi), mxphi)):
-            batch_azi = phi[iazi_start:np.minimum(iazi_start+mxphi, len(phi))]
-            for ipol, ipol_start in enumerate(range(0, len(umu), mxumu)):
-                batch_pol = umu[ipol_start:np.minimum(ipol_start+mxumu, len(umu))]
+        for iazi, batch_azi in enumerate(azi_batches):
+            for ipol, batch_pol in enumerate(pol_batches):
                 # Set the umu and phi keyword parameters
-                self.cases[ipol][iazi].alter_option(['phi'] + [str(x) for x in batch_azi])
+                if azi_symmetric:
+                    self.cases[ipol][iazi].del_option('phi')
+                    self.cases[ipol][iazi].del_option('phi0')
+                else:
+                    self.cases[ipol][iazi].alter_option(['phi'] + [str(x) for x in batch_azi])
                 self.cases[ipol][iazi].alter_option(['umu'] + [str(x) for x in batch_pol])
                 # Set up individual case names
                 self.cases[ipol][iazi].infile = (self.cases[ipol][iazi].infile[:-4] +
@@ -1786,11 +2224,13 @@ class RadEnv(object):
                                                  '_{:04d}_{:04d}.OUT'.format(ipol, iazi))
                 self.cases[ipol][iazi].name = (self.cases[ipol][iazi].name +
                                                  '_{:04d}_{:04d}'.format(ipol, iazi))
-                if hemi:  # Doing only one hemisphere along solar principal plane
+                if hemi and not azi_symmetric:  # Doing only one hemisphere along solar principal plane
                     self.cases[ipol][iazi].alter_option(['phi0', '0.0'])  # Sun shining towards North
         # Create a flattened list view of the cases
         # Put all the cases into a single list
         self.casechain = list(chain(*self.cases))  # This creates a linear view of the cases
+        self.mxumu = mxumu
+        self.mxphi = mxphi
         self.hemi = hemi
         self.n_azi = n_azi
         self.n_pol = n_pol
@@ -1806,12 +2246,13 @@ class RadEnv(object):
         self.has_ice_clouds = self.base_case.has_ice_clouds
         self.has_clouds = self.base_case.has_clouds
         self.n_sza = n_sza
+        self.trans_mode = trans_mode
         if n_sza:  # Setup the transmission run cases
-            self.setup_trans_cases(n_sza=n_sza)
+            self.setup_trans_cases(n_sza=n_sza, trans_mode=trans_mode)
             # self.trans_vza_up = []
         self.uu = np.array([])
 
-    def setup_trans_cases(self, n_sza=32):
+    def setup_trans_cases(self, n_sza=32, trans_mode='sza'):
         """ Setup a list of cases for computing the transmission matrices between every level defined in the
         REM (and at every wavelength and stokes parameter combination). The computation of  transmittance between
         levels is accomplished in `MORTICIA` using libRadtran/uvspec by computing the direct solar irradiance
@@ -1868,24 +2309,47 @@ class RadEnv(object):
              SZA itself. This is to help with the problem that the slant range between levels increases
              in linear relation to the secant of the view zenith angle. The optical depths are later
              interpolated to the same sightlines as the REM itself.
+        :param trans_mode: String. If 'sza' (the default), the transmission cases are copies of the base case,
+             using the same RT solver and options, with one case per SZA. If 'cheap', the direct beam transmittance
+             is computed with the cheapest valid configuration. The `twostr` solver is used and options relating
+             only to the multiple scattering solution (such as `number_of_streams`, `polradtran` and `mc_` options)
+             are removed. The direct beam transmittance does not depend on the multiple scattering solution. One
+             case is still run for each SZA (uvspec accepts only a single SZA per run), since scaling of the zero
+             SZA transmittance with the secant of the SZA (Beer's Law) does not hold for band models and
+             correlated-k schemes. If 'verbose' (only for monochromatic calculations with `mol_abs_param crs`),
+             a single `twostr` case
+             is run with the `verbose` option and the layer optical thickness profile is read from the error
+             output (see `Case.read_verbose_optprop`). Slant path optical depths are then computed analytically
+             (plane parallel geometry) for all sightlines, including those close to the horizontal.
         :return:
         """
-
-        # Start by removing any cloud options in the transmission base_case, as well as any radiance options
-        # to reduce runtime.
-        new_option_list = []
-        new_tokens_list = []
+        if trans_mode not in ['sza', 'cheap', 'verbose']:
+            raise ValueError('Unknown trans_mode ' + trans_mode + ' in RadEnv.setup_trans_cases.')
+        if trans_mode == 'verbose' and self.trans_base_case.mol_abs_param != 'crs':
+            raise ValueError('Verbose transmittance mode requires monochromatic calculations (mol_abs_param crs). '
+                             'Band, representative wavelength (reptran) and correlated-k parametrisations have more '
+                             'than one optical property table per wavelength, which do not obey Beer\'s Law.')
+        self.trans_mode = trans_mode
         # TODO : setup up transmission case series with AND without clouds
-        # Remove radiance options to speed up transmission series computations
-        options_to_remove = ['umu', 'phi', 'phi0']
-        for (ioption, option) in enumerate(self.trans_base_case.options):
-            if any([option == removal_option for removal_option in options_to_remove]):
-                pass  # TODO : Look for other cloud options that may be important
-            else:
-                new_option_list.append(option)
-                new_tokens_list.append(self.trans_base_case.tokens[ioption])
-        self.trans_base_case.options = new_option_list
-        self.trans_base_case.tokens = new_tokens_list
+        # Remove radiance options to speed up transmission series computations. The options are deleted with
+        # del_option, which keeps the tokens, file origins and option objects of the case in step with the options.
+        for option in ['umu', 'phi', 'phi0']:
+            self.trans_base_case.del_option(option)
+        if trans_mode in ['cheap', 'verbose']:
+            # Remove options relating only to the multiple scattering solution and switch to the two-stream solver
+            cheap_options_to_remove = ['number_of_streams', 'polradtran', 'disort_intcor', 'rte_solver']
+            if trans_mode == 'verbose':
+                # The quiet option suppresses the verbose output from which the optical properties are read
+                cheap_options_to_remove.append('quiet')
+            for option in list(self.trans_base_case.options):
+                if option in cheap_options_to_remove or option.startswith('mc_'):
+                    self.trans_base_case.del_option(option)
+            self.trans_base_case.n_stokes = 1
+            self.trans_base_case.stokes = ['I']
+            self.trans_base_case.alter_option(['rte_solver', 'twostr'])
+        if trans_mode == 'verbose':
+            self.trans_base_case.alter_option(['verbose', ''])
+            self.trans_base_case.read_optprop = True
         # There are no radiance calculations now, so set n_phi and n_umu to zero
         self.trans_base_case.n_phi = 0
         self.trans_base_case.phi = []
@@ -1912,10 +2376,14 @@ class RadEnv(object):
         # Now build a list of uvspec runs, based on trans_base_case
         # The list is called trans_cases
         self.trans_cases = []
-        for i_case in range(len(vpa_up)):
+        i_case = -1
+        for i_sza in range(len(vpa_up)):
+            # Set the solar zenith angle, which is given to uvspec in degrees
+            sza = np.rad2deg(float(self.trans_vza_up[i_sza].data))
+            if trans_mode == 'verbose' and sza > 0.0:
+                continue  # Only a single run is required to obtain the optical property profiles
             self.trans_cases.append(copy.deepcopy(self.trans_base_case))
-            # Set the solar zenith angle
-            sza = self.trans_vza_up[i_case].data  # Solar zenith angle
+            i_case += 1
             self.trans_cases[i_case].alter_option(['sza', str(sza)])
             # Set cloudcover to zero if the case has water or ice clouds
             if self.trans_base_case.has_water_clouds:
@@ -1923,16 +2391,16 @@ class RadEnv(object):
             if self.trans_base_case.has_ice_clouds:
                 self.trans_cases[i_case].alter_option(['cloudcover', 'ic', '0.0'])
             # Set pseudospherical option above sza of 75 degrees and solver is disort or twostr
-            if sza > 75.0 and any([self.solver == thesolver for thesolver in ['disort', 'disort2', 'sdisort',
+            if sza > 75.0 and any([self.trans_base_case.solver == thesolver for thesolver in ['disort', 'disort2', 'sdisort',
                                                            'spsdisort', 'fdisort1', 'fdisort2', 'twostr']]):
                 self.trans_cases[i_case].alter_option(['pseudospherical', ''])
             # Change the name and input and output filenames, the _x_ is for transmission runs
             self.trans_cases[i_case].infile = (self.trans_cases[i_case].infile[:-4] +
-                                             '_x_{:04d}.INP'.format(i_case))
+                                             '_x_{:04d}.INP'.format(i_sza))
             self.trans_cases[i_case].outfile = (self.trans_cases[i_case].outfile[:-4] +
-                                             '_x_{:04d}.OUT'.format(i_case))
+                                             '_x_{:04d}.OUT'.format(i_sza))
             self.trans_cases[i_case].name = (self.trans_cases[i_case].name +
-                                             '_x_{:04d}'.format(i_case))
+                                             '_x_{:04d}'.format(i_sza))
         # The transmission cases should be ready to run at this point.
         # The run_ipyparallel method will run these cases, but not in parallel with
         # the radiance cases.
@@ -1947,6 +2415,65 @@ class RadEnv(object):
             self.cloud_detect_cases.append(copy.deepcopy(self.trans_base_case))
             self.cloud_detect_cases[2].alter_option(['cloudcover', '1.0'])
 
+    def _assemble_radiance(self):
+        """ Compile the radiance and irradiance results from the executed cases in the casechain into the RadEnv.
+        This is called by the run methods once all the cases in the casechain have been executed.
+
+        :return: None
+        """
+        # Now recreate the list of lists view
+        self.cases = [[self.casechain[i_pol * self.n_azi_batch + i_azi] for i_azi in range(self.n_azi_batch)]
+                                                                        for i_pol in range(self.n_pol_batch)]
+        if getattr(self, 'azi_symmetric', False):
+            # Only azimuthally averaged radiances were computed, broadcast these along the azimuth axis (no copy)
+            self.xd_u0u = xr.concat([case.xd_u0u for case in self.casechain], dim='pza')
+            self.xd_u0u['pza'] = self.pza
+            other_dims = list(self.xd_u0u.dims[1:])
+            self.uu = np.broadcast_to(self.xd_u0u.data[:, np.newaxis, ...],
+                                      (self.pza.size, self.paz.size) + self.xd_u0u.shape[1:])
+            self.xd_uu = xr.DataArray(self.uu, [self.pza, self.paz] + [self.xd_u0u[dim] for dim in other_dims],
+                                      name=self.xd_u0u.name, attrs=self.xd_u0u.attrs)
+        else:
+            # Compile the radiance results into one large array
+            self.uu = np.hstack([np.vstack([self.cases[i_pol][i_azi].uu for i_pol in range(self.n_pol_batch)])
+                                                                        for i_azi in range(self.n_azi_batch)])
+            # if self.hemi:  # Double up in the azimuth direction, but flip as well
+            #     self.uu = np.hstack([self.uu, self.uu[:,::-1,...]])
+            #     # Perform doubling up in all azimuth variables
+            #     self.pza = xr.concat((self.pza, self.pza + np.pi), dim='pza')
+            #     self.phi = xr.concat((self.phi, self.phi + 180), dim='phi')
+            #     self.vaz = xr.concat((self.vaz, self.vaz + 180), dim='vaz')  # view azimuth angle
+            # Delete the individual results in an attempt to save memory
+            for case in self.casechain:
+                del case.uu
+            # Concatenate the cases in umu and phi
+            self.xd_uu = xr.concat([xr.concat([case_uu.xd_uu for case_uu in self.cases[jj]], dim='paz')
+                                                     for jj in range(len(self.cases))], dim='pza')
+            #self.xd_uu = xr.DataArray(self.uu, [self.pza, self.paz, self.spectral, self.levels, self.stokes])
+            # Replace the values in the xr.DataArray with the exact original values in the zenith and azimuth
+            # directions. Not doing this gave rise to a very subtle bug in spherical harmonic fitting
+            self.xd_uu['pza'] = self.pza
+            self.xd_uu['paz'] = self.paz
+        self._promote_irradiance()
+
+    def _promote_irradiance(self):
+        """ Obtain the irradiance results from the first case in the casechain. The irradiances should be the same for
+        all the cases making up the REM.
+
+        :return: None
+        """
+        # Also need to obtain the irradiances from one of the cases - they should actually all be the same
+        fluxdata = self.casechain[0].fluxdata  # Would really want this as a xr.DataArray
+        fluxline = self.casechain[0].fluxline
+        irrad_units = self.casechain[0].irrad_units_str()
+        # Promote irradiance data from
+        for flux_component in fluxline:
+            if hasattr(self.casechain[0], 'xd_' + flux_component):
+                setattr(self, 'xd_' + flux_component, getattr(self.casechain[0], 'xd_' + flux_component))
+        self.fluxdata = fluxdata
+        self.fluxline = fluxline
+        self.irrad_units = irrad_units
+
     def run_ipyparallel(self, ipyparallel_view, stderr_to_file=False, purge=False):
         """ Run a complete set of radiant environment map cases of libRadtran/uvspec using the `ipyparallel`
         Python package, which provides parallel computation from Jupyter notebooks and other Python launch
@@ -1977,40 +2504,7 @@ class RadEnv(object):
         # instead of being assigned element for element
         # TODO : Consider passing in the client instead, to set blocking and use_dill() EVERY time.
         self.casechain = ipyparallel_view.map(Case.run, self.casechain)
-        # Now recreate the list of lists view
-        self.cases = [[self.casechain[i_pol * self.n_azi_batch + i_azi] for i_azi in range(self.n_azi_batch)]
-                                                                        for i_pol in range(self.n_pol_batch)]
-        # Compile the radiance results into one large array
-        self.uu = np.hstack([np.vstack([self.cases[i_pol][i_azi].uu for i_pol in range(self.n_pol_batch)])
-                                                                    for i_azi in range(self.n_azi_batch)])
-        # if self.hemi:  # Double up in the azimuth direction, but flip as well
-        #     self.uu = np.hstack([self.uu, self.uu[:,::-1,...]])
-        #     # Perform doubling up in all azimuth variables
-        #     self.pza = xr.concat((self.pza, self.pza + np.pi), dim='pza')
-        #     self.phi = xr.concat((self.phi, self.phi + 180), dim='phi')
-        #     self.vaz = xr.concat((self.vaz, self.vaz + 180), dim='vaz')  # view azimuth angle
-        # Delete the individual results in an attempt to save memory
-        for case in self.casechain:
-            del case.uu
-        # Concatenate the cases in umu and phi
-        self.xd_uu = xr.concat([xr.concat([case_uu.xd_uu for case_uu in self.cases[jj]], dim='paz')
-                                                 for jj in range(len(self.cases))], dim='pza')
-        #self.xd_uu = xr.DataArray(self.uu, [self.pza, self.paz, self.spectral, self.levels, self.stokes])
-        # Replace the values in the xr.DataArray with the exact original values in the zenith and azimuth
-        # directions. Not doing this gave rise to a very subtle bug in spherical harmonic fitting
-        self.xd_uu['pza'] = self.pza
-        self.xd_uu['paz'] = self.paz
-        # Also need to obtain the irradiances from one of the cases - they should actually all be the same
-        fluxdata = self.casechain[0].fluxdata  # Would really want this as a xr.DataArray
-        fluxline = self.casechain[0].fluxline
-        irrad_units = self.casechain[0].irrad_units_str()
-        # Promote irradiance data from
-        for flux_component in fluxline:
-            if hasattr(self.casechain[0], 'xd_' + flux_component):
-                setattr(self, 'xd_' + flux_component, getattr(self.casechain[0], 'xd_' + flux_component))
-        self.fluxdata = fluxdata
-        self.fluxline = fluxline
-        self.irrad_units = irrad_units
+        self._assemble_radiance()
         # Run the transmittance sequences if there are any
         if self.n_sza:
             self.trans_cases = ipyparallel_view.map(Case.run, self.trans_cases)
@@ -2052,40 +2546,7 @@ class RadEnv(object):
         self.casechain_futures = dask_client.map(Case.run, self.casechain)
         # Gather the results
         self.casechain = dask_client.gather(self.casechain_futures)
-        # Now recreate the list of lists view
-        self.cases = [[self.casechain[i_pol * self.n_azi_batch + i_azi] for i_azi in range(self.n_azi_batch)]
-                                                                        for i_pol in range(self.n_pol_batch)]
-        # Compile the radiance results into one large array
-        self.uu = np.hstack([np.vstack([self.cases[i_pol][i_azi].uu for i_pol in range(self.n_pol_batch)])
-                                                                    for i_azi in range(self.n_azi_batch)])
-        # if self.hemi:  # Double up in the azimuth direction, but flip as well
-        #     self.uu = np.hstack([self.uu, self.uu[:,::-1,...]])
-        #     # Perform doubling up in all azimuth variables
-        #     self.pza = xr.concat((self.pza, self.pza + np.pi), dim='pza')
-        #     self.phi = xr.concat((self.phi, self.phi + 180), dim='phi')
-        #     self.vaz = xr.concat((self.vaz, self.vaz + 180), dim='vaz')  # view azimuth angle
-        # Delete the individual results in an attempt to save memory
-        for case in self.casechain:
-            del case.uu
-        # Concatenate the cases in umu and phi
-        self.xd_uu = xr.concat([xr.concat([case_uu.xd_uu for case_uu in self.cases[jj]], dim='paz')
-                                                 for jj in range(len(self.cases))], dim='pza')
-        #self.xd_uu = xr.DataArray(self.uu, [self.pza, self.paz, self.spectral, self.levels, self.stokes])
-        # Replace the values in the xr.DataArray with the exact original values in the zenith and azimuth
-        # directions. Not doing this gave rise to a very subtle bug in spherical harmonic fitting
-        self.xd_uu['pza'] = self.pza
-        self.xd_uu['paz'] = self.paz
-        # Also need to obtain the irradiances from one of the cases - they should actually all be the same
-        fluxdata = self.casechain[0].fluxdata  # Would really want this as a xr.DataArray
-        fluxline = self.casechain[0].fluxline
-        irrad_units = self.casechain[0].irrad_units_str()
-        # Promote irradiance data from
-        for flux_component in fluxline:
-            if hasattr(self.casechain[0], 'xd_' + flux_component):
-                setattr(self, 'xd_' + flux_component, getattr(self.casechain[0], 'xd_' + flux_component))
-        self.fluxdata = fluxdata
-        self.fluxline = fluxline
-        self.irrad_units = irrad_units
+        self._assemble_radiance()
         # Run the transmittance sequences if there are any
         if self.n_sza:
             self.trans_case_futures = dask_client.map(Case.run, self.trans_cases)
@@ -2129,6 +2590,205 @@ class RadEnv(object):
         for case in self.casechain:
             del case.uu
 
+    def refine(self, case_mapper, tol=0.01, max_passes=3, min_step=np.deg2rad(0.25)):
+        """ Adaptively refine the polar and azimuth angle grids of a REM that has already been run.
+
+        The error of linear interpolation in each polar and azimuth interval of the REM is estimated from the
+        second differences of the radiance, relative to the maximum radiance over all sightlines (for each
+        wavelength, level and Stokes parameter). Intervals for which the error exceeds the tolerance are bisected and
+        additional uvspec cases are run only for the new sightlines, i.e. the new polar angles at all azimuth angles
+        and the new azimuth angles at the existing polar angles. The new sightlines are merged into the REM, which
+        remains a rectilinear (but non-uniform) grid in polar and azimuth angle. Path transmittances and radiances are
+        recomputed if available.
+
+        The refined REM supports the same interpolation methods (e.g. RadEnv.sample) and EXR export as a uniform REM.
+        The horizontal (pza of pi/2) is never added, since it is illegal in libRadtran. Whenever a polar angle
+        :math:`\theta` is added, :math:`\pi - \theta` is also added, so that the polar angle grid remains symmetric
+        about the horizontal. This is required for the pairing of upward and downward sightlines in
+        `compute_path_transmittance` and `compute_path_radiance`.
+
+        :param case_mapper: Function which runs a list of librad.Case objects and returns the list of executed cases,
+            e.g. lambda cases: ipyparallel_view.map(Case.run, cases) or lambda cases: map(Case.run, cases).
+        :param tol: Error tolerance relative to the maximum radiance. Default 0.01.
+        :param max_passes: Maximum number of refinement passes. Default 3.
+        :param min_step: Intervals narrower than this angle (radians) are not refined. Default 0.25 degrees.
+        :return: List with a dictionary for each pass performed, giving the number of new polar angles ('n_new_pza'),
+            new azimuth angles ('n_new_paz') and the number of cases run ('n_cases').
+        """
+        if not hasattr(self, 'xd_uu'):
+            raise ValueError('RadEnv must be run before refinement.')
+        azi_symmetric = getattr(self, 'azi_symmetric', False)
+        if not hasattr(self, 'refine_cases'):
+            self.refine_cases = []
+        passes = []
+        for i_pass in range(max_passes):
+            other_dims = [dim for dim in self.xd_uu.dims if dim not in ['pza', 'paz']]
+            xd_uu = self.xd_uu.transpose(*(['pza', 'paz'] + other_dims))
+            uu = xd_uu.data[:, :1, ...] if azi_symmetric else xd_uu.data
+            scale = np.max(np.abs(uu), axis=(0, 1), keepdims=True)
+            scale[scale == 0.0] = 1.0
+            new_pza = _refinement_angles(self.pza.data, _interval_interp_error(uu / scale, self.pza.data, 0), tol,
+                                         min_step, avoid=np.pi/2)
+            new_pza = _mirrored_angles(new_pza, self.pza.data)  # Keep the polar angles symmetric about horizontal
+            if azi_symmetric:
+                new_paz = np.array([])
+            else:
+                new_paz = _refinement_angles(self.paz.data, _interval_interp_error(uu / scale, self.paz.data, 1),
+                                             tol, min_step)
+            if not new_pza.size and not new_paz.size:
+                break
+            pza_all = np.sort(np.concatenate((self.pza.data, new_pza)))[::-1]  # Polar angles descending
+            paz_all = np.sort(np.concatenate((self.paz.data, new_paz)))
+            # Sightline blocks requiring computation, new polar angles at all azimuths and new azimuths at old polar
+            if azi_symmetric:
+                blocks = [(new_pza, None)]
+            else:
+                blocks = [(new_pza, paz_all), (self.pza.data, new_paz)]
+            cases = []
+            batches = []
+            for block_pza, block_paz in blocks:
+                if not block_pza.size or (block_paz is not None and not block_paz.size):
+                    continue
+                for batch_pza in [block_pza[i_start:i_start + self.mxumu]
+                                  for i_start in range(0, block_pza.size, self.mxumu)]:
+                    if block_paz is None:
+                        paz_batches = [None]
+                    else:
+                        paz_batches = [block_paz[i_start:i_start + self.mxphi]
+                                       for i_start in range(0, block_paz.size, self.mxphi)]
+                    for batch_paz in paz_batches:
+                        cases.append(self._sightline_case(batch_pza, batch_paz,
+                                                          '_r{:02d}_{:04d}'.format(i_pass, len(cases))))
+                        batches.append((batch_pza, batch_paz))
+            cases = list(case_mapper(cases))
+            self.refine_cases.extend(cases)
+            # Merge the existing and new radiances into the refined grid
+            if azi_symmetric:
+                xd_u0u = self.xd_u0u
+                u0u = np.empty((pza_all.size,) + xd_u0u.shape[1:])
+                u0u[_angle_indices(pza_all, self.pza.data), ...] = xd_u0u.data
+                for case, (batch_pza, batch_paz) in zip(cases, batches):
+                    u0u[_angle_indices(pza_all, batch_pza), ...] = case.xd_u0u.data
+            else:
+                uu = np.empty((pza_all.size, paz_all.size) + xd_uu.shape[2:])
+                uu[np.ix_(_angle_indices(pza_all, self.pza.data), _angle_indices(paz_all, self.paz.data))] = xd_uu.data
+                for case, (batch_pza, batch_paz) in zip(cases, batches):
+                    uu[np.ix_(_angle_indices(pza_all, batch_pza), _angle_indices(paz_all, batch_paz))] = \
+                        case.xd_uu.data
+            # Update the angular axes
+            self.pza = xd_identity(pza_all, 'pza', 'rad')
+            self.paz = xd_identity(paz_all, 'paz', 'rad')
+            self.umu = xd_identity(np.cos(pza_all), 'umu', '')
+            self.phi = xd_identity(np.rad2deg(paz_all), 'phi', 'deg')
+            self.vza = xd_identity(180.0 - np.rad2deg(pza_all), 'vza', 'deg')
+            self.vaz = xd_identity(np.rad2deg(paz_all) - 180.0, 'vaz', 'deg')
+            self.n_pol = pza_all.size
+            self.n_azi = paz_all.size
+            other_coords = [xd_uu[dim] for dim in other_dims]
+            if azi_symmetric:
+                self.xd_u0u = xr.DataArray(u0u, [self.pza] + other_coords, name=xd_u0u.name, attrs=xd_u0u.attrs)
+                uu = np.broadcast_to(u0u[:, np.newaxis, ...], (pza_all.size, paz_all.size) + u0u.shape[1:])
+            self.uu = uu
+            self.xd_uu = xr.DataArray(uu, [self.pza, self.paz] + other_coords, name=xd_uu.name, attrs=xd_uu.attrs)
+            passes.append({'n_new_pza': new_pza.size, 'n_new_paz': new_paz.size, 'n_cases': len(cases)})
+        if passes and self.n_sza and hasattr(self, 'xd_trans'):
+            self.compute_path_transmittance()
+            self.compute_path_radiance()
+        return passes
+
+    def _sightline_case(self, batch_pza, batch_paz, suffix):
+        """ Create a copy of the base case for a batch of sightlines.
+
+        :param batch_pza: Vector of propagation zenith angles (radians).
+        :param batch_paz: Vector of propagation azimuth angles (radians). If None, the case computes azimuthally
+            averaged radiances only (no phi keyword).
+        :param suffix: String to append to the case name and filenames.
+        :return: librad.Case
+        """
+        case = copy.deepcopy(self.base_case)
+        if batch_paz is None:
+            case.del_option('phi')
+            case.del_option('phi0')
+        else:
+            case.alter_option(['phi'] + [str(x) for x in np.rad2deg(batch_paz)])
+            if self.hemi:
+                case.alter_option(['phi0', '0.0'])
+        case.alter_option(['umu'] + [str(x) for x in np.cos(batch_pza)])
+        case.infile = case.infile[:-4] + suffix + '.INP'
+        case.outfile = case.outfile[:-4] + suffix + '.OUT'
+        case.name = case.name + suffix
+        return case
+
+    def sightline_table(self, directions):
+        """ Precompute the interpolation index and weight tables for a set of sightlines (propagation directions)
+        in the REM. The table can be passed to `RadEnv.sample` in place of the directions when the same set of
+        sightlines is to be sampled repeatedly (e.g. for different quantities, wavelengths or levels).
+
+        If the REM covers only one hemisphere (hemi=True), propagation azimuths in the range :math:`\\pi` to
+        :math:`2\\pi` are reflected about the solar principal plane into the computed hemisphere.
+
+        :param directions: Numpy array of shape (..., 2) providing the propagation zenith angle `pza` and propagation
+            azimuth angle `paz` in radians of each sightline in the last dimension.
+        :return: Dictionary with keys 'pza' and 'paz', each being an (index, weight, in_bounds) tuple as returned by
+            `xd.axis_interp_weights`.
+        """
+        directions = np.asarray(directions, dtype=np.float64)
+        if directions.shape[-1] != 2:
+            raise ValueError('Input directions to RadEnv.sightline_table must have last dimension of size 2.')
+        pza = directions[..., 0]
+        paz = np.mod(directions[..., 1], 2.0 * np.pi)
+        if self.hemi:  # Reflect about the solar principal plane
+            paz = np.where(paz > np.pi, 2.0 * np.pi - paz, paz)
+        return {'pza': axis_interp_weights(self.pza.data, pza),
+                'paz': axis_interp_weights(self.paz.data, paz)}
+
+    def sample(self, directions, wavelengths=None, levels=None, quantity='uu', stokes=0, fill_value=np.nan):
+        """ Sample the radiant environment map (or one of the derived path quantities) at arbitrary sightlines,
+        wavelengths and levels using linear interpolation on all of the specified axes.
+
+        All sightlines are evaluated together using precomputed index and weight tables, rather than by
+        interpolation one sightline at a time. Where many queries are made against the same set of sightlines,
+        compute the tables once using `RadEnv.sightline_table` and pass the result as the `directions` input.
+
+        :param directions: Numpy array of shape (..., 2) providing the propagation zenith angle `pza` and propagation
+            azimuth angle `paz` in radians for each sightline, or a table as returned by `RadEnv.sightline_table`.
+        :param wavelengths: Spectral axis values (wavelength or wavenumber, depending on the spectral axis of the
+            REM) at which to sample. Must be broadcastable against the sightlines. If None (default), all
+            spectral samples are returned as a trailing dimension.
+        :param levels: Level values (of the `levels_out_type` axis, e.g. `zout`) at which to sample. Must be
+            broadcastable against the sightlines. If None (default), all levels are returned as a trailing dimension.
+        :param quantity: Name of the quantity to sample, being the name of an `xd_` attribute of the RadEnv, without the
+            `xd_` prefix. Default is 'uu' (the radiance). Others are 'path_radiance', 'trans' and 'opt_depth', if
+            available.
+        :param stokes: Index of the Stokes parameter to return (default 0). If None, all Stokes parameters are
+            returned as a trailing dimension.
+        :param fill_value: Value returned for samples outside the bounds of the REM axes. Default is np.nan.
+        :return: Numpy array having the broadcast shape of the sightlines, wavelengths and levels, followed by any
+            axes of the quantity which are retained (in their original order).
+        """
+        if not hasattr(self, 'xd_' + quantity):
+            raise ValueError('RadEnv does not have quantity xd_' + quantity + '. Has the RadEnv been run?')
+        xd_quantity = getattr(self, 'xd_' + quantity)
+        if isinstance(directions, dict):
+            table = directions
+        else:
+            table = self.sightline_table(directions)
+        axis_weights = []
+        for axis in xd_quantity.dims:
+            if axis in ['pza', 'paz']:
+                axis_weights.append(table[axis])
+            elif axis in ['wvl', 'wvn'] and wavelengths is not None:
+                axis_weights.append(axis_interp_weights(xd_quantity[axis].data, wavelengths))
+            elif axis == self.levels_out_type and levels is not None:
+                axis_weights.append(axis_interp_weights(xd_quantity[axis].data, levels))
+            elif axis == 'stokes' and stokes is not None:
+                stokes = np.asarray(stokes, dtype=np.intp)
+                axis_weights.append((stokes, np.zeros(stokes.shape), (stokes >= 0) & (stokes < xd_quantity.shape[
+                    xd_quantity.get_axis_num('stokes')])))
+            else:
+                axis_weights.append(None)
+        return gather_multilinear(xd_quantity.data, axis_weights, fill_value=fill_value)
+
     def sph_harm_fit(self, degree, method='trapz'):
         """ Fit spherical harmonics to the radiant environment map (REM).
         One set of coefficients per wavelength or spectral channel will be fitted. The coefficients for each spectral
@@ -2184,69 +2844,288 @@ class RadEnv(object):
         :param method: Integration method by which the coefficients are computed. 'trapz' for trapezoidal integration,
             'sum' for simple summation and 'simpson' for Simpson's Rule. The 'trapz' method seems to be
             considerably more accurate than 'sum' or 'simpson'. Therefore 'trapz' is the default.
-        :return:
+        :return: List of lists of coefficients for degree n and order m = 0 to n, as xr.DataArray objects. The
+            full set of real coefficients is also stored as the `xd_sph_harm_coeff` attribute, with dimension `shc`
+            (coefficient index :math:`n^2 + n + m`) and coordinates `shn` (degree) and `shm` (order).
         """
-        from scipy.special import sph_harm
-        azi_angles = self.paz.data  # Propagation zenith angles in radians
-        pol_angles = self.pza.data   # Propagation polar (zenith) angles in radians
-        azi_ang_delta = azi_angles[1] - azi_angles[0]
-        pol_ang_delta = abs(pol_angles[1] - pol_angles[0])
-        # print azi_ang_delta, pol_ang_delta
-        # Angles to be meshgridded - is this really necessary
-        # TODO : Check if meshgridding is really necessary
-        azi_angles, pol_angles = np.meshgrid(azi_angles, pol_angles)
-        sin_pol_angles = xr.DataArray(np.sin(pol_angles), [self.pza, self.paz])
-        # TODO : Symmetry checking still required
-        # if self.hemi:  # Sun-symmetric REM
+        # The basis functions and quadrature weights are combined into a single cached matrix, so that the
+        # coefficients for all wavelengths, levels and Stokes parameters are obtained with one matrix product
+        shn, shm, fit_matrix = _sph_harm_fit_matrix(degree, self.pza.data, self.paz.data, method=method,
+                                                    hemi=self.hemi)
+        other_dims = [dim for dim in self.xd_uu.dims if dim not in ['pza', 'paz']]
+        xd_uu = self.xd_uu.transpose(*(['pza', 'paz'] + other_dims))
+        coeff = np.dot(fit_matrix, xd_uu.data.reshape((fit_matrix.shape[1], -1)))
+        coeff = coeff.reshape((shn.size,) + xd_uu.shape[2:])
+        other_coords = [xd_uu[dim] for dim in other_dims]
+        self.xd_sph_harm_coeff = xr.DataArray(coeff, [('shc', np.arange(shn.size))] + other_coords,
+                                              name='sph_harm_coeff', attrs={'units': self.xd_uu.attrs.get('units', ''),
+                                                                            'degree': degree, 'method': method})
+        self.xd_sph_harm_coeff.coords['shn'] = ('shc', shn)
+        self.xd_sph_harm_coeff.coords['shm'] = ('shc', shm)
+        # Also provide the coefficients in the form of a list of lists for order m = 0 to n for each degree n.
+        # If hemi, these are the (doubled) cosine coefficients, otherwise the cosine coefficient in the real part
+        # and the sine coefficient in the imaginary part.
         sph_harm_coeff = []
-        # If calculating over one hemisphere of a symmetrical REM with sun in the north-south line,
-        # The sine (imaginary) coefficients are zero and the cos (real components) are doubled
-        # SO should just run m = 0 to n, take twice the real part if hemi, otherwise full complex calc
         for n in range(degree + 1):
             sph_harm_coeff.append([])  # Add another list of coefficients for order m = 0 to n
             for m in range(0, n + 1):
-                sph_harm_coeff[n].append(None)  # Add another coefficient for order m
-                condon_short = (-1.0)**m * np.sqrt(2)
-                # Compute the complex spherical harmonic basis
-                if m == 0:
-                    y_mn = sph_harm(0, n, azi_angles, pol_angles)
-                else:
-                    y_mn = condon_short * sph_harm(m, n, azi_angles, pol_angles)  # Ramamoorthi normalisation
-                if self.hemi:
-                    y_mn = y_mn.real * 2.0
-                # Create xr.DataArray
-                y_mn = xr.DataArray(y_mn, [self.pza, self.paz])
-                # Compute the integrand
-                inner_integrand = y_mn * self.xd_uu * sin_pol_angles
-                # Compute the coefficients by integration by various methods
-                if method == 'sum':  # Integrate by simple summation
-                    # First integrate over the propagation zenith angle using summation
-                    outer_integrand = inner_integrand.sum(dim='pza') * pol_ang_delta
-                    # Then integrate over propagation azimuth
-                    sph_harm_coeff[n][m] = outer_integrand.sum(dim='paz') * azi_ang_delta
-                elif method == 'trapz':  # Integrate using the trapezoidal rule (seems best)
-                    outer_integrand = (inner_integrand.isel(pza=0) +
-                                            2.0 * inner_integrand.isel(pza=slice(1, -1)).sum(dim='pza') +
-                                       inner_integrand.isel(pza=-1)) * pol_ang_delta / 2.0
-                    # Then integrate over the propagation azimuth angle
-                    sph_harm_coeff[n][m] = (outer_integrand.isel(paz=0) +
-                                              2.0 * outer_integrand.isel(paz=slice(1, -1)).sum(dim='paz') +
-                                            outer_integrand.isel(paz=-1)) * azi_ang_delta / 2.0
-                elif method == 'simpson':  # The following is integration by Simpsons rule
-                    outer_integrand = (inner_integrand.isel(pza=0) +
-                                            4.0 * inner_integrand.isel(pza=slice(1, -1, 2)).sum(dim='pza') +
-                                            2.0 * inner_integrand.isel(pza=slice(2, -2, 2)).sum(dim='pza') +
-                                       inner_integrand.isel(pza=-1)) * pol_ang_delta / 3.0
-                    # Then integrate over the propagation azimuth angle
-                    sph_harm_coeff[n][m] = (outer_integrand.isel(paz=0) +
-                                              4.0 * outer_integrand.isel(paz=slice(1, -1, 2)).sum(dim='paz') +
-                                              2.0 * outer_integrand.isel(paz=slice(2, -2, 2)).sum(dim='paz') +
-                                            outer_integrand.isel(paz=-1)) * azi_ang_delta / 3.0
-                else:
-                    warnings.warn('Unknown integration method ' + method + ' encountered in sph_harm_fit.')
+                coeff_nm = coeff[n**2 + n + m, ...]
+                if not self.hemi:
+                    coeff_nm = coeff_nm + 1j * coeff[n**2 + n - m, ...] if m > 0 else coeff_nm + 0j
+                sph_harm_coeff[n].append(xr.DataArray(coeff_nm, other_coords))
         self.sph_harm_coeff = sph_harm_coeff
         return sph_harm_coeff
 
+    def sph_harm_eval(self, directions, degree=None, wavelengths=None, levels=None, stokes=0):
+        """ Reconstruct the radiance of the REM at arbitrary sightlines (propagation directions) from the spherical
+        harmonic coefficients computed by `RadEnv.sph_harm_fit`. All sightlines are evaluated together.
+
+        :param directions: Numpy array of shape (..., 2) providing the propagation zenith angle `pza` and propagation
+            azimuth angle `paz` in radians for each sightline in the last dimension.
+        :param degree: Maximum degree of spherical harmonics to use in the reconstruction. Default is None, which
+            uses all the fitted coefficients. Must not exceed the degree of the fit.
+        :param wavelengths: Spectral axis values at which to evaluate, broadcastable against the sightlines. The
+            coefficients are interpolated linearly. Default is None, in which case all spectral samples are
+            returned as a trailing dimension.
+        :param levels: Level values (of the `levels_out_type` axis) at which to evaluate, broadcastable against the
+            sightlines. Default is None, in which case all levels are returned as a trailing dimension.
+        :param stokes: Index of the Stokes parameter to return (default 0). If None, all Stokes parameters are
+            returned as a trailing dimension.
+        :return: Numpy array having the broadcast shape of the sightlines, wavelengths and levels, followed by any
+            retained axes of the coefficients (in their original order).
+        """
+        if not hasattr(self, 'xd_sph_harm_coeff'):
+            raise ValueError('Spherical harmonic coefficients not available. Run RadEnv.sph_harm_fit first.')
+        xd_coeff = self.xd_sph_harm_coeff
+        if degree is None:
+            degree = xd_coeff.attrs['degree']
+        elif degree > xd_coeff.attrs['degree']:
+            raise ValueError('Degree of reconstruction exceeds the degree of the spherical harmonic fit.')
+        xd_coeff = xd_coeff.isel(shc=slice(0, (degree + 1)**2))
+        if stokes is not None and 'stokes' in xd_coeff.dims:
+            xd_coeff = xd_coeff.isel(stokes=stokes)
+        directions = np.asarray(directions, dtype=np.float64)
+        shn, shm, basis = real_sph_harm_basis(degree, directions[..., 0], directions[..., 1])
+        axis_weights = []
+        for axis in xd_coeff.dims:
+            if axis in ['wvl', 'wvn'] and wavelengths is not None:
+                axis_weights.append(axis_interp_weights(xd_coeff[axis].data, wavelengths))
+            elif axis == self.levels_out_type and levels is not None:
+                axis_weights.append(axis_interp_weights(xd_coeff[axis].data, levels))
+            else:
+                axis_weights.append(None)
+        if all([table is None for table in axis_weights]):
+            return np.tensordot(basis, xd_coeff.data, axes=(0, 0))
+        # Interpolate the coefficients to each sample point, then sum over the basis functions
+        coeff = gather_multilinear(xd_coeff.data, axis_weights)
+        n_kept = len([table for table in axis_weights if table is None]) - 1  # Retained axes other than shc
+        basis = np.moveaxis(basis, 0, -1)  # Basis functions last, to line up with the interpolated coefficients
+        basis = basis.reshape(basis.shape + (1,) * n_kept)
+        return (coeff * basis).sum(axis=-(n_kept + 1))
+
+    def sph_harm_error(self, degree=None):
+        """ Report the error of the spherical harmonic representation of the REM, by reconstructing the radiance on
+        the REM sightline grid and comparing with the radiance `xd_uu`. Errors are computed over all sightlines of
+        the grid with equal weight (no solid angle weighting).
+
+        :param degree: Maximum degree of spherical harmonics to use in the reconstruction. Default is None, which
+            uses all the fitted coefficients.
+        :return: Dictionary with the following entries:
+            'rms_error' : xr.DataArray of RMS error over all sightlines for each wavelength, level and Stokes parameter.
+            'max_abs_error' : xr.DataArray of maximum absolute error over all sightlines.
+            'rel_rms_error' : xr.DataArray of RMS error relative to the RMS radiance.
+            'compression_ratio' : Ratio of the number of REM sightlines to the number of coefficients.
+        """
+        if not hasattr(self, 'xd_sph_harm_coeff'):
+            raise ValueError('Spherical harmonic coefficients not available. Run RadEnv.sph_harm_fit first.')
+        if degree is None:
+            degree = self.xd_sph_harm_coeff.attrs['degree']
+        directions = np.stack(np.meshgrid(self.pza.data, self.paz.data, indexing='ij'), axis=-1)
+        other_dims = [dim for dim in self.xd_uu.dims if dim not in ['pza', 'paz']]
+        xd_uu = self.xd_uu.transpose(*(['pza', 'paz'] + other_dims))
+        uu_sph_harm = self.sph_harm_eval(directions, degree=degree, stokes=None)
+        error = uu_sph_harm - xd_uu.data
+        other_coords = [xd_uu[dim] for dim in other_dims]
+        rms_error = np.sqrt(np.mean(error**2, axis=(0, 1)))
+        rms_uu = np.sqrt(np.mean(xd_uu.data**2, axis=(0, 1)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rel_rms_error = rms_error / rms_uu
+        return {'rms_error': xr.DataArray(rms_error, other_coords),
+                'max_abs_error': xr.DataArray(np.max(np.abs(error), axis=(0, 1)), other_coords),
+                'rel_rms_error': xr.DataArray(rel_rms_error, other_coords),
+                'compression_ratio': float(directions[..., 0].size) / (degree + 1)**2}
+
+    def _spectral_dim(self, xd_quantity):
+        """ Return the name of the spectral dimension (wvl, wvn or chn) of a REM quantity.
+
+        :param xd_quantity: xr.DataArray
+        :return: Name of the spectral dimension.
+        """
+        for dim in ['wvl', 'wvn', 'chn']:
+            if dim in xd_quantity.dims:
+                return dim
+        raise ValueError('No spectral dimension (wvl, wvn or chn) found in ' + str(xd_quantity.name) + '.')
+
+    def compress_spectral(self, n_components=None, tol=1.0e-3, quantity='uu', drop=False):
+        """ Compress a REM quantity along the spectral axis using a truncated principal component (PCA/SVD) basis.
+
+        The principal components are computed from the spectra of all sightlines, levels and Stokes parameters (and
+        hyper axes for a HyperRadEnv). The component scores are stored in float32, replacing the spectral axis with a
+        principal component axis `pc`, in the attribute `xd_<quantity>_pc`. The basis (pc, spectral) and mean
+        spectrum are stored in `xd_<quantity>_pc_basis` and `xd_<quantity>_pc_mean`. Compression is by a factor of
+        about twice the number of spectral samples divided by the number of components.
+
+        The spectra are processed one slice of the leading dimension at a time, so that no copy of the full quantity
+        is made.
+
+        :param n_components: Number of principal components to retain. If None (default), the smallest number
+            of components meeting the tolerance `tol` is used.
+        :param tol: Tolerance for the RMS error of the compressed quantity relative to the RMS of the quantity. Used
+            only if `n_components` is None. Default 0.001.
+        :param quantity: Name of the REM quantity to compress, e.g. 'uu' or 'path_radiance'. Default 'uu'.
+        :param drop: If True, the uncompressed quantity is deleted to release memory. The quantity can be restored
+            using `RadEnv.reconstruct_spectral`. Default False.
+        :return: Dictionary with the number of components ('n_components'), the achieved RMS error ('rms_error'),
+            relative RMS error ('rel_rms_error'), maximum absolute error ('max_abs_error') and the
+            compression ratio ('compression_ratio'). These are also stored as attributes of `xd_<quantity>_pc`.
+        """
+        if not hasattr(self, 'xd_' + quantity):
+            raise ValueError('RadEnv does not have quantity xd_' + quantity + '. Has the RadEnv been run?')
+        xd_quantity = getattr(self, 'xd_' + quantity)
+        spectral_dim = self._spectral_dim(xd_quantity)
+        spectral_axis = xd_quantity.get_axis_num(spectral_dim)
+        if spectral_axis == 0:  # Slices are taken along the leading axis, so process with the spectral axis last
+            xd_quantity = xd_quantity.transpose(*(list(xd_quantity.dims[1:]) + [spectral_dim]))
+            spectral_axis = xd_quantity.ndim - 1
+        data = xd_quantity.data
+        n_spectral = data.shape[spectral_axis]
+
+        def spectra(i_slice):
+            return np.moveaxis(data[i_slice], spectral_axis - 1, -1).reshape((-1, n_spectral))
+
+        # Accumulate the sum and Gram matrix of the spectra
+        n_spectra = 0
+        spectral_sum = np.zeros(n_spectral)
+        gram = np.zeros((n_spectral, n_spectral))
+        for i_slice in range(data.shape[0]):
+            block = spectra(i_slice)
+            n_spectra += block.shape[0]
+            spectral_sum += block.sum(axis=0)
+            gram += np.dot(block.T, block)
+        mean = spectral_sum / n_spectra
+        covariance = gram - n_spectra * np.outer(mean, mean)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        eigenvalues, eigenvectors = np.maximum(eigenvalues[::-1], 0.0), eigenvectors[:, ::-1]  # Descending
+        total_energy = np.trace(gram)
+        if n_components is None:
+            residual_energy = np.append(np.cumsum(eigenvalues[::-1])[::-1], 0.0)  # residual_energy[k] with k retained
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rel_error = np.sqrt(residual_energy / total_energy)
+            n_components = max(int(np.nonzero(rel_error <= tol)[0][0]) if np.any(rel_error <= tol) else n_spectral, 1)
+        n_components = min(n_components, n_spectral)
+        basis = eigenvectors[:, :n_components]
+        # Compute the scores and the achieved error
+        scores_shape = list(data.shape)
+        scores_shape[spectral_axis] = n_components
+        scores = np.empty(scores_shape, dtype=np.float32)
+        sum_sq_error = 0.0
+        max_abs_error = 0.0
+        for i_slice in range(data.shape[0]):
+            block = spectra(i_slice)
+            block_scores = np.dot(block - mean, basis).astype(np.float32)
+            error = np.dot(block_scores, basis.T) + mean - block
+            sum_sq_error += np.sum(error**2)
+            max_abs_error = max(max_abs_error, np.max(np.abs(error)))
+            slice_shape = list(data.shape[1:])
+            del slice_shape[spectral_axis - 1]
+            scores[i_slice] = np.moveaxis(block_scores.reshape(slice_shape + [n_components]), -1, spectral_axis - 1)
+        rms_error = np.sqrt(sum_sq_error / (n_spectra * n_spectral))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rel_rms_error = np.sqrt(sum_sq_error / total_energy)
+        compression_ratio = (data.size * data.itemsize) / float(scores.nbytes + basis.nbytes + mean.nbytes)
+        report = {'n_components': n_components, 'rms_error': rms_error, 'rel_rms_error': rel_rms_error,
+                  'max_abs_error': max_abs_error, 'compression_ratio': compression_ratio}
+        coords = [xd_quantity[dim] if dim != spectral_dim else ('pc', np.arange(n_components))
+                  for dim in xd_quantity.dims]
+        attrs = dict(xd_quantity.attrs)
+        attrs.update(report)
+        setattr(self, 'xd_' + quantity + '_pc', xr.DataArray(scores, coords, name=xd_quantity.name, attrs=attrs))
+        setattr(self, 'xd_' + quantity + '_pc_basis',
+                xr.DataArray(basis.T, [('pc', np.arange(n_components)), xd_quantity[spectral_dim]], name='pc_basis'))
+        setattr(self, 'xd_' + quantity + '_pc_mean',
+                xr.DataArray(mean, [xd_quantity[spectral_dim]], name=xd_quantity.name, attrs=xd_quantity.attrs))
+        if drop:
+            delattr(self, 'xd_' + quantity)
+            if quantity == 'uu':
+                self.uu = np.array([])
+        return report
+
+    def reconstruct_spectral(self, quantity='uu', restore=False):
+        """ Reconstruct a REM quantity compressed using `RadEnv.compress_spectral`.
+
+        :param quantity: Name of the REM quantity, e.g. 'uu' or 'path_radiance'. Default 'uu'.
+        :param restore: If True, the reconstructed quantity is stored as the `xd_<quantity>` attribute. Default False.
+        :return: xr.DataArray of the reconstructed quantity, with the spectral axis in place of the `pc` axis.
+        """
+        if not hasattr(self, 'xd_' + quantity + '_pc'):
+            raise ValueError('RadEnv quantity xd_' + quantity + ' has not been compressed. Run compress_spectral.')
+        xd_scores = getattr(self, 'xd_' + quantity + '_pc')
+        xd_basis = getattr(self, 'xd_' + quantity + '_pc_basis')
+        xd_mean = getattr(self, 'xd_' + quantity + '_pc_mean')
+        spectral_dim = xd_mean.dims[0]
+        pc_axis = xd_scores.get_axis_num('pc')
+        data = np.moveaxis(np.tensordot(xd_scores.data, xd_basis.data, axes=(pc_axis, 0)), -1, pc_axis)
+        data += xd_mean.data.reshape((-1,) + (1,) * (xd_scores.ndim - pc_axis - 1))
+        coords = [xd_scores[dim] if dim != 'pc' else xd_mean[spectral_dim] for dim in xd_scores.dims]
+        attrs = dict((key, value) for key, value in xd_scores.attrs.items()
+                     if key not in ['n_components', 'rms_error', 'rel_rms_error', 'max_abs_error', 'compression_ratio'])
+        xd_quantity = xr.DataArray(data, coords, name=xd_scores.name, attrs=attrs)
+        if restore:
+            setattr(self, 'xd_' + quantity, xd_quantity)
+            if quantity == 'uu':
+                self.uu = data
+        return xd_quantity
+
+    def project_srf(self, xd_srf, quantity='uu', normalise=False):
+        """ Compute the band-integrated REM quantity for a set of spectral response functions (SRFs), directly from
+        the principal component representation (see `RadEnv.compress_spectral`) if available, or otherwise from the
+        full spectral quantity.
+
+        The projection weights are those of `radute.srf_projection_matrix`, i.e. the SRFs linearly interpolated onto
+        the REM wavelengths (zero outside the SRF wavelength range) with trapezoidal integration weights. Without a
+        principal component representation, this is `radute.project_onto_srf`. With a principal component
+        representation, the SRFs are first projected onto the basis, so that the cost per spectrum is proportional to
+        the number of components rather than the number of wavelengths.
+
+        :param xd_srf: xr.DataArray of SRFs with dimensions `wvl` (in the same units as the REM) and `chn`, such as
+            returned by `radute.Flt.flt_as_xd_harmonised`. A single SRF without a `chn` dimension is also accepted.
+        :param quantity: Name of the REM quantity, e.g. 'uu' or 'path_radiance'. Default 'uu'.
+        :param normalise: If True, the band-integrated quantity is divided by the integral of each SRF, giving the
+            SRF-weighted mean spectral quantity. An SRF that does not overlap the REM wavelengths then gives zero.
+            Default False.
+        :return: xr.DataArray of the band quantity with the spectral axis replaced by the `chn` axis.
+        """
+        from morticia.rad import radute
+        if not hasattr(self, 'xd_' + quantity + '_pc'):
+            if not hasattr(self, 'xd_' + quantity):
+                raise ValueError('RadEnv does not have quantity xd_' + quantity + '. Has the RadEnv been run?')
+            return radute.project_onto_srf(getattr(self, 'xd_' + quantity), xd_srf, normalise=normalise)
+        if 'chn' not in xd_srf.dims:
+            xd_srf = xd_srf.expand_dims('chn')
+        xd_mean = getattr(self, 'xd_' + quantity + '_pc_mean')
+        xd_scores = getattr(self, 'xd_' + quantity + '_pc')
+        xd_basis = getattr(self, 'xd_' + quantity + '_pc_basis')
+        weights = radute.srf_projection_matrix(xd_srf, xd_mean['wvl'].data, normalise=normalise).T.toarray()
+        pc_axis = xd_scores.get_axis_num('pc')
+        band = np.moveaxis(np.tensordot(xd_scores.data, np.dot(xd_basis.data, weights), axes=(pc_axis, 0)), -1,
+                           pc_axis)
+        band += np.dot(xd_mean.data, weights).reshape((-1,) + (1,) * (xd_scores.ndim - pc_axis - 1))
+        coords = [xd_srf['chn'] if dim == 'pc' else xd_scores[dim] for dim in xd_scores.dims]
+        name, attrs = xd_mean.name, dict(xd_mean.attrs)
+        if not normalise:
+            name, attrs = radute._band_integrated_attrs(xd_mean, xd_srf)
+        return xr.DataArray(band, coords, name=name, attrs=attrs)
+
     def sph_harm_fat(self, degree):
         """ This code was used for debugging purposes - ignore
         :param degree:
@@ -2304,7 +3183,7 @@ class RadEnv(object):
         self.sph_harm_coeff_cos = sph_harm_coeff_cos
         return sph_harm_coeff_cos, sph_harm_coeff_sin
 
-    def compute_path_transmittance(self):
+    def compute_path_transmittance(self, level_pairs=False):
         """ Compute path transmittances from the set of libRadtran/uvspec runs executed for solar zenith angles
         of 0 to near 90 degrees.
 
@@ -2312,56 +3191,129 @@ class RadEnv(object):
         upward and downward. Paths that lie in the horizontal "blind zone" are assigned OD of 0.0. These should
         actually be assigned OD of np.nan or perhaps np.inf.
 
+        The optical depth from each level to TOA is the cumulative sum (from the top) of the layer optical depths.
+        Optical depths between levels are therefore obtained by differencing the optical depths to TOA along the
+        level axis. Paths towards the level below are obtained from the paths towards the level above of the lower
+        level by reversing the propagation zenith angle axis.
+
         .. seealso::
             RadEnv.setup_trans_cases()
 
+        :param level_pairs: Boolean. If set True, the optical depth and transmittance between every pair of
+            levels are also computed and stored in the attributes `xd_opt_depth_pairs` and `xd_trans_pairs`. These
+            have an additional trailing level axis (e.g. `zout_to`) giving the level to which the path extends. Paths
+            which are not possible for the propagation direction (e.g. upward propagation to a lower level) are
+            assigned np.nan. Default is False.
         :return: None
         """
-        # Run through all the cases in the self.trans_cases and compile the direct solar irradiance data
-        # This is actually transmittance data (edir is not a flux/irradiance with output_quantity reflectivity)
-        for trans_case in self.trans_cases:
-            # Add a propagation zenith angle for each sza. The pza is pi - sza (in radians)
-            trans_case.xd_edir = trans_case.xd_edir.assign_coords(pza=np.deg2rad(trans_case.sza))
-        # Concatenate results from all transmission runs
-        self.xd_edir_trans = xr.concat([this_case.xd_edir for this_case in self.trans_cases], dim='pza')
-        # Interpolate transmission results onto the pza grid for the RadEnv
-        # This is not a "harmonisation" interpolation. The transmission grid is being interpolated
-        # onto another grid in pza (propagation zenith angle)
-        # TODO : Check out reliability of using quadratic/cubic interpolation for transmittance
-        self.xd_trans_toa = xd_interp_axis_to(self.xd_edir_trans, self.xd_uu, axis='pza', interp_method='linear',
-                                              fill_value=1.0, assume_sorted=False)
-        self.xd_opt_depth = -np.log(self.xd_trans_toa)  # Compute the optical depths from a level to TOA
-        # Subtract the optical depth of the level above it.
-        # This provides the optical depth from any level to the level above it
-        xd_opt_depth = -self.xd_opt_depth.diff(self.levels_out_type, label='lower')
-        #  TODO : Set long_name and units of optical depth
-        # xd_opt_depth.attrs['long_name'] = long_name['od']
-        # Implicitly, the optical depth from the top level is known to TOA so concat those values
-        levels_axis_num = xd_opt_depth.get_axis_num(self.levels_out_type)
+        if getattr(self, 'trans_mode', 'sza') == 'verbose':
+            self.xd_trans_toa = self._verbose_trans_toa()
+        else:
+            # Run through all the cases in the self.trans_cases and compile the direct solar irradiance data
+            # This is actually transmittance data (edir is not a flux/irradiance with output_quantity reflectivity)
+            for trans_case in self.trans_cases:
+                # Add a propagation zenith angle for each sza. The pza is pi - sza (in radians)
+                trans_case.xd_edir = trans_case.xd_edir.assign_coords(pza=np.deg2rad(trans_case.sza))
+            xd_edir_list = [this_case.xd_edir for this_case in self.trans_cases]
+            # Concatenate results from all transmission runs
+            self.xd_edir_trans = xr.concat(xd_edir_list, dim='pza')
+            # Interpolate transmission results onto the pza grid for the RadEnv
+            # This is not a "harmonisation" interpolation. The transmission grid is being interpolated
+            # onto another grid in pza (propagation zenith angle)
+            # TODO : Check out reliability of using quadratic/cubic interpolation for transmittance
+            self.xd_trans_toa = xd_interp_axis_to(self.xd_edir_trans, self.xd_uu, axis='pza',
+                                                  interp_method='linear', fill_value=1.0, assume_sorted=False)
+        xd_opt_depth_toa = -np.log(self.xd_trans_toa)  # Compute the optical depths from a level to TOA
         levels_out_type = self.levels_out_type  # just to shorten it
-        self.xd_opt_depth = xr.concat((xd_opt_depth, self.xd_opt_depth[{levels_out_type: -1}]),
-                                        dim=levels_out_type)
+        levels_axis_num = xd_opt_depth_toa.get_axis_num(levels_out_type)
+        pza_axis_num = xd_opt_depth_toa.get_axis_num('pza')
+        opt_depth_toa = xd_opt_depth_toa.data
+        # Subtract the optical depth of the level above it. This provides the optical depth from any level to the
+        # level above it. Implicitly, the optical depth from the top level is known to TOA.
+        opt_depth = opt_depth_toa - _shift_along_axis(opt_depth_toa, -1, levels_axis_num)
         # Now confront the problem of computing optical depths to the level below
         # For the lowest level, the optical depths to the level below are undefined, perhaps an appropriate
         # value is np.nan. Otherwise, the optical depth looking to the next lower level is found by
-        # flipping the OD data from the lower level along the pza axis and summing to upper level
-        for ilevel in range(self.n_levels_out-1, 0, -1):  # Start at the top and work down
-            # Create a copy of the optical depths from the level beneath ilevel
-            opt_depth_from_beneath = copy.deepcopy(self.xd_opt_depth[{levels_out_type: ilevel-1}])
-            # Flip optical depth along the pza axis
-            opt_depth_from_beneath.data = opt_depth_from_beneath[{'pza': slice(None, None, -1)}].data
-            self.xd_opt_depth[{levels_out_type: ilevel}] += opt_depth_from_beneath
-            # Replace optical depths of zero with nan
-            # self.xd_opt_depth[{levels_out_type: ilevel}]
+        # flipping the OD data from the lower level along the pza axis and adding to the upper level
+        flip_pza = [slice(None)] * opt_depth.ndim
+        flip_pza[pza_axis_num] = slice(None, None, -1)
+        opt_depth = opt_depth + _shift_along_axis(opt_depth[tuple(flip_pza)], 1, levels_axis_num)
+        #  TODO : Set long_name and units of optical depth
+        self.xd_opt_depth = xr.DataArray(opt_depth, [xd_opt_depth_toa[dim] for dim in xd_opt_depth_toa.dims])
         # Now compute the transmittance between levels as np.exp(optical_depth)
         self.xd_trans = np.exp(-self.xd_opt_depth)
         # TODO : Put in correct long_name and and units (unitless actually)
+        if level_pairs:
+            # Put the levels axis last and compute differences of optical depth to TOA between all pairs of levels
+            other_dims = [dim for dim in xd_opt_depth_toa.dims if dim != levels_out_type]
+            xd_opt_depth_toa = xd_opt_depth_toa.transpose(*(other_dims + [levels_out_type]))
+            opt_depth_toa = xd_opt_depth_toa.data
+            pza_axis_num = xd_opt_depth_toa.get_axis_num('pza')
+            flip_pza = [slice(None)] * opt_depth_toa.ndim
+            flip_pza[pza_axis_num] = slice(None, None, -1)
+            opt_depth_toa_flip = opt_depth_toa[tuple(flip_pza)]
+            upward = opt_depth_toa[..., :, np.newaxis] - opt_depth_toa[..., np.newaxis, :]
+            downward = opt_depth_toa_flip[..., np.newaxis, :] - opt_depth_toa_flip[..., :, np.newaxis]
+            n_levels = opt_depth_toa.shape[-1]
+            i_from, i_to = np.meshgrid(np.arange(n_levels), np.arange(n_levels), indexing='ij')
+            pza_shape = [1] * (opt_depth_toa.ndim + 1)
+            pza_shape[pza_axis_num] = -1
+            pza_up = (xd_opt_depth_toa['pza'].data < np.pi/2).reshape(pza_shape)
+            opt_depth_pairs = np.where(pza_up, np.where(i_to >= i_from, upward, np.nan),
+                                       np.where(i_to <= i_from, downward, np.nan))
+            coords = [xd_opt_depth_toa[dim] for dim in xd_opt_depth_toa.dims]
+            coords.append((levels_out_type + '_to', xd_opt_depth_toa[levels_out_type].data))
+            self.xd_opt_depth_pairs = xr.DataArray(opt_depth_pairs, coords)
+            self.xd_trans_pairs = np.exp(-self.xd_opt_depth_pairs)
         # Now run through the cases in the cloud detection sequence to find layers affected by clouds
         if self.has_clouds:
             for librad_case in self.cloud_detect_cases:
                 pass  #  TODO : Cloud detection
 
 
+    def _verbose_trans_toa(self):
+        """ Compute the transmittance from every REM level to TOA for all sightlines from the layer optical thickness
+        profile read from the verbose output of the transmittance case. Plane parallel geometry is assumed, so that
+        the slant optical depth is the vertical optical depth divided by the cosine of the propagation zenith angle.
+
+        :return: xr.DataArray of transmittance to TOA with dimensions of propagation zenith angle, spectral axis
+            and level. Sightlines propagating downwards (pza > pi/2) are assigned a transmittance of 1.0.
+        """
+        trans_case = self.trans_cases[0]
+        if trans_case.mol_abs_param != 'crs':
+            raise ValueError('Verbose transmittance mode requires monochromatic calculations (mol_abs_param crs).')
+        if not hasattr(trans_case, 'xd_optprop_od'):
+            raise ValueError('No optical property profiles available from the verbose transmittance case.')
+        xd_od = trans_case.xd_optprop_od
+        # Cumulative optical depth from TOA at the layer boundaries, in order of increasing altitude
+        z_top = xd_od['zout_sea'].data
+        i_sort = np.argsort(z_top)[::-1]  # Layers from the top down
+        layer_od = xd_od.data[:, i_sort]
+        z_boundary = np.append(z_top[i_sort], np.atleast_1d(trans_case.altitude)[0])[::-1]
+        od_boundary = np.hstack((np.zeros((layer_od.shape[0], 1)), np.cumsum(layer_od, axis=1)))[:, ::-1]
+        # Altitudes of the REM levels above sea level
+        levels_out_type = self.levels_out_type
+        if levels_out_type == 'zout':
+            z_levels = self.xd_uu[levels_out_type].data + np.atleast_1d(trans_case.altitude)[0]
+        elif levels_out_type == 'zout_sea':
+            z_levels = self.xd_uu[levels_out_type].data
+        else:
+            raise ValueError('Verbose transmittance mode requires zout or zout_sea output levels.')
+        od_levels = np.array([np.interp(z_levels, z_boundary, od_wvl) for od_wvl in od_boundary])
+        # Map onto the spectral axis of the REM
+        spectral_axis = [dim for dim in self.xd_uu.dims if dim not in ['pza', 'paz', levels_out_type, 'stokes']][0]
+        if spectral_axis == 'wvl':
+            spectral_values = self.xd_uu['wvl'].data
+            od_levels = np.array([np.interp(spectral_values, xd_od['wvl'].data, od_level)
+                                  for od_level in od_levels.T]).T
+        elif od_levels.shape[0] != self.xd_uu[spectral_axis].size:
+            raise ValueError('Number of verbose optical property tables does not match the REM spectral axis.')
+        pza = self.xd_uu['pza'].data
+        with np.errstate(divide='ignore', over='ignore'):
+            slant_od = od_levels[np.newaxis, :, :] / np.cos(pza)[:, np.newaxis, np.newaxis]
+        trans_toa = np.where((pza < np.pi/2)[:, np.newaxis, np.newaxis], np.exp(-slant_od), 1.0)
+        return xr.DataArray(trans_toa, [self.xd_uu['pza'], self.xd_uu[spectral_axis], self.xd_uu[levels_out_type]])
+
     def compute_path_length(self):
         """ Compute the path segment lengths between all altitudes in the REM.
         The path length computation is currently based on plane parallel geometry. It is computed
@@ -2393,34 +3345,77 @@ class RadEnv(object):
 
         :return: None
         """
+        # If the REM is azimuthally symmetric, compute for a single azimuth and broadcast along the azimuth axis
+        azi_symmetric = getattr(self, 'azi_symmetric', False)
+        xd_uu = self.xd_uu.isel(paz=slice(0, 1)) if azi_symmetric else self.xd_uu
         # First compute the product of radiance and transmittance at every level
-        self.xd_uu_times_tau = self.xd_trans * self.xd_uu
-        # The upper and lower hemispheres of the path radiance REMs have to be computed separately as shown in
-        # the docstring equations. Typical up/downwelling indexing is xd_uu[xd_uu['pza'] < np.pi/2].
-        # Run through the levels first from bottom level to top, computing the downwelling path radiance
-        # to the level above.
-        # Initialise path radiance to something having same units etc.
-        self.xd_path_radiance = copy.deepcopy(self.xd_uu)  # Initialise to total radiance
-        for ilevel in range(0, self.n_levels_out - 1):
-            # Set up hemispherical indexing for this level
-            hemi_index_level = {self.levels_out_type: ilevel, 'pza': self.xd_path_radiance['pza'] > np.pi/2}
-            # Setup hemisperhical indexing for next level up
-            hemi_index_above = {self.levels_out_type: ilevel + 1, 'pza': self.xd_path_radiance['pza'] > np.pi/2}
-            self.xd_path_radiance[hemi_index_level] = (self.xd_uu[hemi_index_level] -
-                                                       self.xd_uu_times_tau[hemi_index_above])
-        # Now run from top level down to bottom, computing upwelling path radiance
-        for ilevel in range(self.n_levels_out - 1, 1, -1):
-            # Set up hemispherical indexing for this level
-            hemi_index_level = {self.levels_out_type: ilevel, 'pza': self.xd_path_radiance['pza'] < np.pi/2}
-            # Setup hemisperhical indexing for next level down
-            hemi_index_below = {self.levels_out_type: ilevel - 1, 'pza': self.xd_path_radiance['pza'] < np.pi/2}
-            self.xd_path_radiance[hemi_index_level] = (self.xd_uu[hemi_index_level] -
-                                                       self.xd_uu_times_tau[hemi_index_below])
-
-
+        xd_uu_times_tau = (self.xd_trans * xd_uu).transpose(*self.xd_uu.dims)
+        # The upper and lower hemispheres of the path radiance REMs are computed as shown in the docstring
+        # equations. The downwelling hemisphere (pza > pi/2) subtracts the attenuated radiance from the level above,
+        # while the upwelling hemisphere (pza < pi/2) subtracts the attenuated radiance from the level below.
+        levels_axis_num = self.xd_uu.get_axis_num(self.levels_out_type)
+        uu_times_tau = xd_uu_times_tau.data
+        pza_shape = [1] * uu_times_tau.ndim
+        pza_shape[self.xd_uu.get_axis_num('pza')] = -1
+        pza_down = (self.xd_uu['pza'].data > np.pi/2).reshape(pza_shape)
+        uu_times_tau_adjacent = np.where(pza_down, _shift_along_axis(uu_times_tau, -1, levels_axis_num),
+                                         _shift_along_axis(uu_times_tau, 1, levels_axis_num))
+        path_radiance = xd_uu.data - uu_times_tau_adjacent
+        if azi_symmetric:
+            uu_times_tau = np.broadcast_to(uu_times_tau, self.xd_uu.shape)
+            path_radiance = np.broadcast_to(path_radiance, self.xd_uu.shape)
+        coords = [self.xd_uu[dim] for dim in self.xd_uu.dims]
+        self.xd_uu_times_tau = xr.DataArray(uu_times_tau, coords, name=self.xd_uu.name)
+        # Path radiance has the same coordinates and attributes as total radiance
+        self.xd_path_radiance = xr.DataArray(path_radiance, coords, name=self.xd_uu.name, attrs=self.xd_uu.attrs)
+
+    def _uniform_uu(self):
+        """ Return the Stokes I radiance of the REM on uniform polar and azimuth grids. If the REM has been
+        adaptively refined (see RadEnv.refine), it is linearly resampled to uniform grids having the same number of
+        samples, otherwise the radiance data is returned without copying.
+
+        :return: Numpy array with dimensions (pza, paz, spectral, levels).
+        """
+        pza, paz = self.pza.data, self.paz.data
+        if (np.allclose(np.diff(pza), pza[1] - pza[0]) and
+                (paz.size < 2 or np.allclose(np.diff(paz), paz[1] - paz[0]))):
+            return self.xd_uu[:,:,:,:,0].data  # Zero in last index is stokes I
+        uniform_pza = np.linspace(pza[0], pza[-1], pza.size)
+        uniform_paz = np.linspace(paz[0], paz[-1], paz.size)
+        directions = np.stack(np.meshgrid(uniform_pza, uniform_paz, indexing='ij'), axis=-1)
+        return self.sample(directions, stokes=0)
+
+    def envmap_image(self, i_zout=0, channels=None, dtype=np.float32, repeat_azi=1, watts=False):
+        """ Return a slice of the REM as a contiguous, pixel-interleaved lat-long environment map image, laid out as
+        for `RadEnv.write_openexr`. The zenith is in the first row. This is suitable for passing the REM to a renderer
+        in memory (see `mortsuba.Scene.add_radiant_environment_map_from_radenv`).
+
+        :param i_zout: Index of the output level. Default 0.
+        :param channels: List of spectral channel (wavelength) indices to include. Default is the first three.
+        :param dtype: Numpy data type of the image. Default np.float32.
+        :param repeat_azi: Integer. Repeat the data in the REM azimuthal direction. Default 1.
+        :param watts: Boolean. If True, radiance in units of mW are converted to W. Default False.
+        :return: Numpy array of shape (n_pza, n_paz, n_channels). If the REM is hemispherical (hemi=True), the
+            REM is reflected to cover the full azimuth range.
+        """
+        uu = self._uniform_uu()
+        if channels is None:
+            channels = range(min(3, uu.shape[2]))
+        channels = list(channels)
+        n_pza, n_paz = uu.shape[0], uu.shape[1]
+        n_paz_out = 2 * n_paz - 2 if self.hemi else n_paz
+        image = np.empty((n_pza, n_paz_out * repeat_azi, len(channels)), dtype=dtype)
+        image[:, :n_paz, :] = uu[:, :, channels, i_zout]
+        if self.hemi:
+            image[:, n_paz:n_paz_out, :] = uu[:, -2:0:-1, channels, i_zout]
+        if watts and self.xd_uu.units[0:2] == 'mW':
+            image[:, :n_paz_out, :] /= 1000.0
+        for i_repeat in range(1, repeat_azi):
+            image[:, i_repeat * n_paz_out:(i_repeat + 1) * n_paz_out, :] = image[:, :n_paz_out, :]
+        return image
 
     def write_openexr(self, filename, chan_names=None, chan_per_exr=3, normalise=False, half=False, repeat_azi=1,
-                      use_mitsuba_wvl=False):
+                      use_mitsuba_wvl=False, n_workers=1, compression=None, layered=False):
         """Write a radiant environment as an OpenEXR file or set of OpenEXR files.
 
         Use of this method requires that the OpenEXR package be installed on your platform. This can be a problem
@@ -2444,6 +3439,13 @@ class RadEnv(object):
         :param use_mitsuba_wvl: Boolean. If set True, write channels using the Mitsuba wavelength assignments i.e.
             remap wavelengths to the 360 nm to 830 nm range. Setting this flag True will also scale the radiance
             values to W/m^2/sr/nm, which are the canonical units for Mitsuba rendering in the context of MORTICIA.
+        :param n_workers: Number of threads used to write EXR files concurrently. Default 1 (serial).
+        :param compression: OpenEXR compression method, one of 'none', 'rle', 'zips', 'zip', 'piz', 'pxr24', 'b44',
+            'b44a', 'dwaa' or 'dwab' (depending on the version of OpenEXR). Other names raise a ValueError. Default
+            None, which uses the OpenEXR default.
+        :param layered: Boolean. If True, write a single multi-layer EXR file for each level, with each group of
+            `chan_per_exr` channels in a layer. Channels are then named <first>_<last>.<channel name>, where first
+            and last are the indices of the first and last channels in the layer. Default False.
 
         Notes
         -----
@@ -2454,24 +3456,30 @@ class RadEnv(object):
         EXR files with any number of channels, but it is necessary to step through the channels (using [ and ])
         and they are displayed in grayscale. Even mtsgui will clip EXR files having radiance values exceeding 1.0.
         The mrviewer application is recommended for viewing of EXR files.
+        If the REM has been adaptively refined (see RadEnv.refine), it is linearly resampled to uniform polar and
+        azimuth grids having the same number of samples before writing.
+        Each channel is converted once into a contiguous buffer of the EXR pixel type, which is passed to OpenEXR
+        without further copies where the OpenEXR bindings support this.
 
-        :return:
+        :return: List of the EXR filenames written.
         """
         import OpenEXR
         import Imath
         wvl = self.xd_uu.wvl.data  # Might not exist, but assume it does
-        n_wvl = np.float(wvl.size)  # Number of wavelengths
+        n_wvl = wvl.size  # Number of wavelengths
         wvl_units = self.xd_uu.wvl.units
         rad_units = self.xd_uu.units
         zout = self.xd_uu.zout.data  # output levels
         n_zout = zout.size  # Number of output levels
-        n_exr_files = np.int(np.ceil(n_wvl / chan_per_exr))
+        n_exr_files = int(np.ceil(float(n_wvl) / chan_per_exr))
         # Currently cannot handle polarization, stick to output of the first stokes component (I)
-        xd_uu = self.xd_uu[:,:,:,:,0].data  # Zero in last index is stokes I
-        if self.hemi:  # Need to double up by reflection left right
-            # Note that this puts azimuth
-            xd_uu = np.concatenate((xd_uu, xd_uu[:, -2:0:-1, ...]), axis=1)
-        datashape = xd_uu[:,:,0,0].shape
+        xd_uu = self._uniform_uu()
+        n_pza, n_paz = xd_uu.shape[0], xd_uu.shape[1]
+        if self.hemi:  # Need to double up by reflection left right, excluding azimuths 0 and pi from the reflection
+            n_paz_out = 2 * n_paz - 2
+        else:
+            n_paz_out = n_paz
+        width = n_paz_out * repeat_azi
         if half:  # Use 16-bit floating point values
             np_type = np.float16
             imath_type = Imath.PixelType.HALF
@@ -2479,6 +3487,9 @@ class RadEnv(object):
             np_type = np.float32
             imath_type = Imath.PixelType.FLOAT
         imath_chan = Imath.Channel(Imath.PixelType(imath_type))
+        if compression is not None:
+            imath_compression = _openexr_compression(compression)
+        rad_scale = 1.0
         # Generate channel names
         if use_mitsuba_wvl:  # Map wavelength channels to equally space channels in the 360 nmto 830 nm range
             channel_names=[]
@@ -2489,7 +3500,7 @@ class RadEnv(object):
                 channel_names.append('{:.2f}'.format(chan_start[i_chan]) + '-' + '{:.2f}'.format(chan_stop[i_chan]) +
                                      wvl_units)
             if rad_units[0:2] == 'mW':
-                xd_uu = xd_uu/1000.0  # Convert to W/m^2 ....
+                rad_scale = 1.0 / 1000.0  # Convert to W/m^2 ....
                 rad_units = rad_units[1:]
 
         else:  # Use provided channel names or default channel names
@@ -2507,48 +3518,81 @@ class RadEnv(object):
         if n_channel_names != chan_per_exr:
             warnings.warn('Number of channel names should equal number of channels per EXR file when writing'
                           '.exr files from REMs.')
-        # Run through EXR files and write them out
-        for i_zout, zout_value in enumerate(zout):
-            for i_exr in range(n_exr_files):
-                # Generate the file header
-                theheader = OpenEXR.Header(datashape[1] * repeat_azi, datashape[0])
-                # Add some metadata
-                theheader['generatedBy'] = 'morticia.rad.librad'
-                theheader['zout'] = str(zout_value)
-                theheader['zout_units'] = 'km'
-                theheader['rad_units'] = rad_units
-                theheader['wvl_units'] = wvl_units
-                theheader['wvl'] = 'np.' + repr(wvl)
-                channels = []
-                i_channels = []
-                chan_data = {}
-                chan_max = 0.0
-                for i_chan in range(i_exr * chan_per_exr, (i_exr + 1) * chan_per_exr):
-                    if i_chan > n_wvl - 1:
-                        break
-                    # Append the channel names
+        # Groups of channels written to each EXR file (or to each layer of a layered EXR file)
+        chan_groups = [list(range(i_exr * chan_per_exr, min((i_exr + 1) * chan_per_exr, n_wvl)))
+                       for i_exr in range(n_exr_files)]
+
+        def channel_buffer(i_chan, i_zout):
+            # Build the contiguous pixel buffer of a channel, with a single conversion to the EXR pixel type
+            buffer = np.empty((n_pza, width), dtype=np_type)
+            buffer[:, :n_paz] = xd_uu[:, :, i_chan, i_zout]
+            if self.hemi:
+                buffer[:, n_paz:n_paz_out] = xd_uu[:, -2:0:-1, i_chan, i_zout]
+            if rad_scale != 1.0:
+                buffer[:, :n_paz_out] *= rad_scale
+            for i_repeat in range(1, repeat_azi):
+                buffer[:, i_repeat * n_paz_out:(i_repeat + 1) * n_paz_out] = buffer[:, :n_paz_out]
+            return buffer
+
+        def write_exr(task):
+            i_zout, groups = task
+            zout_value = zout[i_zout]
+            # Generate the file header
+            theheader = OpenEXR.Header(width, n_pza)
+            # Add some metadata
+            theheader['generatedBy'] = 'morticia.rad.librad'
+            theheader['zout'] = str(zout_value)
+            theheader['zout_units'] = 'km'
+            theheader['rad_units'] = rad_units
+            theheader['wvl_units'] = wvl_units
+            theheader['wvl'] = 'np.' + repr(wvl)
+            if compression is not None:
+                theheader['compression'] = imath_compression
+            chan_data = OrderedDict()
+            i_channels = []
+            for i_group in groups:
+                group_data = OrderedDict()
+                for i_chan in chan_groups[i_group]:
                     this_channel_name = channel_names[int(np.mod(i_chan, n_channel_names))]
-                    channels.append(this_channel_name)
+                    if layered:  # Layer names identify the group of channels
+                        this_channel_name = ('{:04d}'.format(min(chan_groups[i_group])) + '_' +
+                                             '{:04d}'.format(max(chan_groups[i_group])) + '.' + this_channel_name)
+                    group_data[this_channel_name] = channel_buffer(i_chan, i_zout)
                     i_channels.append(i_chan)
-                    # Build the channel data
-                    single_chan_data = xd_uu[:,:,i_chan,i_zout].astype(np_type)
-                    if repeat_azi > 1:
-                        single_chan_data = np.tile(single_chan_data, (1, repeat_azi))
-                    if normalise:
-                        single_channel_max = np.max(single_chan_data)
-                        chan_max = max(chan_max, single_channel_max)
-                    chan_data[this_channel_name] = single_chan_data
                 if normalise:
-                    for channel_key in chan_data:
-                        chan_data[channel_key] /= chan_max
-                theheader['channels'] = dict([(c, imath_chan) for c in channels])
-                theheader['i_channels'] = str(i_channels)
-                exr_filename = filename + '{:04d}'.format(min(i_channels)) + '_' + '{:04d}'.format(max(i_channels)) + \
-                                'z' + str(zout_value) + '.exr'
-                #print exr_filename
-                exr = OpenEXR.OutputFile(exr_filename, theheader)
-                exr.writePixels(dict([this_channel, chan_data[this_channel].tostring()] for this_channel in channels))
-                exr.close()
+                    chan_max = max([np.max(buffer) for buffer in group_data.values()])
+                    for buffer in group_data.values():
+                        buffer /= chan_max
+                chan_data.update(group_data)
+            theheader['channels'] = dict([(c, imath_chan) for c in chan_data])
+            theheader['i_channels'] = str(i_channels)
+            if layered:
+                exr_filename = filename + 'z' + str(zout_value) + '.exr'
+            else:
+                exr_filename = (filename + '{:04d}'.format(min(i_channels)) + '_' + '{:04d}'.format(max(i_channels)) +
+                                'z' + str(zout_value) + '.exr')
+            exr = OpenEXR.OutputFile(exr_filename, theheader)
+            try:  # Pass the buffers without copying, if supported by the OpenEXR bindings
+                exr.writePixels(dict([(c, memoryview(buffer)) for c, buffer in chan_data.items()]))
+            except TypeError:
+                exr.writePixels(dict([(c, buffer.tobytes()) for c, buffer in chan_data.items()]))
+            exr.close()
+            return exr_filename
+
+        if layered:
+            tasks = [(i_zout, list(range(n_exr_files))) for i_zout in range(n_zout)]
+        else:
+            tasks = [(i_zout, [i_exr]) for i_zout in range(n_zout) for i_exr in range(n_exr_files)]
+        if n_workers > 1:
+            from multiprocessing.pool import ThreadPool
+            worker_pool = ThreadPool(n_workers)
+            try:
+                exr_filenames = worker_pool.map(write_exr, tasks)
+            finally:
+                worker_pool.close()
+        else:
+            exr_filenames = [write_exr(task) for task in tasks]
+        return exr_filenames
 
 
 class HyperRadEnv(RadEnv):
@@ -2564,11 +3608,22 @@ class HyperRadEnv(RadEnv):
      Other possible higher dimensions that can be added include:
      Aerosol loading as specified by visibility or optical depth
 
+     One RadEnv is created for every combination of the hyper axis values. The transmittance cases (see
+     `RadEnv.setup_trans_cases`) do not depend on some of the keywords (listed in `trans_independent_keywords`),
+     so these cases are run only once for each unique combination of the remaining hyper axis values and shared
+     between the RadEnvs.
 
+     Once run, the REM and path quantities are available with the hyper axes as the leading dimensions (in the order
+     of the `hyper_names` attribute) and may be interpolated to arbitrary hyper axis values using `interp_hyper`.
 
     """
 
-    def __init__(self, base_case, n_pol, n_azi, hyper_axes, mxumu=48, mxphi=19, hemi=False, n_sza=0):
+    # libRadtran keywords that do not affect the transmittance cases
+    trans_independent_keywords = ['sza', 'phi0', 'albedo', 'sur_temperature']
+
+    def __init__(self, base_case, n_pol, n_azi, hyper_axes, mxumu=48, mxphi=19, hemi=False, n_sza=0,
+                 trans_mode='sza', batching='fixed', n_workers=1, batch_cost=(1.0, 0.01, 0.001, 0.0),
+                 azi_symmetric=None):
         """ Create a set of uvspec runs covering the whole sphere to calculate a full radiant environment map.
         Where the base_case is the uvspec case on which to base the environmental map, Name is the name to give the
         environmental map and n_pol and n_azi are the number of polar and azimuthal sightline angles to generate. The
@@ -2602,6 +3657,435 @@ class HyperRadEnv(RadEnv):
             This is the recommended mode (hemi=True) for MORTICIA purposes, since it reduces execution time.
         :param n_sza: The number of solar zenith angles (SZA) at which to perform transmittance and path radiance
             computations. Each SZA will result in another run of the base case (no radiances)
+        :param trans_mode: The manner in which the transmittance cases are run. See `RadEnv.setup_trans_cases`.
+            Default is 'sza'.
+        :param batching: Sightline batching, 'fixed' (default) or 'optimal'. See `RadEnv`.
+        :param n_workers: Number of workers available to run cases concurrently. All the RadEnvs in the
+            HyperRadEnv are run in a single map, so each RadEnv is batched for the total number of workers. Default 1.
+        :param batch_cost: Tuple of (overhead, per_umu, per_phi, per_sightline) cost coefficients. See `RadEnv`.
+        :param azi_symmetric: Boolean. If True, only azimuthally averaged radiances are computed. See `RadEnv`.
 
 
         """
+        if isinstance(hyper_axes, OrderedDict):
+            hyper_names = list(hyper_axes.keys())
+        else:
+            hyper_names = sorted(hyper_axes.keys())  # Ensure a reproducible ordering of the hyper dimensions
+        if not hyper_names:
+            raise ValueError('At least one hyper axis must be provided to HyperRadEnv.')
+        self.hyper_names = hyper_names
+        self.hyper_axes = OrderedDict([(keyword, np.unique(np.asarray(hyper_axes[keyword], dtype=np.float64)))
+                                       for keyword in hyper_names])
+        self.hyper_shape = tuple(self.hyper_axes[keyword].size for keyword in hyper_names)
+        # Create one RadEnv for every combination of hyper axis values, in C order of the hyper axes
+        # All the cases are run in a single map (see _run_mapped), so each RadEnv is batched for all the workers
+        self.radenvs = []
+        trans_groups = OrderedDict()  # Map from transmittance-dependent values to indices of RadEnvs
+        for i_hyper, hyper_values in enumerate(product(*[self.hyper_axes[keyword] for keyword in hyper_names])):
+            hyper_case = copy.deepcopy(base_case)
+            for keyword, value in zip(hyper_names, hyper_values):
+                hyper_case.alter_option([keyword, str(value)])
+            # Give each hyper case unique names and filenames
+            hyper_case.infile = hyper_case.infile[:-4] + '_h{:04d}.INP'.format(i_hyper)
+            hyper_case.outfile = hyper_case.outfile[:-4] + '_h{:04d}.OUT'.format(i_hyper)
+            hyper_case.name = hyper_case.name + '_h{:04d}'.format(i_hyper)
+            radenv = RadEnv(hyper_case, n_pol, n_azi, mxumu=mxumu, mxphi=mxphi, hemi=hemi, n_sza=0,
+                            trans_mode=trans_mode, batching=batching, n_workers=n_workers, batch_cost=batch_cost,
+                            azi_symmetric=azi_symmetric)
+            radenv.n_sza = n_sza
+            self.radenvs.append(radenv)
+            trans_key = tuple(value for keyword, value in zip(hyper_names, hyper_values)
+                              if keyword not in self.trans_independent_keywords)
+            trans_groups.setdefault(trans_key, []).append(i_hyper)
+        self.trans_groups = list(trans_groups.values())
+        # The HyperRadEnv itself only has the angular grid and case properties of the RadEnvs, but no cases. These
+        # are the same for all the RadEnvs.
+        lead_radenv = self.radenvs[0]
+        self.base_case = copy.deepcopy(base_case)
+        self.trans_base_case = copy.deepcopy(base_case)
+        for attribute in ['levels_out_type', 'n_levels_out', 'solver', 'azi_symmetric', 'mxumu', 'mxphi', 'hemi',
+                          'n_azi', 'n_pol', 'n_azi_batch', 'n_pol_batch', 'phi', 'umu', 'pza', 'paz', 'vza', 'vaz',
+                          'has_water_clouds', 'has_ice_clouds', 'has_clouds', 'trans_mode']:
+            setattr(self, attribute, getattr(lead_radenv, attribute))
+        self.n_sza = n_sza
+        self.uu = np.array([])
+        self.cases = []
+        self.casechain = []
+        # Set up the transmittance cases only once for each group and share them within the group
+        if n_sza:
+            for trans_group in self.trans_groups:
+                lead_radenv = self.radenvs[trans_group[0]]
+                lead_radenv.setup_trans_cases(n_sza=n_sza, trans_mode=trans_mode)
+                for i_hyper in trans_group[1:]:
+                    self.radenvs[i_hyper].trans_cases = lead_radenv.trans_cases
+                    self.radenvs[i_hyper].cloud_detect_cases = lead_radenv.cloud_detect_cases
+                    self.radenvs[i_hyper].trans_vza_up = lead_radenv.trans_vza_up
+            self.trans_vza_up = self.radenvs[0].trans_vza_up
+
+    def _run_mapped(self, case_mapper, purge=False):
+        """ Run all the cases of the HyperRadEnv using a mapping function and assemble the results.
+
+        All the radiance cases of all the RadEnvs are submitted in a single map, followed by a single map
+        of the deduplicated transmittance and cloud detection cases.
+
+        :param case_mapper: A function taking a list of librad.Case objects and returning the list of executed
+            cases in the same order.
+        :param purge: Boolean. If set True, the executed cases are deleted after assembly.
+        :return: None
+        """
+        all_cases = list(chain(*[radenv.casechain for radenv in self.radenvs]))
+        all_cases = case_mapper(all_cases)
+        i_start = 0
+        for radenv in self.radenvs:
+            n_cases = len(radenv.casechain)
+            radenv.casechain = list(all_cases[i_start:i_start + n_cases])
+            i_start += n_cases
+            radenv._assemble_radiance()
+        if self.n_sza:
+            lead_radenvs = [self.radenvs[trans_group[0]] for trans_group in self.trans_groups]
+            all_cases = list(chain(*[radenv.trans_cases + radenv.cloud_detect_cases for radenv in lead_radenvs]))
+            all_cases = case_mapper(all_cases)
+            i_start = 0
+            for trans_group, lead_radenv in zip(self.trans_groups, lead_radenvs):
+                n_trans = len(lead_radenv.trans_cases)
+                n_cloud = len(lead_radenv.cloud_detect_cases)
+                trans_cases = list(all_cases[i_start:i_start + n_trans])
+                cloud_detect_cases = list(all_cases[i_start + n_trans:i_start + n_trans + n_cloud])
+                i_start += n_trans + n_cloud
+                for i_hyper in trans_group:
+                    self.radenvs[i_hyper].trans_cases = trans_cases
+                    self.radenvs[i_hyper].cloud_detect_cases = cloud_detect_cases
+            for radenv in self.radenvs:
+                radenv.compute_path_transmittance()
+                radenv.compute_path_radiance()
+        self._assemble_hyper()
+        if purge:
+            for radenv in self.radenvs:
+                del radenv.casechain
+                del radenv.cases
+
+    def _assemble_hyper(self):
+        """ Stack the REM and path quantities of the individual RadEnvs into data arrays having the hyper axes as
+        leading dimensions.
+
+        :return: None
+        """
+        lead_radenv = self.radenvs[0]
+        self.fluxline = lead_radenv.fluxline
+        self.irrad_units = lead_radenv.irrad_units
+        quantities = ['uu', 'path_radiance', 'trans', 'opt_depth'] + list(self.fluxline)
+        for quantity in quantities:
+            if not hasattr(lead_radenv, 'xd_' + quantity):
+                continue
+            xd_lead = getattr(lead_radenv, 'xd_' + quantity)
+            if self.azi_symmetric and 'paz' in xd_lead.dims:
+                # Stack a single azimuth and broadcast along the azimuth axis without copying
+                hyper_data = np.stack([getattr(radenv, 'xd_' + quantity).isel(paz=slice(0, 1)).data
+                                       for radenv in self.radenvs])
+                hyper_data = hyper_data.reshape(self.hyper_shape + hyper_data.shape[1:])
+                hyper_data = np.broadcast_to(hyper_data, self.hyper_shape + xd_lead.shape)
+            else:
+                hyper_data = np.stack([getattr(radenv, 'xd_' + quantity).data for radenv in self.radenvs])
+                hyper_data = hyper_data.reshape(self.hyper_shape + xd_lead.shape)
+            coords = [(keyword, self.hyper_axes[keyword]) for keyword in self.hyper_names]
+            coords += [xd_lead[axis] for axis in xd_lead.dims]
+            xd_hyper = xr.DataArray(hyper_data, coords, name=xd_lead.name, attrs=xd_lead.attrs)
+            setattr(self, 'xd_' + quantity, xd_hyper)
+
+    def run_ipyparallel(self, ipyparallel_view, stderr_to_file=False, purge=False):
+        """ Run all the radiant environment map cases of the HyperRadEnv using `ipyparallel`.
+
+        .. seealso:: RadEnv.run_ipyparallel()
+
+        :param ipyparallel_view: an ipyparallel view of a Python engine cluster (see ipyparallel documentation.)
+        :param stderr_to_file: Not used.
+        :param purge: Boolean. If set True, the executed libRadtran cases are deleted after assembly.
+        :return:
+        """
+        self._run_mapped(lambda cases: ipyparallel_view.map(Case.run, cases), purge=purge)
+
+    def run_dask_parallel(self, dask_client, stderr_to_file=False, purge=False):
+        """ Run all the radiant environment map cases of the HyperRadEnv using `dask.distributed`.
+
+        .. seealso:: RadEnv.run_dask_parallel()
+
+        :param dask_client: dask.distributed client (see dask.distributed documentation.)
+        :param stderr_to_file: Not used.
+        :param purge: Boolean. If set True, the executed libRadtran cases are deleted after assembly.
+        :return:
+        """
+        self._run_mapped(lambda cases: dask_client.gather(dask_client.map(Case.run, cases)), purge=purge)
+
+    def interp_hyper(self, quantity='uu', fill_value=np.nan, **hyper_point):
+        """ Interpolate the HyperRadEnv look-up table to arbitrary values of the hyper axes using multilinear
+        interpolation. For example, hyper_rem.interp_hyper(sza=37.5, albedo=0.12) will return the REM radiance for
+        a solar zenith angle of 37.5 degrees and surface albedo of 0.12.
+
+        :param quantity: Name of the quantity to interpolate, being the name of an `xd_` attribute of the
+            HyperRadEnv without the `xd_` prefix. Default is 'uu' (the radiance).
+        :param fill_value: Value to assign outside the range of the hyper axes. Default is np.nan.
+        :param hyper_point: Keyword arguments giving the hyper axis values to which to interpolate. Values may be
+            scalar or numpy arrays (which will be broadcast against one another). Hyper axes not given are retained.
+        :return: xr.DataArray of the interpolated quantity. If array values are given, the sample points are
+            in the leading dimension named `hyper_point`.
+        """
+        if not hasattr(self, 'xd_' + quantity):
+            raise ValueError('HyperRadEnv does not have quantity xd_' + quantity + '. Has the HyperRadEnv been run?')
+        for keyword in hyper_point:
+            if keyword not in self.hyper_names:
+                raise ValueError('Unknown hyper axis ' + keyword + ' in HyperRadEnv.interp_hyper.')
+        xd_quantity = getattr(self, 'xd_' + quantity)
+        if not hyper_point:
+            return xd_quantity.copy()
+        point_values = np.broadcast_arrays(*[np.asarray(value, dtype=np.float64)
+                                             for value in hyper_point.values()])
+        point_shape = point_values[0].shape if point_values else ()
+        point_values = dict(zip(hyper_point.keys(), [value.ravel() for value in point_values]))
+        axis_weights = [axis_interp_weights(xd_quantity[axis].data, point_values[axis]) if axis in point_values
+                        else None for axis in xd_quantity.dims]
+        interp_data = gather_multilinear(xd_quantity.data, axis_weights, fill_value=fill_value)
+        kept_axes = [axis for axis in xd_quantity.dims if axis not in point_values]
+        coords = [xd_quantity[axis] for axis in kept_axes]
+        if point_shape == ():
+            interp_data = interp_data[0, ...]
+        else:
+            coords = [('hyper_point', np.arange(interp_data.shape[0]))] + coords
+        xd_interp = xr.DataArray(interp_data, coords, name=xd_quantity.name, attrs=xd_quantity.attrs)
+        for keyword in point_values:  # Record scalar hyper axis values as scalar coordinates
+            if point_shape == ():
+                xd_interp.coords[keyword] = point_values[keyword][0]
+        return xd_interp
+
+
+class HealpixRadEnv(RadEnv):
+    """A radiant environment map (REM) sampled at the pixel centres of a HEALPix (Hierarchical Equal Area
+    isoLatitude Pixelization) grid. This class inherits from RadEnv.
+
+    The regular polar/azimuth grid of a RadEnv oversamples the poles heavily. HEALPix pixels have equal solid angle,
+    so a HEALPix REM achieves the same angular resolution with fewer sightlines (uvspec runs). The HEALPix pixels
+    lie on rings of constant polar angle and many rings share the same set of azimuth angles. The rings are grouped
+    by azimuth angle set and each group is batched into uvspec cases within the mxumu/mxphi limits, so that no
+    uvspec sightlines are wasted.
+
+    The HEALPix radiances are stored in the `xd_uu_hpx` attribute, having dimensions of (hpx, wvl, zout, stokes),
+    where `hpx` is the HEALPix pixel number in RING ordering. The propagation zenith angle (pza) and propagation
+    azimuth angle (paz) of the pixels are available as coordinates on the hpx dimension. Once run, the REM is also
+    interpolated to a regular polar/azimuth (lat-long) grid (see `HealpixRadEnv.to_latlong`), so that RadEnv methods
+    such as `sample`, `write_openexr` and the path radiance computations are available. Spherical harmonic
+    transforms are performed using the fast transforms in healpy.
+
+    The healpy package is required.
+
+    The HEALPix ring on the equator is horizontal, which is illegal in libRadtran. Radiances on this ring are the
+    average of sightlines slightly above and below the horizon (see `horizon_umu`).
+    """
+
+    def __init__(self, base_case, nside, mxumu=48, mxphi=19, n_sza=0, trans_mode='sza', horizon_umu=1.0e-3):
+        """ Create a set of uvspec runs to calculate a radiant environment map at the pixel centres of a HEALPix grid.
+
+        :param base_case: librad.Case object providing the case on which the environment map is to be based. See
+            RadEnv for requirements.
+        :param nside: HEALPix resolution parameter. Must be a power of 2. The number of pixels is 12*nside**2.
+        :param mxumu: Maximum number of polar angles in a single run of uvspec. Default 48.
+        :param mxphi: Maximum number of azimuth angles in a single run of uvspec. Default 19.
+        :param n_sza: Number of solar zenith angles for path transmittance computation. See RadEnv.
+        :param trans_mode: Transmittance mode. See RadEnv.setup_trans_cases.
+        :param horizon_umu: The horizontal HEALPix ring is computed as the average of sightlines with umu of plus and
+            minus this value. Default 0.001.
+        :return:
+        """
+        import healpy as hp
+        if not hp.isnsideok(nside):
+            raise ValueError('HEALPix nside must be a power of 2 in librad.HealpixRadEnv.')
+        self.base_case = copy.deepcopy(base_case)
+        self.levels_out_type = self.base_case.levels_out_type
+        self.n_levels_out = self.base_case.n_levels_out
+        self.solver = self.base_case.solver
+        self.trans_base_case = copy.deepcopy(base_case)
+        self.nside = nside
+        self.npix = hp.nside2npix(nside)
+        self.horizon_umu = horizon_umu
+        self.mxumu = mxumu
+        self.mxphi = mxphi
+        self.hemi = False
+        self.azi_symmetric = False
+        hpx_pza, hpx_paz = hp.pix2ang(nside, np.arange(self.npix))  # RING ordering, pixels sorted by paz in rings
+        self.hpx_pza = xd_identity(hpx_pza, 'pza', 'rad')
+        self.hpx_paz = xd_identity(hpx_paz, 'paz', 'rad')
+        # Group the rings by their set of azimuth angles
+        ring_groups = OrderedDict()
+        ring_pza, ring_start = np.unique(hpx_pza, return_index=True)
+        ring_order = np.argsort(ring_start)
+        ring_pza, ring_start = ring_pza[ring_order], ring_start[ring_order]
+        ring_stop = np.append(ring_start[1:], self.npix)
+        for pza, start, stop in zip(ring_pza, ring_start, ring_stop):
+            azi_key = tuple(np.round(hpx_paz[start:stop], 10))
+            ring_groups.setdefault(azi_key, []).append((pza, start))
+        # Create the cases, one or more for each group of rings
+        self.casechain = []
+        self.case_pixels = []  # The HEALPix pixel number and weight of each sightline in each case
+        for azi_key, rings in ring_groups.items():
+            group_paz = np.array(azi_key)
+            rows = []  # (umu, ring start pixel, weight) for every sightline row
+            for pza, start in rings:
+                umu = np.cos(pza)
+                if abs(umu) < horizon_umu:  # Horizontal ring, average sightlines just above and below
+                    rows.extend([(-horizon_umu, start, 0.5), (horizon_umu, start, 0.5)])
+                else:
+                    rows.append((umu, start, 1.0))
+            rows.sort()  # uvspec requires umu in increasing order
+            for i_row in range(0, len(rows), mxumu):
+                batch_rows = rows[i_row:i_row + mxumu]
+                batch_pza = np.arccos([row[0] for row in batch_rows])
+                row_start = np.array([row[1] for row in batch_rows])
+                row_weight = np.array([row[2] for row in batch_rows])
+                for i_azi in range(0, group_paz.size, mxphi):
+                    batch_paz = group_paz[i_azi:i_azi + mxphi]
+                    self.casechain.append(self._sightline_case(batch_pza, batch_paz,
+                                                               '_hpx{:04d}'.format(len(self.casechain))))
+                    pixels = row_start[:, np.newaxis] + np.arange(i_azi, i_azi + batch_paz.size)[np.newaxis, :]
+                    self.case_pixels.append((pixels, row_weight))
+        self.cases = [self.casechain]
+        self.n_pol_batch = 1
+        self.n_azi_batch = len(self.casechain)
+        self.has_water_clouds = self.base_case.has_water_clouds
+        self.has_ice_clouds = self.base_case.has_ice_clouds
+        self.has_clouds = self.base_case.has_clouds
+        self.n_sza = n_sza
+        self.trans_mode = trans_mode
+        self._set_latlong_grid(4 * nside, 8 * nside + 1)  # Default lat-long grid, required for transmittance cases
+        if n_sza:
+            self.setup_trans_cases(n_sza=n_sza, trans_mode=trans_mode)
+        self.uu = np.array([])
+
+    def _set_latlong_grid(self, n_pol, n_azi):
+        """ Set the regular polar/azimuth (lat-long) grid angles to which the HEALPix REM is interpolated.
+
+        :param n_pol: Number of polar angles from pi to 0.
+        :param n_azi: Number of azimuth angles from 0 to 2*pi.
+        :return: None
+        """
+        pza = np.linspace(np.pi, 0.0, n_pol)
+        paz = np.linspace(0.0, 2.0 * np.pi, n_azi)
+        self.pza = xd_identity(pza, 'pza', 'rad')
+        self.paz = xd_identity(paz, 'paz', 'rad')
+        self.umu = xd_identity(np.cos(pza), 'umu', '')
+        self.phi = xd_identity(np.rad2deg(paz), 'phi', 'deg')
+        self.vza = xd_identity(180.0 - np.rad2deg(pza), 'vza', 'deg')
+        self.vaz = xd_identity(np.rad2deg(paz) - 180.0, 'vaz', 'deg')
+        self.n_pol = n_pol
+        self.n_azi = n_azi
+
+    def _assemble_radiance(self):
+        """ Compile the radiance results from the executed cases into the HEALPix REM and interpolate to a regular
+        polar/azimuth grid.
+
+        :return: None
+        """
+        self.cases = [self.casechain]
+        xd_uu_case = self.casechain[0].xd_uu
+        other_dims = list(xd_uu_case.dims[2:])
+        uu_hpx = np.zeros((self.npix,) + xd_uu_case.shape[2:])
+        for case, (pixels, row_weight) in zip(self.casechain, self.case_pixels):
+            row_weight = row_weight.reshape((row_weight.size,) + (1,) * (case.xd_uu.ndim - 1))
+            np.add.at(uu_hpx, pixels, row_weight * case.xd_uu.data)
+        for case in self.casechain:
+            if hasattr(case, 'uu'):
+                del case.uu
+        self.xd_uu_hpx = xr.DataArray(uu_hpx, [('hpx', np.arange(self.npix))] +
+                                      [xd_uu_case[dim] for dim in other_dims],
+                                      name=xd_uu_case.name, attrs=xd_uu_case.attrs)
+        self.xd_uu_hpx.coords['pza'] = ('hpx', self.hpx_pza.data)
+        self.xd_uu_hpx.coords['paz'] = ('hpx', self.hpx_paz.data)
+        self.to_latlong()
+        self._promote_irradiance()
+
+    def to_latlong(self, n_pol=None, n_azi=None):
+        """ Interpolate the HEALPix REM to a regular polar/azimuth (lat-long) grid. The interpolated REM is stored in
+        the `xd_uu` attribute (and the angular axes updated) so that RadEnv methods such as `sample` and
+        `write_openexr` can be used.
+
+        :param n_pol: Number of polar angles from pi to 0. Default is 4*nside.
+        :param n_azi: Number of azimuth angles from 0 to 2*pi. Default is 8*nside + 1.
+        :return: xr.DataArray of the radiance on the lat-long grid, dimensions (pza, paz, wvl, zout, stokes).
+        """
+        import healpy as hp
+        if n_pol is None:
+            n_pol = 4 * self.nside
+        if n_azi is None:
+            n_azi = 8 * self.nside + 1
+        self._set_latlong_grid(n_pol, n_azi)
+        grid_pza, grid_paz = np.meshgrid(self.pza.data, self.paz.data, indexing='ij')
+        pixels, weights = hp.get_interp_weights(self.nside, grid_pza.ravel(), grid_paz.ravel())
+        uu_hpx = self.xd_uu_hpx.data
+        weights = weights.reshape(weights.shape + (1,) * (uu_hpx.ndim - 1))
+        uu = np.sum(weights * uu_hpx[pixels, ...], axis=0).reshape((n_pol, n_azi) + uu_hpx.shape[1:])
+        self.uu = uu
+        self.xd_uu = xr.DataArray(uu, [self.pza, self.paz] + [self.xd_uu_hpx[dim] for dim in self.xd_uu_hpx.dims[1:]],
+                                  name=self.xd_uu_hpx.name, attrs=self.xd_uu_hpx.attrs)
+        return self.xd_uu
+
+    def from_latlong(self, xd_uu=None):
+        """ Compute the HEALPix REM by interpolation of a REM on a regular polar/azimuth (lat-long) grid at the
+        HEALPix pixel centres. The result is stored in the `xd_uu_hpx` attribute.
+
+        :param xd_uu: xr.DataArray of radiance with leading dimensions of pza and paz, as for RadEnv. If None
+            (default), the `xd_uu` attribute is used.
+        :return: xr.DataArray of the HEALPix radiances.
+        """
+        if xd_uu is None:
+            xd_uu = self.xd_uu
+        axis_weights = [axis_interp_weights(xd_uu[dim].data, getattr(self, 'hpx_' + dim).data)
+                        if dim in ['pza', 'paz'] else None for dim in xd_uu.dims]
+        uu_hpx = gather_multilinear(xd_uu.data, axis_weights)
+        other_dims = [dim for dim in xd_uu.dims if dim not in ['pza', 'paz']]
+        self.xd_uu_hpx = xr.DataArray(uu_hpx, [('hpx', np.arange(self.npix))] + [xd_uu[dim] for dim in other_dims],
+                                      name=xd_uu.name, attrs=xd_uu.attrs)
+        self.xd_uu_hpx.coords['pza'] = ('hpx', self.hpx_pza.data)
+        self.xd_uu_hpx.coords['paz'] = ('hpx', self.hpx_paz.data)
+        return self.xd_uu_hpx
+
+    def sph_harm_fit_hpx(self, degree, iterations=3):
+        """ Compute the spherical harmonic coefficients of the HEALPix REM using the fast spherical harmonic
+        transform in healpy (healpy.map2alm). One set of coefficients is computed for each wavelength, level and
+        Stokes parameter.
+
+        The coefficients are complex, use the `scipy.special.sph_harm` normalisation and are for orders
+        :math:`m \geq 0` only, in the healpy (m-major) ordering. The coefficients for negative orders follow from
+        :math:`a_{n}^{-m} = (-1)^m \overline{a_{n}^{m}}`.
+
+        :param degree: Maximum degree of the spherical harmonics.
+        :param iterations: Number of Jacobi iterations in healpy.map2alm. Default 3.
+        :return: xr.DataArray of coefficients with leading dimension `alm` and coordinates `shn` (degree) and `shm`
+            (order). Also stored in the `xd_alm` attribute.
+        """
+        import healpy as hp
+        uu_hpx = self.xd_uu_hpx.data.reshape((self.npix, -1))
+        alm = np.array([hp.map2alm(np.ascontiguousarray(uu_hpx[:, i_map], dtype=np.float64), lmax=degree,
+                                   iter=iterations) for i_map in range(uu_hpx.shape[1])]).T
+        alm = alm.reshape((alm.shape[0],) + self.xd_uu_hpx.shape[1:])
+        shn, shm = hp.Alm.getlm(degree)
+        self.xd_alm = xr.DataArray(alm, [('alm', np.arange(alm.shape[0]))] +
+                                   [self.xd_uu_hpx[dim] for dim in self.xd_uu_hpx.dims[1:]],
+                                   name=self.xd_uu_hpx.name, attrs={'degree': degree})
+        self.xd_alm.coords['shn'] = ('alm', shn)
+        self.xd_alm.coords['shm'] = ('alm', shm)
+        return self.xd_alm
+
+    def sph_harm_map_hpx(self, nside=None):
+        """ Synthesise a HEALPix map from the spherical harmonic coefficients computed by
+        `HealpixRadEnv.sph_harm_fit_hpx` using the fast transform in healpy (healpy.alm2map).
+
+        :param nside: HEALPix resolution parameter of the map. Default is the nside of the REM.
+        :return: Numpy array of shape (npix, wvl, zout, stokes).
+        """
+        import healpy as hp
+        if not hasattr(self, 'xd_alm'):
+            raise ValueError('No spherical harmonic coefficients. Run HealpixRadEnv.sph_harm_fit_hpx first.')
+        if nside is None:
+            nside = self.nside
+        degree = self.xd_alm.attrs['degree']
+        alm = self.xd_alm.data.reshape((self.xd_alm.shape[0], -1))
+        uu_hpx = np.array([hp.alm2map(np.ascontiguousarray(alm[:, i_map]), nside, lmax=degree)
+                           for i_map in range(alm.shape[1])]).T
+        return uu_hpx.reshape((uu_hpx.shape[0],) + self.xd_alm.shape[1:])
@@ -10,11 +10,20 @@ __author__ = 'DGriffith, ARamkilowan'
 import numpy as np
 import pandas as pd
 import xarray as xr
-import StringIO
+try:
+    from StringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
 import matplotlib.pyplot as plt
-import easygui  # for simple file/open dialogs and such
+# easygui (for simple file/open dialogs) is only imported on demand, as in librad
 import re
+import os
+import tempfile
+import hashlib
+import zipfile
+import scipy.sparse as sparse
 from morticia.tools.xd import *
+from morticia.tools.xd import _coords_key, _trapz_weights, _interp_along_axis
 
 """ This module provides functionality related to radiometry required by MORTICIA.
 Included here is functionality for :
@@ -29,7 +38,11 @@ TO DO : Check that MODTRAN can read the .flt files created using the Flt class h
 
 # Micron symbol can be encoded in UTF-8 with
 _micronsymbol = u'\xB5'.encode('UTF-8')
-_micrometres = _micronsymbol + "m"
+_micrometres = _micronsymbol + 'm'.encode('UTF-8')
+
+# Regular expression matching a line of numeric data in a .flt file (whitespace-separated floating point numbers)
+_flt_number = r'[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?'
+_flt_data_line = re.compile(r'^\s*' + _flt_number + r'(\s+' + _flt_number + r')*\s*$')
 
 
 def srfgen(center, fwhm, n=101, shape='gauss', yedge=0.001, wvmin=None, wvmax=None, centerflat=0.0,
@@ -243,7 +256,7 @@ class Flt(object):
                                                      1.0e7 / filters[ifilt][:,0], filters[ifilt][:,0]/1000.0)).T
                 elif self.unitsheader == 'M':
                     self.filters[ifilt] = np.vstack((1000.0*filters[ifilt][:,0], filters[ifilt][:,1],
-                                                     1.0e10 /filters[ifilt][:,0], filters[ifilt][:,0])).T
+                                                     1.0e4 /filters[ifilt][:,0], filters[ifilt][:,0])).T
             return  # filter definitions have been given explicitly
         # Check that parameters are scalar or multiply them up to size
         checklist = ['centers', 'fwhms', 'shapes', 'yedges', 'centerflats', 'peakvals', 'oobs']
@@ -287,67 +300,125 @@ class Flt(object):
             raise ValueError('Number of ' + parmname + ' must equal number of filterheaders in rad.flt instantiation')
         return parm
 
-    def read(self, filename, name='Unknown'):
+    def read(self, filename, name='Unknown', use_cache=True):
         """ Read a .flt format spectral band filter definitions file (MODTRAN format)
 
+        The file is scanned once to locate the filter headers and data blocks, after which the numeric data of all
+        the filters is converted in bulk. The parsed content is saved in a binary sidecar file in the user cache
+        folder (see `user_cache_folder`), named by a hash of the absolute path of the .flt file, and is read from
+        there on subsequent calls, as long as the .flt file has not changed. A sidecar file that cannot be read
+        (e.g. left incomplete by an interrupted run) is ignored and replaced.
+
         :param filename:
+        :param use_cache: Read from (and write) the binary sidecar file. Default True.
         :return: object of class Flt, if the file is a well-formatted MODTRAN-style .flt file
         """
-        isfloatnum = '^[-+]?[0-9]*\.?[0-9]+([eE][-+]?[0-9]+)?$'  # regular expression to match a floating point number
         if filename == '.flt':
+            import easygui
             filename = easygui.fileopenbox(msg='Please select a .flt file.', filetypes=["*.flt"])
         self.filename = filename
         self.name = name
+        content = Flt._read_cache(filename) if use_cache else None
+        if content is None:
+            content = Flt._parse(filename)
+            if use_cache:
+                Flt._write_cache(filename, content)
+        fileheader, filterheaders, filter_data, counts = content
+        self.unitsheader = fileheader[0].upper()  # Must be W, N or M for wavenumber per cm, nm or microns
+        if self.unitsheader == 'W':
+            self.units = 'cm^-1'
+        elif self.unitsheader == 'N':
+            self.units = 'nm'
+        elif self.unitsheader == 'M':
+            self.units = _micrometres
+        else:
+            raise ValueError('File header for ' + filename + ' does not start with N, M or W as required for'
+                                                             ' .flt files.')
+        self.name = fileheader[1:].strip()
+        self.fileheader = fileheader.strip()
+        self.filterheaders = filterheaders
+        # Process the data of all filters together, depending on what the units are
+        # Column order is wavelength in nm, filter value, wavenumber per cm and wavelength in microns
+        spectral = filter_data[:, 0]
+        if self.unitsheader == 'W':
+            filters = np.vstack((1e7/spectral, filter_data[:, 1], spectral, 1e4/spectral)).T
+        elif self.unitsheader == 'N':
+            filters = np.vstack((spectral, filter_data[:, 1], 1e7/spectral, spectral/1000.0)).T
+        elif self.unitsheader == 'M':
+            filters = np.vstack((spectral*1000.0, filter_data[:, 1], 1e4/spectral, spectral)).T
+        self.filters = np.split(filters, np.cumsum(counts)[:-1])
+        self.nfilters = len(self.filters)
+
+    @staticmethod
+    def _parse(filename):
+        """ Parse a .flt file in a single scan.
+
+        :param filename: Name of the .flt file.
+        :return: Tuple of (fileheader, filterheaders, filter_data, counts). The filter_data is a 2-column array
+            of the spectral coordinates and filter values of all filters, with counts giving the number of rows
+            for each filter.
+        """
         with open(filename, 'rt') as fltfil:
-            fileheader = fltfil.readline()
-            self.unitsheader = fileheader[0].upper()  # Must be W, N or M for wavenumber per cm, nm or microns
-            if self.unitsheader == 'W':
-                self.units = 'cm^-1'
-            elif self.unitsheader == 'N':
-                self.units = 'nm'
-            elif self.unitsheader == 'M':
-                self.units = _micrometres
-            else:
-                raise ValueError('File header for ' + filename + ' does not start with N, M or W as required for'
-                                                                 ' .flt files.')
-            self.name = fileheader[1:].strip()
-            self.fileheader = fileheader.strip()
-            self.filterheaders = []
-            self.filters = []
-            ifilter = 0  # count the filters
-            nexlin = fltfil.readline()
-            while nexlin:
-                self.filterheaders.append(nexlin.strip())
-                nexlin = fltfil.readline()
-                if not nexlin:
-                    break  # all done
-                slin = nexlin.split()  # split line up into a list of tokens at whitespace
-                thisfilterdata = np.array([])
-                self.filters.append([])
-                # if all tokens match
-                while all([re.match(isfloatnum, tok) for tok in slin]):  # all tokens a are numbers-this is a line of data
-                    # accumulate the data
-                    thelinedata = np.array(slin).astype(np.float)
-                    if len(thisfilterdata) != 0:
-                        thisfilterdata = np.vstack((thisfilterdata, thelinedata))
-                    else:
-                        thisfilterdata = thelinedata
-                    nexlin = fltfil.readline()
-                    if not nexlin:
-                        break  # all done
-                    slin = nexlin.split()  # split line up into a list of tokens at whitespace
-                # process the accumulated data depending on what the units are
-                if self.unitsheader == 'W':
-                    self.filters[ifilter] = np.vstack((1e7/thisfilterdata[:,1], thisfilterdata[:,1],
-                                                       thisfilterdata[:,0], 1e9/thisfilterdata[:,1])).T
-                elif self.unitsheader == 'N':
-                    self.filters[ifilter] = np.vstack((thisfilterdata[:,0], thisfilterdata[:,1],
-                                                       1e7/thisfilterdata[:,0], thisfilterdata[:,0]/1000.0)).T
-                elif self.unitsheader == 'M':
-                    self.filters[ifilter] = np.vstack((thisfilterdata[:,0]*1000.0, thisfilterdata[:,1],
-                                                       1e9/thisfilterdata[:,0], thisfilterdata[:,0])).T
-                ifilter += 1
-            self.nfilters = ifilter
+            lines = fltfil.read().splitlines()
+        if not lines:
+            raise ValueError('File ' + filename + ' is empty.')
+        filterheaders = []
+        counts = []
+        data_tokens = []
+        for line in lines[1:]:
+            if filterheaders and _flt_data_line.match(line):  # This is a line of data
+                data_tokens.append(line.split()[:2])
+                counts[-1] += 1
+            elif line.strip():  # A filter header, which always follows the file header or a block of data
+                filterheaders.append(line.strip())
+                counts.append(0)
+        filter_data = np.array(data_tokens, dtype=np.float64).reshape((-1, 2))  # Bulk numeric conversion
+        return lines[0], filterheaders, filter_data, np.array(counts, dtype=np.int64)
+
+    @staticmethod
+    def _cache_filename(filename):
+        """ Name of the binary sidecar file of a .flt file, in the user cache folder.
+        """
+        path = os.path.abspath(filename)
+        path_hash = hashlib.sha1(path.encode('UTF-8') if not isinstance(path, bytes) else path).hexdigest()
+        return os.path.join(user_cache_folder(), os.path.basename(path) + '_' + path_hash[:16] + '.npz')
+
+    @staticmethod
+    def _read_cache(filename):
+        """ Read the parsed content of a .flt file from the binary sidecar file, if it is up to date.
+
+        :param filename: Name of the .flt file.
+        :return: Tuple as returned by Flt._parse, or None if there is no valid sidecar file.
+        """
+        cache_filename = Flt._cache_filename(filename)
+        if not os.path.isfile(cache_filename):
+            return None
+        flt_stat = os.stat(filename)
+        try:
+            with np.load(cache_filename) as cache:
+                if not np.array_equal(cache['source'], [flt_stat.st_mtime, flt_stat.st_size]):
+                    return None
+                return (str(cache['fileheader']), [str(header) for header in cache['filterheaders']],
+                        cache['filter_data'], cache['counts'])
+        except (IOError, OSError, ValueError, KeyError, EOFError, zipfile.BadZipfile):
+            return None  # Truncated or otherwise unreadable sidecar file, the .flt file is parsed again
+
+    @staticmethod
+    def _write_cache(filename, content):
+        """ Write the parsed content of a .flt file to the binary sidecar file. Failure to write is ignored.
+
+        :param filename: Name of the .flt file.
+        :param content: Tuple as returned by Flt._parse.
+        :return:
+        """
+        fileheader, filterheaders, filter_data, counts = content
+        flt_stat = os.stat(filename)
+        try:
+            _write_atomic(Flt._cache_filename(filename), lambda cache_file: np.savez(
+                cache_file, fileheader=np.array(fileheader), filterheaders=np.array(filterheaders, dtype=str),
+                filter_data=filter_data, counts=counts, source=np.array([flt_stat.st_mtime, flt_stat.st_size])))
+        except (IOError, OSError):
+            pass  # Sidecar files are optional, e.g. if the cache folder is read-only
 
 
     def __repr__(self, format='  %f'):
@@ -361,7 +432,7 @@ class Flt(object):
         for (ifilt, filter) in enumerate(self.filters):
             selfrep = selfrep + self.filterheaders[ifilt] + '\n'
             # Create a string buffer
-            strbuff = StringIO.StringIO()
+            strbuff = StringIO()
             # column ordering depends on original unit specification
             if self.unitsheader == 'W':
                 np.savetxt(strbuff, self.filters[ifilt][:,[2,1,0]], fmt=format)
@@ -427,7 +498,7 @@ class Flt(object):
         """
         xd_flt_list = []
         for ifilt in range(self.nfilters):
-            wvl = xd_identity(self.filters[ifilt][:,0], 'wvl', self.units)
+            wvl = xd_identity(self.filters[ifilt][:,0], 'wvl', 'nm')  # First column is always in nm
             #print wvl
             xd_flt_list.append(xr.DataArray(self.filters[ifilt][:,1], [wvl], name='srf',
                                                 attrs={'long_name': long_name['srf'],
@@ -448,14 +519,16 @@ class Flt(object):
             headers are returned in an attribute called 'labels'. The fileheader of the Flt object is
             returned in an attribute called 'title' (netCDF recommendation)
         """
-        xd_flt_list = self.flt_as_xd()  # Create a list of xr.DataArray objects
-        # Harmonise the wavelength axes
-        xd_flt_list_harmonised = xd_harmonise_interp(xd_flt_list)
-        xd_attrs_update(xd_flt_list_harmonised)  # Update the attribute
-        chn_indices = range(chn_start_index, chn_start_index + len(xd_flt_list))
-        # Compile the list into a single object
-        flt_data = np.vstack([xd_flt_list_harmonised[ifilt].data for ifilt in range(len(xd_flt_list))])
-        xd_flt_harmonised = xr.DataArray(flt_data.T, [(xd_flt_list_harmonised[0]['wvl']),
+        # Harmonise the wavelength axes directly, by linear interpolation of each filter onto the merged wavelengths
+        # with zero values outside the domain of each filter (as for xd_harmonise_interp)
+        wvl = np.unique(np.hstack([self.filters[ifilt][:, 0] for ifilt in range(self.nfilters)]))
+        flt_data = np.zeros((self.nfilters, wvl.size))
+        for ifilt in range(self.nfilters):
+            order = np.argsort(self.filters[ifilt][:, 0], kind='mergesort')
+            flt_data[ifilt] = np.interp(wvl, self.filters[ifilt][order, 0], self.filters[ifilt][order, 1],
+                                        left=0.0, right=0.0)
+        chn_indices = range(chn_start_index, chn_start_index + self.nfilters)
+        xd_flt_harmonised = xr.DataArray(flt_data.T, [xd_identity(wvl, 'wvl', 'nm'),
                                                       ('chn', chn_indices,
                                                          {'labels': self.filterheaders})],
                                            name=quantity_name,
@@ -546,6 +619,388 @@ avhrr_kratz_channels = np.array([
     [ 11.9318,  11.363636, 12.500000]])   # avhrr51.f
 avhrr_kratz_units = 'um'
 
+# Folder containing the libRadtran-compatible sensor spectral response (filter) files
+filter_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'radata', 'filter')
+
+
+def user_cache_folder():
+    """ Obtain the folder in which MORTICIA writes cached files, such as the FilterCatalogue. This is the morticia
+    sub-folder of $XDG_CACHE_HOME (default ~/.cache), or of the system temporary folder if that cannot be created.
+
+    :return: Name of the cache folder.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    for cache_folder in [os.path.join(cache_home, 'morticia'), os.path.join(tempfile.gettempdir(), 'morticia')]:
+        try:
+            if not os.path.isdir(cache_folder):
+                os.makedirs(cache_folder)
+            return cache_folder
+        except (IOError, OSError):
+            continue
+    return tempfile.gettempdir()
+
+
+def _write_atomic(filename, write):
+    """ Write a file atomically, by writing to a temporary file in the same folder and then renaming it into place,
+    so that other processes never see a partially written file.
+
+    :param filename: Name of the file to write.
+    :param write: Function taking the open (binary) file object, which writes the content.
+    :return:
+    """
+    folder, name = os.path.split(os.path.abspath(filename))
+    temp_handle, temp_filename = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=folder)
+    try:
+        with os.fdopen(temp_handle, 'wb') as temp_file:
+            write(temp_file)
+        try:
+            os.rename(temp_filename, filename)
+        except OSError:  # Windows does not allow renaming onto an existing file
+            if not os.path.isfile(filename):
+                raise
+            os.remove(filename)
+            os.rename(temp_filename, filename)
+    except BaseException:
+        if os.path.isfile(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
+class FilterCatalogue(object):
+    """ An indexed catalogue of the sensor spectral response function (filter) files in the libRadtran-compatible
+    library rad/radata/filter. The filter files are organised in sub-directories by platform series and are named
+    platform_sensor_channel (e.g. landsat/landsat7_etm_b4). Some files have more than one response column.
+
+    The catalogue is built once by parsing all the filter files, and is then stored in the user cache folder as a
+    packed numpy array of wavelengths and responses (filter_catalogue.npy), together with a binary index
+    (filter_catalogue_index.npz) holding a numpy record array of the platform, sensor and channel of each filter and
+    the offset and length of its data in the packed array. On subsequent use, the packed array is memory-mapped and
+    any channel is obtained as a view, without parsing any text. The catalogue is rebuilt automatically if the filter
+    files change.
+    """
+    _data_filename = 'filter_catalogue.npy'
+    _index_filename = 'filter_catalogue_index.npz'
+    _index_fields = ['platform_series', 'platform', 'sensor', 'channel', 'name', 'column', 'offset', 'count']
+
+    def __init__(self, folder=None, cache_folder=None, rebuild=False):
+        """ Open (or build) the filter catalogue.
+
+        :param folder: Folder containing the platform series sub-folders of filter files. Defaults to the
+            rad/radata/filter folder.
+        :param cache_folder: Folder in which to write the packed data and index files. Defaults to the folder
+            given by `user_cache_folder`. If the files cannot be written, the catalogue is held in memory only.
+        :param rebuild: Force the catalogue to be rebuilt from the filter files. Default False. The catalogue is also
+            rebuilt if the cached files are for another folder, are out of date or cannot be read.
+        :return:
+        """
+        if folder is None:
+            folder = filter_folder
+        if cache_folder is None:
+            cache_folder = user_cache_folder()
+        self.folder = os.path.abspath(folder)
+        self.data_filename = os.path.join(cache_folder, self._data_filename)
+        self.index_filename = os.path.join(cache_folder, self._index_filename)
+        signature = self._signature()
+        index = None
+        if not rebuild and os.path.isfile(self.index_filename) and os.path.isfile(self.data_filename):
+            try:
+                with np.load(self.index_filename) as index_file:
+                    if index_file['folder'] == self.folder and np.array_equal(index_file['signature'], signature):
+                        index = index_file['entries']  # Otherwise the filter files have changed
+                if index is not None:
+                    self.entries = [dict(zip(index.dtype.names, entry.tolist())) for entry in index]
+                    self.data = np.load(self.data_filename, mmap_mode='r')
+            except (IOError, OSError, ValueError, KeyError, EOFError, zipfile.BadZipfile):
+                index = None  # Unreadable catalogue files are rebuilt
+        if index is None:
+            self._build(signature)
+        self._index_entries()
+
+    def _filter_files(self):
+        """ List the filter files in the catalogue folder as (platform_series, name, path) tuples.
+        """
+        filter_files = []
+        for platform_series in sorted(os.listdir(self.folder)):
+            series_folder = os.path.join(self.folder, platform_series)
+            if not os.path.isdir(series_folder):
+                continue
+            for name in sorted(os.listdir(series_folder)):
+                path = os.path.join(series_folder, name)
+                if os.path.isfile(path) and name != 'README':
+                    filter_files.append((platform_series, name, path))
+        return filter_files
+
+    def _signature(self):
+        """ Compute a signature (number of files, total size and latest modification time) of the filter files.
+        """
+        stats = [os.stat(path) for platform_series, name, path in self._filter_files()]
+        return [len(stats), sum(stat.st_size for stat in stats), max([stat.st_mtime for stat in stats] or [0.0])]
+
+    def _build(self, signature):
+        """ Parse all the filter files and build the packed data array and index.
+        """
+        entries = []
+        blocks = []
+        offset = 0
+        for platform_series, name, path in self._filter_files():
+            try:
+                filter_data = np.loadtxt(path, comments='#', ndmin=2)
+            except ValueError:
+                warnings.warn('Unable to read filter file ' + path + ' into FilterCatalogue.')
+                continue
+            platform_name, sensor_name, channel_name = FilterCatalogue.split_name(name)
+            for i_column in range(1, filter_data.shape[1]):
+                entries.append({'platform_series': platform_series, 'platform': platform_name,
+                                'sensor': sensor_name, 'channel': channel_name, 'name': name,
+                                'column': i_column - 1, 'offset': offset, 'count': filter_data.shape[0]})
+                blocks.append(filter_data[:, [0, i_column]].T)
+                offset += filter_data.shape[0]
+        self.entries = entries
+        self.data = np.ascontiguousarray(np.hstack(blocks))  # Row 0 is wavelength (nm), row 1 is response
+        try:
+            # Files are written atomically, since other processes may be opening the catalogue at the same time
+            _write_atomic(self.data_filename, lambda data_file: np.save(data_file, self.data))
+            index = np.rec.fromarrays([np.array([entry[field] for entry in entries]) for field in self._index_fields],
+                                      names=self._index_fields)
+            _write_atomic(self.index_filename, lambda index_file: np.savez(
+                index_file, entries=index, signature=np.array(signature), folder=np.array(self.folder)))
+            self.data = np.load(self.data_filename, mmap_mode='r')
+        except (IOError, OSError):
+            warnings.warn('Unable to write FilterCatalogue files to ' + os.path.dirname(self.data_filename) +
+                          '. Catalogue is held in memory only.')
+
+    def _index_entries(self):
+        """ Build dictionaries for lookup of channels by name and by sensor.
+        """
+        self.by_name = {}
+        self.by_sensor = {}
+        for i_entry, entry in enumerate(self.entries):
+            self.by_name[(entry['platform_series'], entry['name'], entry['column'])] = i_entry
+            sensor_key = (entry['platform_series'], entry['platform'], entry['sensor'])
+            if entry['column'] == 0:
+                self.by_sensor.setdefault(sensor_key, []).append(i_entry)
+
+    @staticmethod
+    def split_name(name):
+        """ Split a filter file name into platform, sensor and channel names. Names are of the form
+        platform_sensor_channel (e.g. landsat7_etm_b4), or platform_channel (e.g. seosat_b1) if the platform has
+        only one sensor.
+
+        :param name: Name of the filter file.
+        :return: Tuple of (platform_name, sensor_name, channel_name). The sensor name may be empty.
+        """
+        parts = name.split('_')
+        if len(parts) >= 3:
+            return parts[0], parts[1], '_'.join(parts[2:])
+        elif len(parts) == 2:
+            return parts[0], '', parts[1]
+        return name, '', ''
+
+    def channel_data(self, platform_series, platform_name, sensor_name, channel_name, column=0):
+        """ Obtain the wavelengths and response of a single sensor channel.
+
+        :param platform_series: Name of the series of platforms on which the sensor is carried e.g. 'landsat'
+        :param platform_name: Name of the specific satellite/platform e.g. 'landsat7'
+        :param sensor_name: Name of the specific sensor on the platform e.g. 'tm' or 'etm'. Can be empty or None for
+            platforms with a single sensor.
+        :param channel_name: Name of the spectral channel e.g. 'b4'
+        :param column: Response column for files having more than one response column. Default 0 (the first).
+        :return: Tuple (wvl, response) of numpy arrays (read-only views into the catalogue), wavelengths in nm.
+        """
+        name = '_'.join([part for part in [platform_name, sensor_name, channel_name] if part])
+        key = (platform_series, name, column)
+        if key not in self.by_name:
+            raise ValueError('Sensor channel ' + name + ' (column ' + str(column) + ') not found in platform '
+                             'series ' + platform_series + ' of the FilterCatalogue.')
+        entry = self.entries[self.by_name[key]]
+        channel_slice = slice(entry['offset'], entry['offset'] + entry['count'])
+        return self.data[0, channel_slice], self.data[1, channel_slice]
+
+    def channel(self, platform_series, platform_name, sensor_name, channel_name, column=0):
+        """ Obtain a single sensor channel spectral response function as an xr.DataArray.
+
+        :param platform_series: Name of the series of platforms on which the sensor is carried e.g. 'landsat'
+        :param platform_name: Name of the specific satellite/platform e.g. 'landsat7'
+        :param sensor_name: Name of the specific sensor on the platform e.g. 'etm'.
+        :param channel_name: Name of the spectral channel e.g. 'b4'
+        :param column: Response column for files having more than one response column. Default 0 (the first).
+        :return: xr.DataArray of the spectral response function, with wavelength axis 'wvl'.
+        """
+        wvl, response = self.channel_data(platform_series, platform_name, sensor_name, channel_name, column)
+        name = '_'.join([part for part in [platform_name, sensor_name, channel_name] if part])
+        return xr.DataArray(np.array(response), [xd_identity(np.array(wvl), 'wvl', 'nm')], name='srf',
+                            attrs={'long_name': long_name['srf'], 'units': default_units['srf'],
+                                   'labels': name, 'title': platform_series})
+
+    def sensor(self, platform_series, platform_name, sensor_name):
+        """ Obtain all channels of a sensor as a single, wavelength-harmonised xr.DataArray, as for
+        `Flt.flt_as_xd_harmonised`.
+
+        :param platform_series: Name of the series of platforms on which the sensor is carried e.g. 'landsat'
+        :param platform_name: Name of the specific satellite/platform e.g. 'landsat7'
+        :param sensor_name: Name of the specific sensor on the platform e.g. 'etm'. Use an empty string for
+            platforms with a single sensor.
+        :return: xr.DataArray with axes 'wvl' and 'chn'. The channel names are in the 'labels' attribute of the
+            'chn' axis.
+        """
+        key = (platform_series, platform_name, sensor_name or '')
+        if key not in self.by_sensor:
+            raise ValueError('Sensor ' + str(key) + ' not found in the FilterCatalogue.')
+        entries = [self.entries[i_entry] for i_entry in self.by_sensor[key]]
+        xd_srf_list = [self.channel(platform_series, entry['platform'], entry['sensor'], entry['channel'])
+                       for entry in entries]
+        xd_srf_list = xd_harmonise_interp(xd_srf_list)
+        srf_data = np.vstack([xd_srf.data for xd_srf in xd_srf_list])
+        return xr.DataArray(srf_data.T, [xd_srf_list[0]['wvl'],
+                                         ('chn', range(len(entries)),
+                                          {'labels': [entry['channel'] for entry in entries]})],
+                            name='srf', attrs={'long_name': long_name['srf'], 'units': default_units['srf'],
+                                               'title': '_'.join([part for part in key[1:] if part])})
+
+    def sensors(self):
+        """ List the sensors in the catalogue.
+
+        :return: Sorted list of (platform_series, platform_name, sensor_name) tuples.
+        """
+        return sorted(self.by_sensor.keys())
+
+    def find(self, re_select):
+        """ Find channels having names matching a regular expression.
+
+        :param re_select: Regular expression to match against the filter file names e.g. 'landsat7_etm_b[1-4]'
+        :return: List of (platform_series, platform_name, sensor_name, channel_name) tuples.
+        """
+        return [(entry['platform_series'], entry['platform'], entry['sensor'], entry['channel'])
+                for entry in self.entries if entry['column'] == 0 and re.search(re_select, entry['name'])]
+
+
+_filter_catalogue = None
+
+
+def filter_catalogue():
+    """ Obtain the default FilterCatalogue over rad/radata/filter, which is opened (or built) on first use.
+
+    :return: FilterCatalogue object.
+    """
+    global _filter_catalogue
+    if _filter_catalogue is None:
+        _filter_catalogue = FilterCatalogue()
+    return _filter_catalogue
+
+
+# Cache of SRF projection matrices, keyed on the SRFs, the wavelengths of the spectral quantity and normalisation
+_srf_projection_cache = LRUCache(maxsize=32)
+
+
+def srf_projection_matrix(xd_srf, wvl, normalise=False):
+    """ Compute the sparse matrix that projects (band-integrates) spectral quantities sampled at the given wavelengths
+    onto a set of spectral response functions (SRFs). Row i of the matrix is the SRF of channel i, linearly
+    interpolated onto the wavelengths (zero outside the SRF wavelength range) and multiplied by the trapezoidal
+    integration weights. Only the non-zero weights are stored (scipy.sparse CSR format), so that the matrix is
+    compact for band-limited SRFs.
+
+    Matrices are kept in a bounded, least-recently-used cache. The returned matrix is shared and is read-only.
+
+    :param xd_srf: xr.DataArray of SRFs with dimensions `wvl` and `chn`, such as returned by
+        `Flt.flt_as_xd_harmonised` or `FilterCatalogue.sensor`. A single SRF without a `chn` dimension is also
+        accepted.
+    :param wvl: Vector of wavelengths at which the spectral quantity is sampled, in the same units as the SRF
+        wavelengths.
+    :param normalise: If True, each row is divided by its sum (the integral of the SRF over the wavelengths), so
+        that projection gives the SRF-weighted mean of the spectral quantity. Default False.
+    :return: scipy.sparse.csr_matrix of shape (n_channels, n_wavelengths).
+    """
+    if 'chn' not in xd_srf.dims:
+        xd_srf = xd_srf.expand_dims('chn')
+    xd_srf = xd_srf.transpose('chn', 'wvl')
+    wvl = np.asarray(wvl, dtype=np.float64)
+    srf_wvl = xd_srf['wvl'].values
+    cache_key = (bool(normalise), _coords_key(srf_wvl), _coords_key(xd_srf.values), _coords_key(wvl))
+    matrix = _srf_projection_cache.get(cache_key)
+    if matrix is None:
+        srf = xd_srf.values
+        if srf_wvl.size > 1 and np.any(np.diff(srf_wvl) < 0):
+            order = np.argsort(srf_wvl, kind='mergesort')
+            srf_wvl, srf = srf_wvl[order], srf[:, order]
+        table = axis_interp_weights_cached(srf_wvl, wvl)
+        weights = _interp_along_axis(srf, 1, table, fill_value=0.0) * _trapz_weights(wvl)
+        if normalise:
+            row_sums = weights.sum(axis=1)
+            weights /= np.where(row_sums != 0.0, row_sums, 1.0)[:, np.newaxis]
+        matrix = sparse.csr_matrix(weights)
+        for matrix_array in [matrix.data, matrix.indices, matrix.indptr]:
+            matrix_array.flags.writeable = False
+        _srf_projection_cache.put(cache_key, matrix)
+    return matrix
+
+
+def srf_projection_cache_clear():
+    """ Clear the cache of SRF projection matrices (see `srf_projection_matrix`).
+
+    :return:
+    """
+    _srf_projection_cache.clear()
+
+
+def project_onto_srf(xd_spectral, xd_srf, normalise=False):
+    """ Compute the band-integrated quantity for a set of spectral response functions (SRFs). The spectral
+    quantity can have any number of other axes (e.g. sightline, level and hyper-axes of a radiant environment
+    map) and the projection is performed as a single sparse-dense matrix product using the (cached) matrix from
+    `srf_projection_matrix`.
+
+    :param xd_spectral: xr.DataArray of the spectral quantity, having a `wvl` axis.
+    :param xd_srf: xr.DataArray of SRFs with dimensions `wvl` and `chn`. A single SRF without a `chn` dimension is
+        also accepted.
+    :param normalise: If True, the band-integrated quantity is divided by the integral of each SRF, giving the
+        SRF-weighted mean spectral quantity, which keeps the name and attributes of the spectral quantity. Otherwise
+        the units and long_name are those of the band integral (see `_band_integrated_attrs`). Default False.
+    :return: xr.DataArray of the band quantity with the `wvl` axis replaced by the `chn` axis.
+    """
+    if 'chn' not in xd_srf.dims:
+        xd_srf = xd_srf.expand_dims('chn')
+    matrix = srf_projection_matrix(xd_srf, xd_spectral['wvl'].values, normalise=normalise)
+    spectral_axis = xd_spectral.get_axis_num('wvl')
+    spectral = np.moveaxis(xd_spectral.values, spectral_axis, 0)
+    band = matrix.dot(spectral.reshape((spectral.shape[0], -1)))
+    band = np.moveaxis(band.reshape((matrix.shape[0],) + spectral.shape[1:]), 0, spectral_axis)
+    coords = [xd_srf['chn'] if dim == 'wvl' else xd_spectral[dim] for dim in xd_spectral.dims]
+    name, attrs = xd_spectral.name, dict(xd_spectral.attrs)
+    if not normalise:
+        name, attrs = _band_integrated_attrs(xd_spectral, xd_srf)
+    return xr.DataArray(band, coords, name=name, attrs=attrs)
+
+
+def _band_integrated_attrs(xd_spectral, xd_srf):
+    """ Compute the name and attributes of the band integral of a spectral quantity over a set of SRFs. The
+    wavelength units are removed from (or multiplied into) the units and any units of the SRF are multiplied in.
+    A 'Spectral' long_name loses the 'Spectral' prefix, so that e.g. `specrad` (Spectral Radiance in W/m^2/sr/nm)
+    becomes `rad` (Radiance in W/m^2/sr).
+
+    :param xd_spectral: xr.DataArray of the spectral quantity, having a `wvl` axis.
+    :param xd_srf: xr.DataArray of the SRFs.
+    :return: Tuple of the name and the attributes dict of the band-integrated quantity.
+    """
+    name, attrs = xd_spectral.name, dict(xd_spectral.attrs)
+    if name in long_name and name.startswith('spec') and name[4:] in long_name:
+        name = name[4:]
+    if 'units' in attrs:
+        wvl_units = xd_spectral['wvl'].attrs.get('units', default_units['wvl'])
+        units = attrs['units']
+        if units.endswith('/' + wvl_units):
+            units = units[:-len(wvl_units) - 1]
+        else:
+            units = '(' + units + ')*' + wvl_units if units else wvl_units
+        srf_units = xd_srf.attrs.get('units', '')
+        if srf_units and srf_units != '1':
+            units = units + '*(' + srf_units + ')'
+        attrs['units'] = units
+    if 'long_name' in attrs:
+        if attrs['long_name'].startswith('Spectral '):
+            attrs['long_name'] = attrs['long_name'][len('Spectral '):]
+        else:
+            attrs['long_name'] = 'Band-integrated ' + attrs['long_name']
+    return name, attrs
+
 
 class SpectralFunction(object):
     """ The SpectralFunction class defines any band-limited spectral distribution function. This could be
@@ -566,7 +1021,10 @@ class SpectralFunction(object):
 
         :return: A SpectralDistribution object
         """
-        pass
+        self.extreme_limits = extreme_limits
+        self.in_band_limits = in_band_limits
+        self.in_band_threshold = in_band_threshold
+        self.xd_sdf = None  # Samples of the spectral distribution function, if defined by samples
 
     # Use @classmethod, where the class of object instance is passed implicitly, instead of self
     # This syntax is used to create alternative constructors
@@ -636,10 +1094,14 @@ class SpectralFunction(object):
             e.g. 'landsat7'
         :param sensor_name: Name of the specific sensor on the platform e.g. 'tm' or 'etm'
         :param channel_name: Name of the specific spectral channel on the given sensor e.g.
-        :return:
+        :return: A SpectralFunction object with the response function samples in attribute xd_sdf, loaded from
+            the FilterCatalogue.
         """
-
-        obj = cls()
+        xd_srf = filter_catalogue().channel(platform_series, platform_name, sensor_name, channel_name)
+        wvl = xd_srf['wvl'].data
+        in_band = wvl[xd_srf.data >= 0.01 * xd_srf.data.max()]
+        obj = cls([wvl[0], wvl[-1]], in_band_limits=[in_band[0], in_band[-1]])
+        obj.xd_sdf = xd_srf
         return obj
 
     def decimate_resolution(self):
@@ -669,7 +1131,58 @@ class SpectralBasis(object):
     onto the spectral response functions of the sensor to get the sensor responses to each of the end-members.
 
     Notes: A SpectralBasis is not generally orthogonal unless specifically designed so by the user.
+
+    The spectral functions are held as a single, wavelength-harmonised xr.DataArray with axes `wvl` and `chn`, and
+    projection is performed with a sparse projection matrix (see `srf_projection_matrix`), which is cached for each
+    wavelength grid onto which the basis is projected.
     """
+    def __init__(self, xd_srf):
+        """ Create a SpectralBasis.
+
+        :param xd_srf: xr.DataArray of spectral functions with axes `wvl` and `chn`, as returned by
+            `Flt.flt_as_xd_harmonised` or `FilterCatalogue.sensor`, or a list of SpectralFunction objects defined by
+            samples (see `SpectralFunction.sensor_channel`), which are then harmonised.
+        :return:
+        """
+        if isinstance(xd_srf, (list, tuple)):
+            xd_sdf_list = xd_harmonise_interp([spectral_function.xd_sdf for spectral_function in xd_srf])
+            labels = [xd_sdf.attrs.get('labels', '') for xd_sdf in xd_sdf_list]
+            xd_srf = xr.DataArray(np.vstack([xd_sdf.data for xd_sdf in xd_sdf_list]).T,
+                                  [xd_sdf_list[0]['wvl'], ('chn', range(len(xd_sdf_list)), {'labels': labels})],
+                                  name='srf', attrs={'long_name': long_name['srf'], 'units': default_units['srf']})
+        elif 'chn' not in xd_srf.dims:
+            xd_srf = xd_srf.expand_dims('chn')
+        self.xd_srf = xd_srf.transpose('wvl', 'chn')
+
+    def projection_matrix(self, wvl, normalise=False):
+        """ Obtain the sparse matrix that projects spectral quantities sampled at the given wavelengths onto this
+        SpectralBasis (see `srf_projection_matrix`).
+
+        :param wvl: Vector of wavelengths.
+        :param normalise: Normalise the projection by the integral of each spectral function. Default False.
+        :return: scipy.sparse.csr_matrix of shape (n_channels, n_wavelengths).
+        """
+        return srf_projection_matrix(self.xd_srf, wvl, normalise=normalise)
+
+    def project(self, xd_spectral, normalise=False):
+        """ Project a spectral quantity onto this SpectralBasis (see `project_onto_srf`).
+
+        :param xd_spectral: xr.DataArray of the spectral quantity, having a `wvl` axis and any other axes.
+        :param normalise: Normalise the projection by the integral of each spectral function. Default False.
+        :return: SpectralVector
+        """
+        return SpectralVector(self, project_onto_srf(xd_spectral, self.xd_srf, normalise=normalise), normalise)
+
+    @classmethod
+    def sensor_channels(cls, platform_series, platform_name, sensor_name):
+        """ Create a SpectralBasis from all the channels of a sensor in the FilterCatalogue.
+
+        :param platform_series: Name of the series of platforms on which the sensor is carried e.g. 'landsat'
+        :param platform_name: Name of the specific satellite/platform e.g. 'landsat7'
+        :param sensor_name: Name of the specific sensor on the platform e.g. 'etm'
+        :return: SpectralBasis
+        """
+        return cls(filter_catalogue().sensor(platform_series, platform_name, sensor_name))
 
     @classmethod
     def from_flt_file(cls, filename, re_select=None):
@@ -680,8 +1193,15 @@ class SpectralBasis(object):
         :param re_select: Select a sub-set of the channels using a regular expression filter. Only the channel
             names/descriptions that match the regular expression will be included. The default is to read
             all channels in the file.
-        :return:
+        :return: SpectralBasis
         """
+        xd_srf = Flt(filename).flt_as_xd_harmonised()
+        if re_select is not None:
+            labels = xd_srf['chn'].attrs['labels']
+            selected = [i_chn for i_chn, label in enumerate(labels) if re.search(re_select, label)]
+            xd_srf = xd_srf.isel(chn=selected)
+            xd_srf['chn'].attrs['labels'] = [labels[i_chn] for i_chn in selected]
+        return cls(xd_srf)
 
     @classmethod
     def kato_VIS(cls):
@@ -702,8 +1222,24 @@ class SpectralBasis(object):
         """
 
 
-class SpectralVector(object):  # Should inherit from
-    pass
+class SpectralVector(object):
+    """ A SpectralVector is the result of projecting a spectral quantity onto a SpectralBasis, being the
+    band-integrated (or band-averaged, if normalised) quantity in each of the channels of the basis.
+    """
+    def __init__(self, basis, xd_vector, normalised=False):
+        """ Create a SpectralVector.
+
+        :param basis: The SpectralBasis onto which the quantity was projected.
+        :param xd_vector: xr.DataArray of the projected quantity, having a `chn` axis.
+        :param normalised: True if the projection was normalised by the integrals of the spectral functions.
+        :return:
+        """
+        self.basis = basis
+        self.xd_vector = xd_vector
+        self.normalised = normalised
+
+    def __str__(self):
+        return str(self.xd_vector)
 
 
 
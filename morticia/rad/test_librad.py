@@ -14,3 +14,275 @@ for uvINPfile in uvINPfiles:
 
 
 
+
+
+# Tests of the RadEnv tools on synthetic radiant environment maps (uvspec is not run)
+import os
+import numpy as np
+import xarray as xr
+import pytest
+from morticia.tools.xd import xd_identity
+from morticia.rad import radute
+
+example_inp = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples', 'UVSPEC_AEROSOL.INP')
+
+
+def smooth_angular(pza, paz):
+    """ A smooth radiance distribution, symmetric about the solar principal plane.
+    """
+    return 1.0 + 0.5 * np.cos(pza) + 0.2 * np.sin(pza) * np.cos(paz)
+
+
+def make_radenv(n_pol=8, n_azi=8, wvl=(300.0, 310.0, 320.0, 330.0, 340.0), hemi=False, angular=smooth_angular):
+    """ Create a RadEnv from the example case and attach a synthetic spectral radiance map, being the product of
+    the given angular distribution and a linear spectrum.
+    """
+    rad_env = librad.RadEnv(librad.Case(filename=example_inp), n_pol, n_azi, hemi=hemi)
+    wvl = np.asarray(wvl)
+    pza, paz = np.meshgrid(rad_env.pza.values, rad_env.paz.values, indexing='ij')
+    angular = angular(pza, paz)
+    spectral = 1.0 + (wvl - 300.0) / 40.0
+    uu = angular[:, :, np.newaxis, np.newaxis, np.newaxis] * spectral[:, np.newaxis, np.newaxis]
+    rad_env.xd_uu = xr.DataArray(uu, [rad_env.pza, rad_env.paz, xd_identity(wvl, 'wvl'), xd_identity([0.0], 'zout'),
+                                      xd_identity([0], 'stokes')], name='specrad', attrs={'units': 'W/m^2/sr/nm'})
+    rad_env.uu = rad_env.xd_uu.values
+    return rad_env
+
+
+def test_project_srf():
+    rad_env = make_radenv()
+    srf_wvl = np.array([315.0, 305.0, 325.0])  # Unsorted SRF wavelengths
+    xd_srf = xr.DataArray(np.array([[0.5, 0.0, 0.0], [0.0, 0.0, 0.0], [0.0, 0.0, 1.0]]),
+                          [xd_identity(srf_wvl, 'wvl'), ('chn', [0, 1, 2])], name='srf')
+    xd_srf[1, 1] = 1.0  # Channel 1 only responds at 305 nm
+    for normalise in [False, True]:
+        band = rad_env.project_srf(xd_srf, normalise=normalise)
+        expected = radute.project_onto_srf(rad_env.xd_uu, xd_srf, normalise=normalise)
+        assert band.dims == expected.dims and np.allclose(band.values, expected.values)
+        assert band.attrs['units'] == ('W/m^2/sr/nm' if normalise else 'W/m^2/sr')
+    # An SRF entirely outside the REM wavelengths gives zero, also when normalised
+    xd_srf_out = xr.DataArray(np.array([0.0, 1.0, 0.0]), [xd_identity([400.0, 410.0, 420.0], 'wvl')], name='srf')
+    band = rad_env.project_srf(xd_srf_out, normalise=True)
+    assert not np.any(np.isnan(band.values)) and np.all(band.values == 0.0)
+    # The projection from the principal component representation agrees with the full spectral projection
+    expected = rad_env.project_srf(xd_srf, normalise=True)
+    rad_env.compress_spectral(n_components=2, drop=True)
+    band = rad_env.project_srf(xd_srf, normalise=True)
+    assert band.dims == expected.dims and np.allclose(band.values, expected.values, rtol=1.0e-5)
+    assert band.attrs['units'] == 'W/m^2/sr/nm'
+    assert rad_env.project_srf(xd_srf).attrs['units'] == 'W/m^2/sr'
+
+
+@pytest.mark.parametrize('trans_mode', ['sza', 'cheap', 'verbose'])
+def test_setup_trans_cases(trans_mode):
+    base_case = librad.Case(filename=example_inp)
+    for option in [['umu', '-1.0', '1.0'], ['phi', '0.0', '90.0'], ['phi0', '10.0'], ['mol_abs_param', 'crs']]:
+        base_case.alter_option(option)
+    rad_env = librad.RadEnv(base_case, 8, 8, n_sza=4, trans_mode=trans_mode)
+    for trans_case in [rad_env.trans_base_case] + rad_env.trans_cases:
+        # The option lists of the case are kept in step
+        assert (len(trans_case.options) == len(trans_case.tokens) == len(trans_case.filorigin) ==
+                len(trans_case.optionobj))
+        assert [obj.name for obj in trans_case.optionobj] == trans_case.options
+        assert not set(['umu', 'phi', 'phi0']) & set(trans_case.options)
+        assert 'aerosol_file' in trans_case.options
+        if trans_mode == 'sza':
+            assert trans_case.solver == 'disort' and 'number_of_streams' in trans_case.options
+        else:
+            assert trans_case.solver == 'twostr' and 'number_of_streams' not in trans_case.options
+            assert trans_case.options.count('rte_solver') == 1
+        assert ('quiet' in trans_case.options) == (trans_mode != 'verbose')
+        assert trans_case.verbose == (trans_mode == 'verbose')
+    assert len(rad_env.trans_cases) == (1 if trans_mode == 'verbose' else len(rad_env.trans_vza_up))
+
+
+def test_openexr_compression():
+    Imath = pytest.importorskip('Imath')
+    assert str(librad._openexr_compression('none')) == str(Imath.Compression(Imath.Compression.NO_COMPRESSION))
+    assert str(librad._openexr_compression('PIZ')) == str(Imath.Compression(Imath.Compression.PIZ_COMPRESSION))
+    with pytest.raises(ValueError):
+        librad._openexr_compression('lzw')
+
+
+def sph_harm_angular(coeff):
+    """ A radiance distribution given by real spherical harmonic coefficients, as a function of pza and paz.
+    """
+    degree = int(np.sqrt(len(coeff))) - 1
+
+    def angular(pza, paz):
+        shn, shm, basis = librad.real_sph_harm_basis(degree, pza, paz)
+        return np.tensordot(np.asarray(coeff), basis, axes=(0, 0))
+    return angular
+
+
+@pytest.mark.parametrize('hemi', [False, True])
+def test_sph_harm_fit_eval_round_trip(hemi):
+    # A REM that is a combination of spherical harmonics up to degree 2 (symmetric about the solar principal plane
+    # for hemi, i.e. without the sine terms of order m < 0)
+    coeff = np.array([2.0, 0.3, 0.5, -0.2, 0.1, 0.2, 0.3, 0.05, -0.1])
+    if hemi:
+        coeff[[1, 4, 5]] = 0.0
+    angular = sph_harm_angular(coeff)
+    rad_env = make_radenv(n_pol=90, n_azi=90 if hemi else 180, hemi=hemi, angular=angular)
+    rad_env.sph_harm_fit(2)
+    xd_coeff = rad_env.xd_sph_harm_coeff
+    assert xd_coeff.dims == ('shc', 'wvl', 'zout', 'stokes')
+    spectral = np.linspace(1.0, 2.0, 5)
+    expected = coeff[:, np.newaxis] * spectral
+    assert np.allclose(xd_coeff.values[..., 0, 0], expected, rtol=0.0, atol=2.0e-3)
+    # Evaluation at arbitrary directions, with and without interpolation of the wavelengths
+    rng = np.random.RandomState(1)
+    directions = np.column_stack((np.arccos(rng.uniform(-1.0, 1.0, 20)), rng.uniform(0.0, np.pi, 20)))
+    exact = angular(directions[:, 0], directions[:, 1])
+    uu = rad_env.sph_harm_eval(directions)
+    assert uu.shape == (20, 5, 1)
+    assert np.allclose(uu[:, :, 0], exact[:, np.newaxis] * spectral, rtol=0.0, atol=2.0e-3)
+    uu = rad_env.sph_harm_eval(directions, wavelengths=np.full(20, 315.0), levels=np.zeros(20))
+    assert np.allclose(uu, exact * 1.375, rtol=0.0, atol=2.0e-3)
+    assert np.all(rad_env.sph_harm_error()['rel_rms_error'].values < 1.0e-3)
+    with pytest.raises(ValueError):
+        rad_env.sph_harm_eval(directions, degree=3)
+
+
+def test_sph_harm_matrix_cache():
+    librad._sph_harm_matrix_cache.clear()
+    rad_env = make_radenv(n_pol=16, n_azi=16)
+    rad_env.sph_harm_fit(3)
+    coeff = rad_env.xd_sph_harm_coeff.values
+    shn, shm, fit_matrix = librad._sph_harm_fit_matrix(3, rad_env.pza.values, rad_env.paz.values)
+    assert librad._sph_harm_matrix_cache.hits == 1 and not fit_matrix.flags.writeable
+    # Refitting on the same grid uses the cached matrix and gives the same coefficients
+    rad_env.sph_harm_fit(3)
+    assert librad._sph_harm_matrix_cache.hits == 2 and np.array_equal(rad_env.xd_sph_harm_coeff.values, coeff)
+    # The cache is bounded, with the least recently used matrices discarded
+    for degree in range(4, 13):
+        librad._sph_harm_fit_matrix(degree, rad_env.pza.values, rad_env.paz.values)
+    assert len(librad._sph_harm_matrix_cache) == librad._sph_harm_matrix_cache.maxsize
+    assert librad._sph_harm_fit_matrix(12, rad_env.pza.values, rad_env.paz.values)[2].shape == (169, 256)
+    assert librad._sph_harm_matrix_cache.hits == 3
+
+
+def make_hyper_radenv(**kwargs):
+    """ Create a HyperRadEnv from the example case with sza and albedo hyper axes and attach synthetic REMs in which
+    the radiance is linear in both the sza and the albedo.
+    """
+    hyper_rem = librad.HyperRadEnv(librad.Case(filename=example_inp), 8, 8,
+                                   {'sza': [0.0, 30.0, 60.0], 'albedo': [0.1, 0.3]}, **kwargs)
+    for i_hyper, (albedo, sza) in enumerate([(albedo, sza) for albedo in [0.1, 0.3] for sza in [0.0, 30.0, 60.0]]):
+        radenv = hyper_rem.radenvs[i_hyper]
+        options = radenv.base_case.options
+        assert radenv.base_case.tokens[options.index('albedo')] == [str(albedo)]
+        assert radenv.base_case.tokens[options.index('sza')] == [str(sza)]
+        radenv_reference = make_radenv(angular=lambda pza, paz: smooth_angular(pza, paz) * (1.0 + albedo) +
+                                       sza / 60.0)
+        radenv.xd_uu = radenv_reference.xd_uu
+        radenv.fluxline = []
+        radenv.irrad_units = ''
+    hyper_rem._assemble_hyper()
+    return hyper_rem
+
+
+def test_hyper_radenv_setup(monkeypatch):
+    init_calls = []
+    radenv_init = librad.RadEnv.__init__
+
+    def counted_init(self, *args, **kwargs):
+        init_calls.append(kwargs.get('n_workers'))
+        radenv_init(self, *args, **kwargs)
+    monkeypatch.setattr(librad.RadEnv, '__init__', counted_init)
+    hyper_rem = librad.HyperRadEnv(librad.Case(filename=example_inp), 8, 8,
+                                   {'sza': [0.0, 30.0, 60.0], 'albedo': [0.1, 0.3]}, batching='optimal',
+                                   n_workers=12, hemi=True)
+    # Only the RadEnvs of the hyper axis combinations set up cases, each batched for all the workers
+    assert init_calls == [12] * 6
+    assert hyper_rem.hyper_names == ['albedo', 'sza'] and hyper_rem.hyper_shape == (2, 3)
+    assert hyper_rem.cases == [] and hyper_rem.casechain == []
+    monkeypatch.setattr(librad.RadEnv, '__init__', radenv_init)
+    radenv = librad.RadEnv(librad.Case(filename=example_inp), 8, 8, hemi=True, batching='optimal', n_workers=12)
+    assert len(hyper_rem.radenvs[0].casechain) == len(radenv.casechain)
+    assert np.array_equal(hyper_rem.pza.values, radenv.pza.values)
+    assert np.array_equal(hyper_rem.paz.values, radenv.paz.values)
+    assert hyper_rem.hemi and hyper_rem.levels_out_type == radenv.levels_out_type
+
+
+def test_interp_hyper():
+    hyper_rem = make_hyper_radenv()
+    xd_uu = hyper_rem.xd_uu
+    assert xd_uu.dims == ('albedo', 'sza', 'pza', 'paz', 'wvl', 'zout', 'stokes')
+    reference = make_radenv().xd_uu.values
+    spectral = np.linspace(1.0, 2.0, 5)[:, np.newaxis, np.newaxis]
+
+    def expected(albedo, sza):
+        return reference * (1.0 + albedo) + sza / 60.0 * spectral
+    # The radiance is linear in the hyper axes, so multilinear interpolation is exact
+    xd_point = hyper_rem.interp_hyper(sza=45.0, albedo=0.15)
+    assert xd_point.dims == ('pza', 'paz', 'wvl', 'zout', 'stokes')
+    assert float(xd_point['sza']) == 45.0 and float(xd_point['albedo']) == 0.15
+    assert np.allclose(xd_point.values, expected(0.15, 45.0))
+    # Array points, in the leading hyper_point dimension
+    xd_points = hyper_rem.interp_hyper(sza=np.array([0.0, 10.0, 60.0]), albedo=0.3)
+    assert xd_points.dims == ('hyper_point', 'pza', 'paz', 'wvl', 'zout', 'stokes')
+    for i_point, sza in enumerate([0.0, 10.0, 60.0]):
+        assert np.allclose(xd_points.values[i_point], expected(0.3, sza))
+    # Hyper axes not given are retained
+    xd_sza = hyper_rem.interp_hyper(sza=15.0)
+    assert xd_sza.dims == ('albedo', 'pza', 'paz', 'wvl', 'zout', 'stokes')
+    assert np.allclose(xd_sza.values[1], expected(0.3, 15.0))
+    # Outside the hyper axes
+    assert np.all(np.isnan(hyper_rem.interp_hyper(sza=75.0, albedo=0.2).values))
+    assert np.all(hyper_rem.interp_hyper(sza=75.0, albedo=0.2, fill_value=0.0).values == 0.0)
+    with pytest.raises(ValueError):
+        hyper_rem.interp_hyper(sur_temperature=300.0)
+
+
+def synthetic_case_radiance(case, angular=smooth_angular, wvl=(300.0, 320.0, 340.0)):
+    """ Attach a synthetic spectral radiance to a case, at the sightlines of its umu and phi options.
+    """
+    pza = np.arccos(np.array(case.tokens[case.options.index('umu')], dtype=np.float64))
+    paz = np.deg2rad(np.array(case.tokens[case.options.index('phi')], dtype=np.float64))
+    uu = angular(pza[:, np.newaxis], paz[np.newaxis, :])[:, :, np.newaxis] * (np.asarray(wvl) / 300.0)
+    case.xd_uu = xr.DataArray(uu[..., np.newaxis, np.newaxis],
+                              [xd_identity(pza, 'pza'), xd_identity(paz, 'paz'), xd_identity(np.asarray(wvl), 'wvl'),
+                               xd_identity([0.0], 'zout'), xd_identity([0], 'stokes')],
+                              name='specrad', attrs={'units': 'W/m^2/sr/nm'})
+    case.uu = uu
+    case.fluxline = []
+    case.fluxdata = np.array([])
+
+
+def test_healpix_pixel_case_mapping():
+    hp = pytest.importorskip('healpy')
+    nside, mxumu, mxphi = 4, 5, 7
+    rad_env = librad.HealpixRadEnv(librad.Case(filename=example_inp), nside, mxumu=mxumu, mxphi=mxphi)
+    assert rad_env.npix == hp.nside2npix(nside) and len(rad_env.case_pixels) == len(rad_env.casechain)
+    pixel_weight = np.zeros(rad_env.npix)
+    n_sightlines = 0
+    for case, (pixels, row_weight) in zip(rad_env.casechain, rad_env.case_pixels):
+        umu = np.array(case.tokens[case.options.index('umu')], dtype=np.float64)
+        phi = np.array(case.tokens[case.options.index('phi')], dtype=np.float64)
+        assert pixels.shape == (umu.size, phi.size) and row_weight.size == umu.size
+        assert umu.size <= mxumu and phi.size <= mxphi and np.all(np.diff(umu) > 0.0)
+        assert not np.any(umu == 0.0)
+        # The sightlines of the case are the centres of the pixels they are attributed to
+        pixel_pza, pixel_paz = hp.pix2ang(nside, pixels)
+        assert np.allclose(np.rad2deg(pixel_paz), phi[np.newaxis, :])
+        horizontal = row_weight == 0.5
+        assert np.allclose(np.cos(pixel_pza[~horizontal, 0]), umu[~horizontal])
+        assert np.allclose(pixel_pza[horizontal], np.pi / 2.0)
+        assert np.allclose(np.abs(umu[horizontal]), rad_env.horizon_umu)
+        np.add.at(pixel_weight, pixels, row_weight[:, np.newaxis])
+        n_sightlines += pixels.size
+    # Every pixel is covered exactly once and only the horizontal ring is computed twice
+    assert np.allclose(pixel_weight, 1.0)
+    n_horizontal = np.sum(np.isclose(hp.pix2ang(nside, np.arange(rad_env.npix))[0], np.pi / 2.0))
+    assert n_sightlines == rad_env.npix + n_horizontal
+    # Assembly places the radiance of each sightline at its pixel
+    for case in rad_env.casechain:
+        synthetic_case_radiance(case)
+    rad_env._assemble_radiance()
+    xd_uu_hpx = rad_env.xd_uu_hpx
+    assert xd_uu_hpx.dims == ('hpx', 'wvl', 'zout', 'stokes')
+    expected = smooth_angular(rad_env.hpx_pza.values, rad_env.hpx_paz.values)
+    assert np.allclose(xd_uu_hpx.values[:, 0, 0, 0], expected)
+    assert np.allclose(xd_uu_hpx.values[:, 2, 0, 0], expected * 340.0 / 300.0)
+    assert np.array_equal(xd_uu_hpx['pza'].values, rad_env.hpx_pza.values)
@@ -0,0 +1,217 @@
+__author__ = 'DGriffith'
+
+""" Tests of the .flt file parser, the FilterCatalogue and the spectral projection tools in morticia.rad.radute.
+Run with `python -m pytest` from the repository root.
+"""
+
+import os
+import numpy as np
+import pytest
+from morticia.rad import radute
+
+
+@pytest.fixture
+def cache_home(tmpdir, monkeypatch):
+    """ Direct the user cache folder to a temporary folder.
+    """
+    cache_home = tmpdir.mkdir('cache')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(cache_home))
+    return cache_home
+
+
+def write_flt(tmpdir, units_header, filters, name='test.flt'):
+    """ Write a .flt file with the given units header ('N', 'M' or 'W') and a list of (header, data) filters.
+    """
+    lines = [units_header + ' Test filters']
+    for header, data in filters:
+        lines.append(header)
+        lines.extend(['  %f  %f' % tuple(row) for row in data])
+    flt_file = tmpdir.join(name)
+    flt_file.write('\n'.join(lines) + '\n')
+    return str(flt_file)
+
+
+def test_flt_read_nm(tmpdir, cache_home):
+    data = [np.array([[500.0, 0.1], [550.0, 1.0], [600.0, 0.2]]), np.array([[700.0, 0.5], [800.0, 0.7]])]
+    flt = radute.Flt(write_flt(tmpdir, 'N', [('Band 1', data[0]), ('Band 2', data[1])]))
+    assert flt.units == 'nm' and flt.nfilters == 2
+    assert flt.filterheaders == ['Band 1', 'Band 2']
+    for filter_read, filter_data in zip(flt.filters, data):
+        # Columns are wavelength in nm, filter value, wavenumber per cm and wavelength in microns
+        expected = np.vstack((filter_data[:, 0], filter_data[:, 1], 1.0e7 / filter_data[:, 0],
+                              filter_data[:, 0] / 1000.0)).T
+        assert np.allclose(filter_read, expected)
+
+
+def test_flt_read_wavenumber_and_micron_units(tmpdir, cache_home):
+    # Regression test for the unit conversions of W (wavenumber) and M (micron) files. The original reader took
+    # the wavelength of W files from the filter value column and converted microns to wavenumber with 1e9.
+    wvn_data = np.array([[10000.0, 0.1], [12500.0, 0.9], [20000.0, 0.4]])
+    flt = radute.Flt(write_flt(tmpdir, 'W', [('Wavenumber band', wvn_data)], name='wvn.flt'))
+    assert flt.units == 'cm^-1'
+    expected = np.vstack((1.0e7 / wvn_data[:, 0], wvn_data[:, 1], wvn_data[:, 0], 1.0e4 / wvn_data[:, 0])).T
+    assert np.allclose(flt.filters[0], expected)
+    assert np.allclose(flt.filters[0][:, 0], [1000.0, 800.0, 500.0])
+    um_data = np.array([[0.5, 0.1], [0.8, 0.9], [1.0, 0.4]])
+    flt = radute.Flt(write_flt(tmpdir, 'M', [('Micron band', um_data)], name='um.flt'))
+    expected = np.vstack((1000.0 * um_data[:, 0], um_data[:, 1], 1.0e4 / um_data[:, 0], um_data[:, 0])).T
+    assert np.allclose(flt.filters[0], expected)
+    assert np.allclose(flt.filters[0][:, 2], [20000.0, 12500.0, 10000.0])
+
+
+def test_flt_sidecar_cache(tmpdir, cache_home, monkeypatch):
+    data = np.array([[500.0, 0.1], [550.0, 1.0], [600.0, 0.2]])
+    flt_filename = write_flt(tmpdir, 'N', [('Band 1', data)])
+    flt = radute.Flt(flt_filename)
+    # The sidecar is written to the user cache folder, not next to the .flt file
+    cache_filename = radute.Flt._cache_filename(flt_filename)
+    assert os.path.dirname(cache_filename) == os.path.join(str(cache_home), 'morticia')
+    assert os.path.isfile(cache_filename)
+    assert sorted(os.listdir(str(tmpdir))) == ['cache', 'test.flt']
+    assert radute.Flt._cache_filename(os.path.relpath(flt_filename)) == cache_filename
+    # Subsequent reads come from the sidecar, without parsing the .flt file
+    parse = radute.Flt._parse
+
+    def no_parse(filename):
+        raise AssertionError('Flt file parsed although the sidecar file is valid.')
+    monkeypatch.setattr(radute.Flt, '_parse', staticmethod(no_parse))
+    flt_cached = radute.Flt(flt_filename)
+    assert flt_cached.filterheaders == flt.filterheaders
+    assert np.array_equal(flt_cached.filters[0], flt.filters[0])
+    monkeypatch.setattr(radute.Flt, '_parse', staticmethod(parse))
+    # A truncated sidecar (e.g. from an interrupted run) is ignored and replaced
+    with open(cache_filename, 'rb') as cache_file:
+        cache_content = cache_file.read()
+    with open(cache_filename, 'wb') as cache_file:
+        cache_file.write(cache_content[:len(cache_content) // 2])
+    flt_reparsed = radute.Flt(flt_filename)
+    assert np.array_equal(flt_reparsed.filters[0], flt.filters[0])
+    assert radute.Flt._read_cache(flt_filename) is not None
+    assert not [name for name in os.listdir(os.path.dirname(cache_filename)) if name.endswith('.tmp')]
+    # A changed .flt file is parsed again
+    write_flt(tmpdir, 'N', [('Band 1', data), ('Band 2', data + [100.0, 0.0])])
+    os.utime(flt_filename, (os.stat(flt_filename).st_atime, os.stat(flt_filename).st_mtime + 10.0))
+    assert radute.Flt(flt_filename).nfilters == 2
+
+
+def test_flt_bundled_file_leaves_package_tree_clean(cache_home):
+    flt_filename = os.path.join(os.path.dirname(os.path.abspath(radute.__file__)), 'radata', 'CIEXYZ2.flt')
+    flt = radute.Flt(flt_filename)
+    assert flt.nfilters == 3
+    assert not os.path.exists(flt_filename + '.npz')
+    assert os.path.isfile(radute.Flt._cache_filename(flt_filename))
+
+
+def write_filter_folder(folder):
+    """ Write a small filter folder, with one sensor of two channels and a file having two response columns.
+    """
+    series_folder = folder.mkdir('testsat')
+    series_folder.join('testsat1_cam_b1').write('# Test channel 1\n400 0.0\n450 1.0\n500 0.0\n')
+    series_folder.join('testsat1_cam_b2').write('# Test channel 2\n480 0.0\n520 0.5\n560 1.0\n600 0.0\n')
+    series_folder.join('testsat2_b1').write('400 0.0 0.0\n500 1.0 0.5\n600 0.0 1.0\n')
+    return series_folder
+
+
+def test_filter_catalogue_build_and_reload(tmpdir, cache_home, monkeypatch):
+    folder = tmpdir.mkdir('filter')
+    write_filter_folder(folder)
+    catalogue = radute.FilterCatalogue(str(folder))
+    # Catalogue files go to the user cache folder, not the filter folder
+    assert os.path.dirname(catalogue.index_filename) == os.path.join(str(cache_home), 'morticia')
+    assert os.path.isfile(catalogue.data_filename) and os.path.isfile(catalogue.index_filename)
+    assert sorted(os.listdir(str(folder))) == ['testsat']
+    assert catalogue.sensors() == [('testsat', 'testsat1', 'cam'), ('testsat', 'testsat2', '')]
+    assert catalogue.find('testsat1_cam_b[12]') == [('testsat', 'testsat1', 'cam', 'b1'),
+                                                    ('testsat', 'testsat1', 'cam', 'b2')]
+    wvl, response = catalogue.channel_data('testsat', 'testsat1', 'cam', 'b2')
+    assert np.array_equal(wvl, [480.0, 520.0, 560.0, 600.0]) and np.array_equal(response, [0.0, 0.5, 1.0, 0.0])
+    wvl, response = catalogue.channel_data('testsat', 'testsat2', '', 'b1', column=1)
+    assert np.array_equal(response, [0.0, 0.5, 1.0])
+    with pytest.raises(ValueError):
+        catalogue.channel_data('testsat', 'testsat1', 'cam', 'b3')
+    xd_sensor = catalogue.sensor('testsat', 'testsat1', 'cam')
+    assert xd_sensor.dims == ('wvl', 'chn') and xd_sensor['chn'].attrs['labels'] == ['b1', 'b2']
+    # Reopening uses the memory-mapped catalogue files, without parsing the filter files
+    monkeypatch.setattr(radute.np, 'loadtxt', None)
+    reopened = radute.FilterCatalogue(str(folder))
+    assert isinstance(reopened.data, np.memmap)
+    assert reopened.entries == catalogue.entries
+    assert np.array_equal(reopened.channel_data('testsat', 'testsat1', 'cam', 'b2')[1], [0.0, 0.5, 1.0, 0.0])
+
+
+def test_filter_catalogue_invalidation(tmpdir, cache_home):
+    folder = tmpdir.mkdir('filter')
+    series_folder = write_filter_folder(folder)
+    catalogue = radute.FilterCatalogue(str(folder))
+    assert not catalogue.find('b3')
+    # Adding a filter file changes the signature and the catalogue is rebuilt
+    series_folder.join('testsat1_cam_b3').write('600 0.0\n650 1.0\n700 0.0\n')
+    catalogue = radute.FilterCatalogue(str(folder))
+    assert catalogue.find('b3') == [('testsat', 'testsat1', 'cam', 'b3')]
+    # A rebuild can be forced, in which case the filter files are parsed again
+    index_mtime = os.stat(catalogue.index_filename).st_mtime
+    os.utime(catalogue.index_filename, (index_mtime - 100.0, index_mtime - 100.0))
+    radute.FilterCatalogue(str(folder), rebuild=True)
+    assert os.stat(catalogue.index_filename).st_mtime > index_mtime - 100.0
+    # Another filter folder sharing the cache folder is not served from the cached catalogue
+    other_folder = tmpdir.mkdir('other')
+    other_folder.mkdir('othersat').join('othersat1_b1').write('400 1.0\n500 1.0\n')
+    assert radute.FilterCatalogue(str(other_folder)).sensors() == [('othersat', 'othersat1', '')]
+    # Corrupt catalogue files are rebuilt
+    with open(catalogue.index_filename, 'wb') as index_file:
+        index_file.write(b'corrupt')
+    assert radute.FilterCatalogue(str(folder)).find('b3') == [('testsat', 'testsat1', 'cam', 'b3')]
+
+
+def test_filter_catalogue_radata(tmpdir):
+    catalogue = radute.FilterCatalogue(cache_folder=str(tmpdir))
+    assert ('landsat', 'landsat7', 'etm') in catalogue.sensors()
+    wvl, response = catalogue.channel_data('landsat', 'landsat7', 'etm', 'b4')
+    flt_data = np.loadtxt(os.path.join(radute.filter_folder, 'landsat', 'landsat7_etm_b4'), comments='#')
+    assert np.array_equal(wvl, flt_data[:, 0]) and np.array_equal(response, flt_data[:, 1])
+
+
+def make_srf_and_radiance():
+    """ Two SRFs with unsorted wavelengths and two spectral radiances on a finer wavelength grid.
+    """
+    srf_wvl = np.array([520., 500, 540, 560, 580, 600])
+    srf = np.array([[0.5, 0.0, 1.0, 0.8, 0.2, 0.0], [0.0, 0.0, 0.0, 0.3, 1.0, 0.6]])
+    xd_srf = radute.xr.DataArray(srf.T, [radute.xd_identity(srf_wvl, 'wvl'), ('chn', [0, 1])], name='srf')
+    wvl = np.linspace(480.0, 620.0, 57)
+    radiance = np.vstack([np.exp(-((wvl - 550.0) / 40.0) ** 2), np.linspace(1.0, 2.0, wvl.size)])
+    return srf_wvl, srf, xd_srf, wvl, radiance
+
+
+def test_srf_projection_matches_band_integral():
+    trapz = getattr(np, 'trapz', None) or np.trapezoid
+    srf_wvl, srf, xd_srf, wvl, radiance = make_srf_and_radiance()
+    order = np.argsort(srf_wvl)
+    for normalise in [False, True]:
+        matrix = radute.srf_projection_matrix(xd_srf, wvl, normalise=normalise)
+        for i_chn in range(2):
+            srf_at_wvl = np.interp(wvl, srf_wvl[order], srf[i_chn, order], left=0.0, right=0.0)
+            expected = trapz(srf_at_wvl * radiance, wvl, axis=1)
+            if normalise:
+                expected /= trapz(srf_at_wvl, wvl)
+            assert np.allclose(matrix.dot(radiance.T)[i_chn], expected, rtol=1.0e-12)
+
+
+def test_project_onto_srf_units():
+    srf_wvl, srf, xd_srf, wvl, radiance = make_srf_and_radiance()
+    xd_radiance = radute.xr.DataArray(radiance.T, [radute.xd_identity(wvl, 'wvl'), ('pza', [0.0, 1.0])],
+                                      name='specrad', attrs={'units': 'W/m^2/sr/nm', 'long_name': 'Spectral Radiance'})
+    band = radute.project_onto_srf(xd_radiance, xd_srf)
+    assert band.dims == ('chn', 'pza') and band.name == 'rad'
+    assert band.attrs['units'] == 'W/m^2/sr' and band.attrs['long_name'] == 'Radiance'
+    assert xd_radiance.attrs['units'] == 'W/m^2/sr/nm'
+    # The SRF-weighted mean is still a spectral quantity
+    band_mean = radute.project_onto_srf(xd_radiance, xd_srf, normalise=True)
+    assert band_mean.name == 'specrad' and band_mean.attrs == xd_radiance.attrs
+    # A quantity that is not per unit wavelength is multiplied by the wavelength units, as are any SRF units
+    xd_srf.attrs['units'] = 'A/W'
+    xd_reflectance = radute.xr.DataArray(radiance.T, xd_radiance.coords, name='refl',
+                                         attrs={'units': '1', 'long_name': 'Reflectance'})
+    band = radute.project_onto_srf(xd_reflectance, xd_srf)
+    assert band.name == 'refl' and band.attrs['long_name'] == 'Band-integrated Reflectance'
+    assert band.attrs['units'] == '(1)*nm*(A/W)'
+    assert radute.ureg(band.attrs['units']).dimensionality == radute.ureg('nm*A/W').dimensionality
@@ -31,6 +31,8 @@ import warnings
 import mitsuba.core as mitcor
 import mitsuba.render as mitren
 import re
+import hashlib
+import tempfile
 # Read the Mitsuba manual section on Python integration. On windows it is necessary to explicitly specify the location
 # of the Mitsuba installation as follows:
 
@@ -89,6 +91,55 @@ default_samples = 16  # Default number of samples for Mitsuba renders
 # Get a global Mitsuba plugin manager
 plugin_mngr = mitcor.PluginManager.getInstance()
 
+
+def _prune_envmap_cache(cache_folder, max_cache_files, keep=None):
+    """
+    Delete the least recently used REM OpenEXR files in an envmap cache folder, leaving at most max_cache_files.
+    Files that cannot be deleted (e.g. in use, or deleted by another process) are skipped.
+    :param cache_folder: The cache folder (see Scene.add_radiant_environment_map_from_radenv).
+    :param max_cache_files: Maximum number of REM files to keep.
+    :param keep: Filename of a REM file that must not be deleted.
+    :return: None
+    """
+    rem_files = []
+    for filename in os.listdir(cache_folder):
+        if filename.startswith('rem_') and filename.endswith('.exr'):
+            filename = os.path.join(cache_folder, filename)
+            try:
+                rem_files.append((os.stat(filename).st_mtime, filename))
+            except OSError:
+                pass
+    rem_files.sort()
+    for mtime, filename in rem_files[:max(len(rem_files) - max_cache_files, 0)]:
+        if filename != keep:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+def rem_bitmap(image):
+    """
+    Create a Mitsuba bitmap from a radiant environment map image held in memory.
+    :param image: Numpy array of shape (height, width, n_channels), such as returned by `librad.RadEnv.envmap_image`.
+    :return: mitsuba.core.Bitmap with float32 components. One channel gives a luminance bitmap and three channels
+    an RGB bitmap. If the number of channels is equal to SPECTRUM_SAMPLES, a spectral bitmap is created, otherwise
+    a multi-channel bitmap.
+    """
+    n_channels = image.shape[2]
+    if n_channels == 1:
+        pixel_format = mitcor.Bitmap.ELuminance
+    elif n_channels == 3:
+        pixel_format = mitcor.Bitmap.ERGB
+    elif n_channels == SPECTRUM_SAMPLES:
+        pixel_format = mitcor.Bitmap.ESpectrum
+    else:
+        pixel_format = mitcor.Bitmap.EMultiChannel
+    bitmap = mitcor.Bitmap(pixel_format, mitcor.Bitmap.EFloat32, mitcor.Vector2i(image.shape[1], image.shape[0]),
+                           n_channels)
+    bitmap.fromByteArray(bytearray(np.ascontiguousarray(image, dtype=np.float32).data))
+    return bitmap
+
 class Transform(object):
     """
     Encapsulates transformation objects for moving and rotating Mitsuba scene components
@@ -2157,13 +2208,36 @@ class Scene(object):
         """
         if self.hasEnvironmentEmitter():
             warnings.warn('Mitsuba scene already has a radiant environment emitter. Only one is permitted.')
+        toWorld = self._rem_toWorld(toWorld, saz)
+        envmap = self._create_envmap(self.fileResolver.resolve(filename), toWorld, scale, gamma, cache, samplingWeight)
+        self.scene.addChild('environment', envmap)
+
+    @staticmethod
+    def _rem_toWorld(toWorld=None, saz=0.0):
+        """
+        Compute the transformation of a radiant environment map (see Scene.add_radiant_environment_map).
+        :param toWorld: Transformation of the environment map. If None, the REM is rotated so that the zenith is
+        along the Z-axis.
+        :param saz: Solar azimuth angle in degrees.
+        :return: Transform
+        """
         if toWorld is None:  # Generate the default REM rotation, which is +Z towards the zenith
             toWorld = Transform()  # Get identity transform
             toWorld.rotate((1.0, 0.0, 0.0), 90.0)  # Rotate by 90 degrees about the x-axis
         if saz != 0.0:
             toWorld.rotate((0.0, 0.0, 1.0), saz)  # Rotate by solar azimuth about the new z-axis
+        return toWorld
+
+    @staticmethod
+    def _create_envmap(filename, toWorld, scale=1.0, gamma=1.0, cache=None, samplingWeight=1.0):
+        """
+        Create and configure a Mitsuba envmap emitter from a file.
+        :param filename: Resolved filename of the REM.
+        :param toWorld: Transform of the environment map.
+        :return: The configured envmap emitter.
+        """
         envmap_props = mitcor.Properties('envmap')
-        envmap_props['filename'] = self.fileResolver.resolve(filename)
+        envmap_props['filename'] = filename
         envmap_props['scale'] = scale
         envmap_props['toWorld'] = toWorld.xform
         envmap_props['gamma'] = gamma
@@ -2172,7 +2246,68 @@ class Scene(object):
         envmap_props['samplingWeight'] = samplingWeight
         envmap = plugin_mngr.createObject(envmap_props)
         envmap.configure()
+        return envmap
+
+    def add_radiant_environment_map_from_radenv(self, radenv, i_zout=0, channels=None, saz=0.0, scale=1.0,
+                                                toWorld=None, cache=None, samplingWeight=1.0, cache_folder=None,
+                                                max_cache_files=32):
+        """
+        Add a radiant environment map (envmap) to a Mitsuba scene from a `librad.RadEnv` held in memory, without
+        first writing OpenEXR files using `RadEnv.write_openexr`.
+        This is still a file hand-off: the Mitsuba envmap plugin only reads the REM from a file, so the REM is passed
+        through a content-hashed OpenEXR file cache. The REM slice (level and spectral channels) is converted to a
+        Mitsuba bitmap in memory and written once to an OpenEXR file named by a hash of the REM content in the cache
+        folder. The file is written under a temporary name and renamed, so that concurrent processes never read a
+        partly written file. Later calls with the same REM (e.g. batch rendering over many scenes) reuse the file.
+        A new envmap emitter is created for each scene, which reads the file when it is created.
+        The cache holds at most `max_cache_files` REM files. The least recently used files are deleted when the
+        limit is exceeded. The cache folder can also be deleted at any time that no scenes are being set up.
+        :param radenv: librad.RadEnv object which has been run.
+        :param i_zout: Index of the REM output level. Default 0.
+        :param channels: List of spectral channel indices of the REM to use. Default is the first three channels.
+        The number of channels should be 3 for RGB Mitsuba, or SPECTRUM_SAMPLES for spectral Mitsuba.
+        :param saz: Solar azimuth angle in degrees. See Scene.add_radiant_environment_map.
+        :param scale: Scale the REM by this scalar value. Radiance in mW units is converted to W before scaling.
+        :param toWorld: Transformation of the environment map. See Scene.add_radiant_environment_map.
+        :param cache: Set True to force MIP mapping of the REM and False to inhibit. Default is automatic.
+        :param samplingWeight: Relative weight to assign to this emitter. Default is 1.0.
+        :param cache_folder: Folder for cached OpenEXR files. Default is the folder morticia_envmaps in the system
+        temporary folder.
+        :param max_cache_files: Maximum number of REM files kept in the cache folder. Default 32.
+        :return: The hash of the REM content, which identifies the cached OpenEXR file.
+        """
+        if self.hasEnvironmentEmitter():
+            warnings.warn('Mitsuba scene already has a radiant environment emitter. Only one is permitted.')
+        toWorld = self._rem_toWorld(toWorld, saz)
+        image = radenv.envmap_image(i_zout=i_zout, channels=channels, dtype=np.float32, watts=True)
+        rem_hash = hashlib.sha1(str(image.shape).encode('ascii') + image.tobytes()).hexdigest()
+        if cache_folder is None:
+            cache_folder = os.path.join(tempfile.gettempdir(), 'morticia_envmaps')
+        if not os.path.isdir(cache_folder):
+            os.makedirs(cache_folder)
+        exr_filename = os.path.join(cache_folder, 'rem_' + rem_hash + '.exr')
+        if os.path.isfile(exr_filename):
+            os.utime(exr_filename, None)  # Mark as recently used
+        else:
+            exr_fd, tmp_filename = tempfile.mkstemp(suffix='.tmp', prefix='rem_' + rem_hash + '_', dir=cache_folder)
+            os.close(exr_fd)
+            try:
+                exr_stream = mitcor.FileStream(tmp_filename, mitcor.FileStream.ETruncWrite)
+                rem_bitmap(image).write(mitcor.Bitmap.EOpenEXR, exr_stream)
+                exr_stream.close()
+                try:
+                    os.rename(tmp_filename, exr_filename)
+                except OSError:
+                    # On Windows, rename fails if another process has written the same REM in the meantime
+                    if not os.path.isfile(exr_filename):
+                        raise
+            finally:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+        envmap = self._create_envmap(exr_filename, toWorld, scale, 1.0, cache, samplingWeight)
         self.scene.addChild('environment', envmap)
+        _prune_envmap_cache(cache_folder, max_cache_files, keep=exr_filename)
+        return rem_hash
 
 
     def render_local(self, jobname=None, destinationfile=None, nworkers=None):
@@ -0,0 +1,34 @@
+__author__ = 'DGriffith'
+
+""" Tests of the unit conversion tools in morticia.moglo. Run with `python -m pytest` from the repository root.
+"""
+
+import numpy as np
+import pytest
+from morticia import Q_
+from morticia import moglo
+
+
+@pytest.mark.parametrize('from_units, to_units', [('degF', 'K'), ('K', 'degF'), ('degC', 'degF'), ('degF', 'degC'),
+                                                  ('degC', 'K'), ('km', 'm'), ('W/m^2/sr/nm', 'mW/cm^2/sr/um'),
+                                                  ('cm^-1', 'm^-1'), ('deg', 'rad')])
+def test_convert_units_matches_pint(from_units, to_units):
+    moglo.unit_conversion_cache_clear()
+    values = np.array([-40.0, 0.0, 1.0, 37.5, 300.0, 1000.0, 1.0e5])
+    expected = Q_(values, from_units).to(to_units).magnitude
+    for i_pass in range(2):  # The second pass uses the cached conversion factors
+        converted = moglo.convert_units(values, from_units, to_units)
+        assert np.allclose(converted, expected, rtol=1.0e-14, atol=1.0e-12)
+        assert (from_units, to_units) in moglo._unit_conversion_cache
+
+
+def test_convert_units_offset_precision():
+    # The scale for units with an offset was once computed as the difference of the converted values of 1 and 0,
+    # which gave 810.9277777777652 for 1000 degF
+    moglo.unit_conversion_cache_clear()
+    assert moglo.convert_units(1000.0, 'degF', 'K') == Q_(1000.0, 'degF').to('K').magnitude
+    scale, offset = moglo._unit_conversion_cache[('degF', 'K')]
+    assert abs(scale - 5.0 / 9.0) < 1.0e-15
+    values = np.array([1.0, 2.0])
+    converted = moglo.convert_units(values, 'degC', 'degC')
+    assert np.array_equal(converted, values) and converted is not values
@@ -0,0 +1,230 @@
+__author__ = 'DGriffith'
+
+""" Regression tests for the interpolation, product and basis tools in morticia.tools.xd, checked against the
+original (scipy-based) implementations where these existed.
+Run with `python -m pytest` from the repository root.
+"""
+
+import numpy as np
+import xarray as xray
+import scipy.interpolate as interp
+import pytest
+from functools import reduce
+from operator import mul
+from morticia.tools.xd import *
+
+trapz = getattr(np, 'trapz', None) or np.trapezoid
+
+
+def old_harmonise_interp(xd_list):
+    """ Original implementation of xd_harmonise_interp using scipy.interpolate.RegularGridInterpolator. Axes are
+    first sorted, since the RegularGridInterpolator requires monotonic coordinates.
+    """
+    index_vals = {}
+    for xd_arr in xd_list:
+        for axis in xd_arr.dims:
+            index_vals[axis] = np.unique(np.hstack((index_vals.get(axis, []), xd_arr[axis].values)))
+    xd_return_list = []
+    for xd_arr in xd_list:
+        xd_arr = xd_arr.sortby(list(xd_arr.dims))
+        interpolator = interp.RegularGridInterpolator([xd_arr[axis].values for axis in xd_arr.dims], xd_arr.values,
+                                                      method='linear', bounds_error=False, fill_value=0.0)
+        merged_coordinates = np.meshgrid(*[index_vals[axis] for axis in xd_arr.dims], indexing='ij')
+        xd_return_list.append(xray.DataArray(interpolator(tuple(merged_coordinates)),
+                                             [(axis, index_vals[axis]) for axis in xd_arr.dims], name=xd_arr.name))
+    return xd_return_list
+
+
+def make_xd(data, coords, name='trn'):
+    """ Build a DataArray with (default) units on each axis, as required by xd_harmonised_product.
+    """
+    return xray.DataArray(data, [xd_identity(np.asarray(values, dtype=np.float64), axis)
+                                 for axis, values in coords], name=name)
+
+
+@pytest.fixture
+def xd_factors():
+    """ Three DataArrays on different, partly overlapping grids, with ascending, descending and unsorted axes.
+    """
+    rng = np.random.RandomState(1)
+    xd_a = make_xd(rng.rand(7, 5), [('wvl', [400., 450, 475, 500, 600, 650, 700]), ('pza', [80., 60, 45, 20, 0])])
+    xd_b = make_xd(rng.rand(6), [('wvl', [620., 410, 560, 480, 705, 520])])
+    xd_c = make_xd(rng.rand(4, 3), [('pza', [10., 30, 50, 70]), ('paz', [0., 90, 180])])
+    return xd_a, xd_b, xd_c
+
+
+def test_harmonise_interp_matches_old(xd_factors):
+    new_list = xd_harmonise_interp(xd_factors)
+    for xd_new, xd_old in zip(new_list, old_harmonise_interp(xd_factors)):
+        assert xd_new.dims == xd_old.dims
+        for axis in xd_new.dims:
+            assert np.array_equal(xd_new[axis].values, xd_old[axis].values)
+        assert np.allclose(xd_new.values, xd_old.values, rtol=1.0e-12, atol=1.0e-12)
+
+
+def test_interp_weights_cache_reuse(xd_factors):
+    interp_weights_cache_clear()
+    first_list = xd_harmonise_interp(xd_factors)
+    misses = interp_weights_cache_info()['misses']
+    assert misses > 0 and interp_weights_cache_info()['hits'] == 0
+    second_list = xd_harmonise_interp(xd_factors)  # Same grids, all tables come from the cache
+    assert interp_weights_cache_info()['misses'] == misses
+    assert interp_weights_cache_info()['hits'] == misses
+    for xd_first, xd_second in zip(first_list, second_list):
+        assert np.array_equal(xd_first.values, xd_second.values)
+    # Cached tables are shared, and are therefore read-only
+    index, weight, in_bounds = axis_interp_weights_cached([1.0, 2.0, 4.0], [1.5, 3.0])
+    assert not (index.flags.writeable or weight.flags.writeable or in_bounds.flags.writeable)
+    assert axis_interp_weights_cached([1.0, 2.0, 4.0], [1.5, 3.0])[0] is index
+
+
+@pytest.mark.parametrize('fill_value', ['extrapolate', (-1.0, 2.0), 0.5])
+def test_interp_axis_to_fill_value(fill_value):
+    from_xd = make_xd([1.0, 3.0, 2.0, 5.0], [('wvl', [400., 450, 500, 550])])
+    to_xd = make_xd(np.zeros(5), [('wvl', [350., 425, 500, 560, 600])])
+    expected = interp.interp1d(from_xd['wvl'].values, from_xd.values, bounds_error=False,
+                               fill_value=fill_value)(to_xd['wvl'].values)
+    xd_new = xd_interp_axis_to(from_xd, to_xd, 'wvl', fill_value=fill_value)
+    assert np.allclose(xd_new.values, expected, rtol=1.0e-12, atol=1.0e-12)
+
+
+@pytest.mark.parametrize('order', ['ascending', 'descending', 'unsorted'])
+@pytest.mark.parametrize('interp_method', ['linear', 'nearest', 'cubic'])
+def test_interp_axis_to_matches_interp1d(order, interp_method):
+    rng = np.random.RandomState(2)
+    from_wvl = np.array([400., 430, 470, 520, 560, 610, 650, 700])
+    if order == 'descending':
+        from_wvl = from_wvl[::-1]
+    elif order == 'unsorted':
+        from_wvl = from_wvl[[3, 0, 6, 1, 7, 2, 5, 4]]
+    from_xd = make_xd(rng.rand(3, from_wvl.size), [('pza', [0., 45, 90]), ('wvl', from_wvl)])
+    to_xd = make_xd(np.zeros(6), [('wvl', [390., 410, 455, 555, 699, 720])])
+    expected = interp.interp1d(from_wvl, from_xd.values, kind=interp_method, axis=1, bounds_error=False,
+                               fill_value=0.0, assume_sorted=False)(to_xd['wvl'].values)
+    xd_new = xd_interp_axis_to(from_xd, to_xd, 'wvl', interp_method=interp_method, assume_sorted=(order == 'ascending'))
+    assert xd_new.dims == from_xd.dims
+    assert np.array_equal(xd_new['wvl'].values, to_xd['wvl'].values)
+    assert np.allclose(xd_new.values, expected, rtol=1.0e-12, atol=1.0e-12)
+    # Interpolation into a preallocated array
+    out = np.empty((3, 6))
+    xd_out = xd_interp_axis_to(from_xd, to_xd, 'wvl', interp_method=interp_method, assume_sorted=False, out=out)
+    assert xd_out.values is out or np.shares_memory(xd_out.values, out)
+    assert np.allclose(out, expected, rtol=1.0e-12, atol=1.0e-12)
+
+
+def test_interp_axis_to_out_checked():
+    from_xd = make_xd(np.arange(3.0 * 8).reshape(3, 8), [('pza', [0., 45, 90]),
+                                                          ('wvl', np.linspace(400.0, 700.0, 8))])
+    to_xd = make_xd(np.zeros(4), [('wvl', [410., 500, 555, 690])])
+    for out in [np.empty((3, 5)), np.empty((4, 3)), np.empty((3, 4), dtype=np.int64), np.empty((3, 4)).tolist()]:
+        with pytest.raises(ValueError):
+            xd_interp_axis_to(from_xd, to_xd, 'wvl', out=out)
+    read_only = np.empty((3, 4))
+    read_only.flags.writeable = False
+    with pytest.raises(ValueError):
+        xd_interp_axis_to(from_xd, to_xd, 'wvl', out=read_only)
+    out = np.empty((3, 4), dtype=np.float32)  # Floating point output of lower precision is allowed
+    xd_interp_axis_to(from_xd, to_xd, 'wvl', out=out)
+    assert np.allclose(out, xd_interp_axis_to(from_xd, to_xd, 'wvl').values, rtol=1.0e-6)
+
+
+def test_harmonised_product_matches_old(xd_factors):
+    xd_old = reduce(mul, old_harmonise_interp(xd_factors))  # Unfused product
+    xd_new = xd_harmonised_product(xd_factors)
+    assert np.allclose(xd_new.values, xd_old.transpose(*xd_new.dims).values, rtol=1.0e-12, atol=1.0e-12)
+    # Chunked computation gives the same result
+    xd_chunked = xd_harmonised_product(xd_factors, chunk_axis='wvl', chunk_size=3)
+    assert np.allclose(xd_chunked.values, xd_new.values, rtol=1.0e-12, atol=1.0e-12)
+    # Integration over wavelength, with and without chunking along the integration axis
+    wvl_axis = xd_old.get_axis_num('wvl')
+    old_integral = trapz(xd_old.values, xd_old['wvl'].values, axis=wvl_axis)
+    for chunk_axis in [None, 'wvl', 'pza']:
+        xd_integral = xd_harmonised_product(xd_factors, chunk_axis=chunk_axis, chunk_size=4, reduce_axis='wvl')
+        assert 'wvl' not in xd_integral.dims
+        old_dims = [axis for axis in xd_old.dims if axis != 'wvl']
+        expected = np.transpose(old_integral, [old_dims.index(axis) for axis in xd_integral.dims])
+        assert np.allclose(xd_integral.values, expected, rtol=1.0e-12, atol=1.0e-12)
+
+
+def traced_peak(func, *args, **kwargs):
+    """ Peak memory (bytes) allocated while calling a function, as traced by tracemalloc.
+    """
+    tracemalloc = pytest.importorskip('tracemalloc')
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak, result
+
+
+def test_harmonised_product_memory():
+    n_wvl, n_pza = 300, 400
+    full_size = n_wvl * n_pza * 8  # Bytes in one full-size float64 array
+    wvl = np.linspace(400.0, 700.0, n_wvl)
+    pza = np.linspace(0.0, 90.0, n_pza)
+    rng = np.random.RandomState(3)
+    # Factors already on the merged grid are not interpolated, and only the accumulator is allocated
+    xd_on_grid = [make_xd(rng.rand(n_wvl, n_pza), [('wvl', wvl), ('pza', pza)]) for i_factor in range(4)]
+    peak, xd_product = traced_peak(xd_harmonised_product, xd_on_grid)
+    assert peak < 1.2 * full_size
+    assert np.allclose(xd_product.values, reduce(mul, [xd_arr.values for xd_arr in xd_on_grid]))
+    # Factors each lacking one of the merged wavelengths must all be interpolated. At most one factor is
+    # interpolated at a time, the first interpolated factor being reused as the accumulator.
+    xd_off_grid = [make_xd(xd_arr.values[np.arange(n_wvl) != 10 * i_factor + 5],
+                           [('wvl', wvl[np.arange(n_wvl) != 10 * i_factor + 5]), ('pza', pza)])
+                   for i_factor, xd_arr in enumerate(xd_on_grid)]
+    interp_peak, xd_interp = traced_peak(xd_harmonise_interp, [xd_off_grid[0], xd_on_grid[0]])
+    del xd_interp
+    peak, xd_product = traced_peak(xd_harmonised_product, xd_off_grid)
+    assert peak < interp_peak + 1.2 * full_size
+    assert np.allclose(xd_product.values, reduce(mul, [xd_arr.values for xd_arr in xd_harmonise_interp(xd_off_grid)]))
+
+
+def hat_basis(wvl_nodes):
+    """ Piecewise linear (hat function) basis on a set of nodes, each sampled on the nodes.
+    """
+    return [make_xd(np.eye(wvl_nodes.size)[i_node], [('wvl', wvl_nodes)], name='srf')
+            for i_node in range(wvl_nodes.size)]
+
+
+@pytest.mark.parametrize('sparse_storage', [False, True])
+def test_functional_basis_round_trip(sparse_storage):
+    wvl_nodes = np.array([400., 450, 500, 575, 650, 700])
+    basis = UnivarFunctionalBasis(hat_basis(wvl_nodes), sparse_storage=sparse_storage)
+    # A piecewise linear function on the nodes lies in the span of the basis and is recovered exactly
+    node_values = np.array([[0.2, 1.0, 0.5, 0.7, 0.1, 0.0], [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]])
+    xd_func = make_xd(node_values, [('pza', [0., 45.]), ('wvl', wvl_nodes)])
+    basis_vector = basis.project(xd_func, expansion=True)
+    assert np.allclose(basis_vector.coefficients.transpose('basis', 'pza').values, node_values.T)
+    xd_reconstructed = basis_vector.reconstruct()
+    assert np.allclose(xd_reconstructed.transpose('pza', 'wvl').values, node_values)
+    # Inner products are trapezoidal integrals over the basis grid
+    inner = basis.project(xd_func).coefficients.transpose('basis', 'pza').values
+    expected = [[trapz(np.eye(wvl_nodes.size)[i_node] * values, wvl_nodes) for values in node_values]
+                for i_node in range(wvl_nodes.size)]
+    assert np.allclose(inner, expected)
+    # Evaluation of the expansion at arbitrary points is linear interpolation of the node values
+    points = np.array([380., 400., 433., 575., 612.5, 700., 720.])
+    expected = [np.interp(points, wvl_nodes, values, left=0.0, right=0.0) for values in node_values]
+    assert np.allclose(basis.evaluate({'wvl': points}, basis_vector).T, expected)
+
+
+def test_dask_inputs_match_numpy(xd_factors):
+    pytest.importorskip('dask.array')
+    lazy_factors = [xd_factors[0].chunk({'pza': 2}), xd_factors[1].chunk({'wvl': 3}), xd_factors[2]]
+    for xd_input, xd_lazy, xd_eager in zip(lazy_factors, xd_harmonise_interp(lazy_factors),
+                                           xd_harmonise_interp(xd_factors)):
+        assert (xd_lazy.chunks is None) == (xd_input.chunks is None)
+        assert np.allclose(xd_lazy.values, xd_eager.values, rtol=1.0e-12, atol=1.0e-12)
+    for reduce_axis in [None, 'wvl']:
+        xd_lazy = xd_harmonised_product(lazy_factors, reduce_axis=reduce_axis)
+        xd_eager = xd_harmonised_product(xd_factors, reduce_axis=reduce_axis)
+        assert xd_lazy.chunks is not None
+        assert np.allclose(xd_lazy.values, xd_eager.values, rtol=1.0e-12, atol=1.0e-12)
+    to_xd = make_xd(np.zeros(4), [('wvl', [405., 500, 555, 690])])
+    for interp_method in ['linear', 'cubic']:
+        xd_lazy = xd_interp_axis_to(lazy_factors[1], to_xd, 'wvl', interp_method=interp_method, assume_sorted=False)
+        xd_eager = xd_interp_axis_to(xd_factors[1], to_xd, 'wvl', interp_method=interp_method, assume_sorted=False)
+        assert np.allclose(xd_lazy.values, xd_eager.values, rtol=1.0e-12, atol=1.0e-12)
@@ -11,10 +11,13 @@ import numpy as np
 import xarray as xray
 from morticia import ureg, Q_, U_
 import scipy.interpolate as interp
+import scipy.sparse as sparse
 import warnings
 from operator import mul, add
 from morticia.moglo import *  # Import morticia global vocab, exceptions etc.
-import copy
+import functools
+import numbers
+from collections import OrderedDict
 
 def xd_identity(np_vector, axis_name, units=None, attrs=None):
     """ Create an identity xray.DataArray. That is, a DataArray vector in which both the values and axis
@@ -39,9 +42,7 @@ def xd_identity(np_vector, axis_name, units=None, attrs=None):
         the_units = ''  # Assumed to be unitless quantity
     if units is None:
         units = the_units
-    values = Q_(np_vector, units)  # Create a pint quantity with the given units
-    values = values.to(the_units)  # actually the default units
-    np_vector = values.magnitude
+    np_vector = convert_units(np_vector, units, the_units)  # Convert to the default units (if not already)
     if attrs is not None:
         the_attrs = attrs
     else:
@@ -51,6 +52,102 @@ def xd_identity(np_vector, axis_name, units=None, attrs=None):
     return xray.DataArray(np_vector, [(axis_name, np_vector)], name=axis_name, attrs=the_attrs)
 
 
+def _merged_axis_coords(xd_list):
+    """ Merge the coordinates of each axis over a list of xray.DataArray objects.
+
+    :param xd_list: List of xray.DataArray objects.
+    :return: Tuple of two dictionaries, keyed on axis name. The first provides the sorted, unique coordinates of
+        each axis and the second whether the coordinates are numeric (and can therefore be interpolated).
+    """
+    # Accumulate the index values from each of the given arrays, for each of the axes in the first array
+    index_vals = {}  # dictionary of index coordinates for each axis
+    index_float = {}  # determine if the index kind is numeric (and can therefore be interpolated)
+    for xd_arr in xd_list:
+        for axis in xd_arr.dims:
+            # accumulate dictionary for all dimensions in the entire collection of DataArrays
+            if not axis in index_vals:
+                index_vals[axis] = xd_arr[axis].values
+            else:
+                index_vals[axis] = np.hstack((index_vals[axis], xd_arr[axis].values))
+    # get the unique values in increasing numerical order using np.unique for each axis found in the whole set
+    for axis in index_vals:
+        index_vals[axis] = np.unique(index_vals[axis])
+        index_float[axis] = index_vals[axis].dtype.kind in 'iufc'
+    return index_vals, index_float
+
+
+def _is_lazy(xd_arr):
+    """ Determine whether an xray.DataArray is backed by a chunked (lazy) dask array.
+
+    :param xd_arr: xray.DataArray
+    :return: True if the DataArray data is a dask array, otherwise False.
+    """
+    return xd_arr.chunks is not None
+
+
+def _interp_along_axis_chunked(data, axis, table, fill_value=np.nan):
+    """ Interpolate a dask array lazily along a single axis using an (index, weight, in_bounds) table from
+    `axis_interp_weights`. The array is rechunked to a single chunk along the interpolation axis only, so that the
+    chunks of all the other axes are retained, and each chunk is then interpolated independently (and in parallel
+    when computed) using `_interp_along_axis`.
+
+    :param data: dask array.
+    :param axis: The axis number along which to interpolate.
+    :param table: Tuple (index, weight, in_bounds) for the axis.
+    :param fill_value: Value to assign to points lying outside the bounds of the axis. Default is np.nan.
+    :return: dask array having the axis replaced by the interpolation points.
+    """
+    index, weight, in_bounds = table
+    data = data.rechunk({axis: -1})
+    chunks = list(data.chunks)
+    chunks[axis] = (index.size,)
+    if np.any(weight) or not np.all(in_bounds):
+        dtype = np.result_type(data.dtype, np.float64)
+    else:
+        dtype = data.dtype
+    return data.map_blocks(functools.partial(_interp_along_axis, axis=axis, table=table, fill_value=fill_value),
+                           chunks=tuple(chunks), dtype=dtype)
+
+
+def _interp_to_coords(xd_arr, index_vals, index_float):
+    """ Interpolate the data of an xray.DataArray onto new coordinates, one axis at a time, using cached index and
+    weight tables. Values outside the domain of the DataArray are set to zero. If the DataArray is backed by a dask
+    array, the interpolation is lazy and chunk-wise (see `_interp_along_axis_chunked`). Numeric axes having
+    coordinates that are not monotonic are first put in coordinate order.
+
+    :param xd_arr: xray.DataArray
+    :param index_vals: Dictionary of new coordinates for each axis of the DataArray.
+    :param index_float: Dictionary of flags, True if the axis is numeric, otherwise the axis is matched by label.
+    :return: Numpy array of interpolated values, with the same axis order as the DataArray, or a dask array if the
+        DataArray is dask-backed.
+    """
+    if _is_lazy(xd_arr):
+        interp_vals = xd_arr.data
+        interp_along_axis = _interp_along_axis_chunked
+    else:
+        interp_vals = xd_arr.values
+        interp_along_axis = _interp_along_axis
+    # Build the tables for axes needing interpolation, then apply them, most contracting axes first
+    axis_tables = []
+    for axis in xd_arr.dims:
+        from_coords = xd_arr[axis].values
+        if from_coords.shape == index_vals[axis].shape and np.all(from_coords == index_vals[axis]):
+            continue  # Coordinates already match
+        i_axis = xd_arr.get_axis_num(axis)
+        if index_float[axis] and from_coords.size > 1:
+            steps = np.diff(from_coords)
+            if not (np.all(steps > 0) or np.all(steps < 0)):  # Unsorted, gather the data in coordinate order
+                sort_order = np.argsort(from_coords, kind='mergesort')
+                interp_vals = interp_vals[(slice(None),) * i_axis + (sort_order,)]
+                from_coords = from_coords[sort_order]
+        table = axis_interp_weights_cached(from_coords, index_vals[axis],
+                                           method='linear' if index_float[axis] else 'label')
+        axis_tables.append((float(index_vals[axis].size) / from_coords.size, i_axis, table))
+    for size_ratio, i_axis, table in sorted(axis_tables, key=lambda axis_table: axis_table[0]):
+        interp_vals = interp_along_axis(interp_vals, i_axis, table, fill_value=0.0)
+    return interp_vals
+
+
 def xd_harmonise_interp(xd_list):
     """ Perform linear interpolation on merged set of axis points for two or more xarray DataArray objects.
         This function can be used to prepare (harmonise) multiple xarray.DataArray objects for multiplication or
@@ -58,48 +155,28 @@ def xd_harmonise_interp(xd_list):
         on a common set of coordinate axis points by linearly interpolating all DataArray objects onto the same
         set of points, obtained by merging and sorting the points from all input DataArray objects.
 
-    The DataArray objects provided. The scipy linear grid interpolator is used for this purpose. See:
-    scipy.interpolate.RegularGridInterpolator
-    This scipy interpolator may have poor performance for datasets with more than 2 axes.
+    Interpolation is separable, being performed one axis at a time using precomputed index and weight tables (see
+    `axis_interp_weights`), so that the cost is a few weighted gathers per axis, irrespective of the number of axes.
+    The tables are cached (see `axis_interp_weights_cached`), so repeated harmonisation onto the same grids is cheap.
+    Axes for which the coordinates already match the merged coordinates are not interpolated. Values outside the
+    domain of a DataArray are set to zero. Axes having non-numeric coordinates (e.g. labels) are not interpolated,
+    but are matched by label, with zeros for labels not present in a DataArray.
+
+    DataArrays backed by dask arrays (e.g. opened with `chunks=`) are interpolated lazily, chunk by chunk, and the
+    returned DataArrays are also dask-backed. Only the axis being interpolated is rechunked.
     :param xd_list:
     :return: Tuple of xarray.DataArray objects with merged and linearly interpolated values in all axes.
     Only unique values in the interpolation axis are used.
 
     """
     # TODO : enforce compatible attributes or not ? What attributes in returned object ?
-    # TODO : Ignore axes that have non-numeric coordinates e.g. xdarray['axisname'].dtype.char in 'SUa',
-    # TODO : which detects dtypes that are string, or xdarray['axisname'].dtype.kind in 'fc' (float or complex)
-    # TODO : alternatively require that axis coordinates are always numeric, say with a list of labels as attrs
     # TODO : What about interpolation on times axes
     # TODO : Need to expand on extrapolation (and possibly also single-axis interpolation) schemes
-    # Accumulate the index values from each of the given arrays, for each of the axes in the first array
-    index_vals = {}  # dictionary of index coordinates for each axis
-    index_float = {}  # determine if the index kind is a floating point type (complex included)
-    #metadata = {}
-
-    for xd_arr in xd_list:
-        for axis in xd_arr.dims:
-            # accumulate dictionary for all dimensions in the entire collection of DataArrays
-            if not axis in index_vals:
-                index_vals[axis] = xd_arr[axis]
-            else:
-                index_vals[axis] = np.hstack((index_vals[axis], xd_arr[axis]))
-            # also accumulate the attributes (metadata)
-            # metadata.update(xd_arr.attrs)
-    # get the unique values in increasing numerical order using np.unique for each axis found in the whole set
-    for axis in index_vals:
-        index_vals[axis] = np.unique(index_vals[axis])
-        index_float[axis] = index_vals[axis].dtype.kind in 'fc'
+    index_vals, index_float = _merged_axis_coords(xd_list)
     # interpolate each of the DataArray objects onto the new grid (for whatever axes it does have)
     xd_return_list = []
     for xd_arr in xd_list:
-        # Create the linear interpolator
-        interpolator = interp.RegularGridInterpolator([xd_arr[axis].values for axis in xd_arr.dims],
-                                               xd_arr.values,
-                                               method='linear', bounds_error=False, fill_value=0.0)
-        merged_coordinates = np.meshgrid(*[index_vals[axis] for axis in xd_arr.dims],
-                                               indexing='ij')
-        interp_vals = interpolator(tuple(merged_coordinates))
+        interp_vals = _interp_to_coords(xd_arr, index_vals, index_float)
         # reconstruct the xray.DataArray with interpolated data
         xd_arr_interp = xray.DataArray(interp_vals, [(axis, index_vals[axis]) for axis in xd_arr.dims],
                                        name=xd_arr.name, attrs=xd_arr.attrs)
@@ -111,7 +188,7 @@ def xd_harmonise_interp(xd_list):
     return xd_return_list
 
 def xd_interp_axis_to(from_xd, to_xd, axis, interp_method='linear', bounds_error=False, fill_value=0.0,
-                      assume_sorted=True):
+                      assume_sorted=True, out=None):
     """ Interpolate a single xray.DataArray axis from one set of coordinates to another. Since interpolation
     occurs along a single axis, there is more flexibility in the method of interpolation that can be used.
     The `scipy.interpoalte.interp1d` class is used to perform the interpolation.
@@ -123,27 +200,122 @@ def xd_interp_axis_to(from_xd, to_xd, axis, interp_method='linear', bounds_error
     :param interp_method: Is the kind of interpolation to perform. Options are as for sipy.interpolate.interp1d,
         namely 'linear', 'nearest', 'zero', 'slinear', 'quadratic' and 'cubic', where 'slinear', 'quadratic' and
         'cubic' produce spline interpolation of first, second or third order respectively. The default is 'linear'.
+        For 'linear' and 'nearest' interpolation with a numeric fill_value, cached index and weight tables are used
+        (see `axis_interp_weights_cached`) rather than scipy.interpolate.interp1d. Other fill values (e.g.
+        'extrapolate' or a tuple of below and above values) are passed to scipy.interpolate.interp1d.
+    :param assume_sorted: If False, the coordinates of from_xd along the axis may be in any order. Coordinates that
+        are nevertheless monotonic (increasing or decreasing) are used as is. Otherwise, for 'linear' and 'nearest'
+        interpolation, the index tables are mapped through the sort order of the coordinates, so that the data
+        itself is never sorted.
+    :param out: Optional preallocated, writeable numpy array into which the interpolated data is written. Must have
+        the shape of from_xd with the axis replaced by the new coordinates, and a dtype to which the interpolated
+        values can be cast (e.g. a floating point dtype for 'linear' interpolation). The returned DataArray wraps
+        this array.
     :return: New xray.DataArray with xd_from interpolated along given axis to coordinates provided by xd_to in
-        the given axis.
+        the given axis. If from_xd is backed by a dask array, the result is also dask-backed (lazy), with the
+        interpolation performed chunk by chunk. Only the interpolation axis is rechunked. If `out` is given, the
+        dask computation is performed and stored in `out`.
     """
-    from_dims = from_xd.dims
-    from_axes = [copy.deepcopy(from_xd[this_axis]) for this_axis in from_dims]
-    interp_func = interp.interp1d(from_xd[axis].data, from_xd.data, kind=interp_method, axis=from_xd.get_axis_num(axis),
-                            copy=False, bounds_error=bounds_error, fill_value=fill_value, assume_sorted=assume_sorted)
-    new_data = interp_func(to_xd[axis].data)  # Interpolate along the named axis
-    # Now reconstruct the xd_from DataArray
-    from_axes[from_xd.get_axis_num(axis)] = to_xd[axis]  # Grab the new axis from the xd_to DataArray
-    new_from_xd = xray.DataArray(new_data, from_axes, attrs=from_xd.attrs)  # Use attributes from original
+    lazy = _is_lazy(from_xd)
+    i_axis = from_xd.get_axis_num(axis)
+    from_coords = from_xd[axis].values
+    to_coords = to_xd[axis].values
+    if out is not None:
+        out_shape = list(from_xd.shape)
+        out_shape[i_axis] = to_coords.size
+        if not isinstance(out, np.ndarray) or not out.flags.writeable:
+            raise ValueError('Output of xd_interp_axis_to must be a writeable numpy array.')
+        if tuple(out_shape) != out.shape:
+            raise ValueError('Array provided for output of xd_interp_axis_to has shape ' + str(out.shape) +
+                             ' rather than ' + str(tuple(out_shape)) + '.')
+        if interp_method == 'nearest':
+            out_dtype = from_xd.dtype
+            if isinstance(fill_value, numbers.Number):
+                out_dtype = np.result_type(out_dtype, np.asarray(fill_value).dtype)
+        else:
+            out_dtype = np.result_type(from_xd.dtype, np.float64)
+        if not np.can_cast(out_dtype, out.dtype, casting='same_kind'):
+            raise ValueError('Array provided for output of xd_interp_axis_to has dtype ' + str(out.dtype) +
+                             ', which cannot hold interpolated values of dtype ' + str(out_dtype) + '.')
+    presorted = assume_sorted  # Index tables can be built on monotonic (increasing or decreasing) coordinates
+    if not assume_sorted and from_coords.size > 1:
+        steps = np.diff(from_coords)
+        assume_sorted = bool(np.all(steps > 0))
+        presorted = assume_sorted or bool(np.all(steps < 0))
+    if interp_method in ['linear', 'nearest'] and isinstance(fill_value, numbers.Number):
+        # Use the cached index and weight tables
+        from_data = from_xd.data
+        if presorted:
+            table = axis_interp_weights_cached(from_coords, to_coords, method=interp_method)
+            index, weight, in_bounds = table
+            upper = np.minimum(index + 1, from_coords.size - 1)
+        else:  # Build the tables on the sorted coordinates and map the indices back to the original order
+            sort_order = np.argsort(from_coords, kind='mergesort')
+            index, weight, in_bounds = axis_interp_weights_cached(from_coords[sort_order], to_coords,
+                                                                  method=interp_method)
+            upper = sort_order[np.minimum(index + 1, from_coords.size - 1)]
+            index = sort_order[index]
+            table = (index, weight, in_bounds)
+        if bounds_error and not np.all(in_bounds):
+            raise ValueError('A value in the new coordinates is out of the interpolation range in xd_interp_axis_to.')
+        if lazy:
+            if not presorted:  # Gather in coordinate order to allow the chunked interpolation
+                from_data = from_data[(slice(None),) * i_axis + (sort_order,)]
+                table = axis_interp_weights_cached(from_coords[sort_order], to_coords, method=interp_method)
+            new_data = _interp_along_axis_chunked(from_data, i_axis, table, fill_value=fill_value)
+        else:
+            new_data = _gather_along_axis(from_data, i_axis, index, upper, weight, in_bounds, fill_value=fill_value,
+                                          out=out)
+    elif lazy:  # Apply interp1d chunk by chunk, with the interpolation axis in a single chunk
+        from_data = from_xd.data.rechunk({i_axis: -1})
+        chunks = list(from_data.chunks)
+        chunks[i_axis] = (to_coords.size,)
+
+        def interp_block(block):
+            return interp.interp1d(from_coords, block, kind=interp_method, axis=i_axis, copy=False,
+                                   bounds_error=bounds_error, fill_value=fill_value,
+                                   assume_sorted=assume_sorted)(to_coords)
+        new_data = from_data.map_blocks(interp_block, chunks=tuple(chunks),
+                                        dtype=np.result_type(from_data.dtype, np.float64))
+    else:
+        interp_func = interp.interp1d(from_coords, from_xd.data, kind=interp_method, axis=i_axis, copy=False,
+                                      bounds_error=bounds_error, fill_value=fill_value, assume_sorted=assume_sorted)
+        new_data = interp_func(to_coords)  # Interpolate along the named axis
+    if out is not None and new_data is not out:
+        if lazy:
+            import dask.array as da
+            da.store(new_data, out)
+        else:
+            out[...] = new_data
+        new_data = out
+    # Now reconstruct the xd_from DataArray, reusing the coordinate axes (which are not modified)
+    new_axes = [to_xd[this_axis] if this_axis == axis else from_xd[this_axis] for this_axis in from_xd.dims]
+    new_from_xd = xray.DataArray(new_data, new_axes, attrs=from_xd.attrs)  # Use attributes from original
     return new_from_xd
 
 
-def xd_harmonised_product(xd_list):
+def xd_harmonised_product(xd_list, chunk_axis=None, chunk_size=None, reduce_axis=None, reduce_method='trapz'):
     """ Compute the harmonised product of a number of N-dimensional data arrays.
         The DataArrays are interpolated onto a common set of coordinates and then the product of the DataArrays
         is computed, returning a single DataArray with merged attributes. Unit mismatches are flagged with warnings.
 
+    The product is fused, with each factor multiplied into the product as soon as it has been interpolated, so that
+    the interpolated factors are not all held in memory at once. The product can also be computed in chunks along
+    one of the axes and reduced (integrated or summed) along an axis in the same pass, which bounds the memory
+    required for long chains of factors (e.g. SRF, transmittance, radiance and SQE) over large arrays.
+
+    If any of the DataArrays is backed by a dask array, the product (and any reduction) is built lazily and the
+    returned DataArray is dask-backed. Computation is then performed chunk by chunk, in parallel, by the dask
+    scheduler. Chunking is then determined by the dask chunks and the chunk_axis and chunk_size inputs are ignored.
+
     :param xd_list: List/tuple of xray.DataArray objects to be multiplied
-    :return: Product of xray.DataArray objects with merged attributes
+    :param chunk_axis: Name of an axis along which to compute the product in chunks. Default None (no chunking).
+    :param chunk_size: Number of merged coordinates of the chunk axis per chunk. Default is all (one chunk).
+    :param reduce_axis: Name of an axis over which to integrate or sum the product. Default None (no reduction).
+    :param reduce_method: 'trapz' (default) for trapezoidal integration over the reduce_axis coordinates, or 'sum'
+        for summation.
+    :return: Product of xray.DataArray objects with merged attributes. The dimensions are ordered as for
+        broadcasting of the DataArrays in the given order, omitting the reduce_axis.
     :except UnitMismatch, MissingUnits:
     """
     # TODO : This function to be checked to correct "var_units" mistake
@@ -173,8 +345,102 @@ def xd_harmonised_product(xd_list):
                 raise UnitMismatch('Unit mismatch encountered for ' + xd_arr.name + ' on axis ' + axis)
             elif not 'units' in xd_arr[axis].attrs:  # Units are missing for this axis
                 raise MissingUnits('Units not found for ' + xd_arr.name + ' on axis ' + axis)
-    xd_factors = xd_harmonise_interp(xd_list)
-    xd_product = reduce(mul, xd_factors)  # take the product by reducing the list using the mul operator
+    index_vals, index_float = _merged_axis_coords(xd_list)
+    out_dims = []  # Broadcast order of the dimensions
+    for xd_arr in xd_list:
+        for axis in xd_arr.dims:
+            if axis not in out_dims:
+                out_dims.append(axis)
+    for axis in [chunk_axis, reduce_axis]:
+        if axis is not None and axis not in out_dims:
+            raise ValueError('Axis ' + str(axis) + ' not found in xd_harmonised_product inputs.')
+    result_dims = [axis for axis in out_dims if axis != reduce_axis]
+    lazy = any(_is_lazy(xd_arr) for xd_arr in xd_list)
+    if lazy:
+        import dask.array as da
+        tensordot = da.tensordot
+        chunk_axis = None  # Chunking is left to dask
+    else:
+        tensordot = np.tensordot
+    if reduce_axis is not None:
+        reduce_coords = index_vals[reduce_axis]
+        if reduce_method == 'trapz':
+            reduce_weights = np.zeros(reduce_coords.size)
+            steps = np.diff(reduce_coords.astype(np.float64))
+            reduce_weights[:-1] += steps / 2.0
+            reduce_weights[1:] += steps / 2.0
+        elif reduce_method == 'sum':
+            reduce_weights = np.ones(reduce_coords.size)
+        else:
+            raise ValueError('Unknown reduce_method ' + reduce_method + ' in xd_harmonised_product.')
+    if chunk_axis is None:
+        chunks = [slice(None)]
+    else:
+        n_chunk_axis = index_vals[chunk_axis].size
+        if chunk_size is None:
+            chunk_size = n_chunk_axis
+        chunks = [slice(i_start, i_start + chunk_size) for i_start in range(0, n_chunk_axis, chunk_size)]
+
+    def factor_values(xd_arr, chunk):
+        # Interpolate a factor onto the merged coordinates (of the chunk) and align with the output dimensions
+        chunk_vals = dict(index_vals)
+        if chunk_axis in xd_arr.dims:
+            chunk_vals[chunk_axis] = index_vals[chunk_axis][chunk]
+        values = _interp_to_coords(xd_arr, chunk_vals, index_float)
+        values = values.transpose([xd_arr.dims.index(axis) for axis in out_dims if axis in xd_arr.dims])
+        return values.reshape([chunk_vals[axis].size if axis in xd_arr.dims else 1 for axis in out_dims])
+
+    # When chunking, factors without the chunk axis are the same for all chunks and are interpolated only once.
+    # Otherwise each factor is interpolated only when it is multiplied into the product, so that at most one
+    # interpolated factor is held in memory alongside the product.
+    if chunk_axis is None:
+        fixed_values = {}
+    else:
+        fixed_values = dict((i_factor, factor_values(xd_arr, None)) for i_factor, xd_arr in enumerate(xd_list)
+                            if chunk_axis not in xd_arr.dims)
+    result = None
+    for chunk in chunks:
+        product = None
+        owned = False  # Whether the product array may be overwritten
+        for i_factor, xd_arr in enumerate(xd_list):
+            values = fixed_values[i_factor] if i_factor in fixed_values else factor_values(xd_arr, chunk)
+            if product is None:
+                # An interpolated factor is a new array, which becomes the accumulator for the product
+                product = values
+                owned = (not lazy and i_factor not in fixed_values and
+                         not np.may_share_memory(values, xd_arr.values))
+            elif (owned and np.broadcast(product, values).shape == product.shape and
+                  np.result_type(product, values) == product.dtype):
+                np.multiply(product, values, out=product)
+            elif (not lazy and i_factor not in fixed_values and np.broadcast(product, values).shape == values.shape
+                  and np.result_type(product, values) == values.dtype and
+                  not np.may_share_memory(values, xd_arr.values)):
+                np.multiply(values, product, out=values)  # The interpolated factor becomes the accumulator
+                product = values
+                owned = True
+            else:
+                product = product * values
+                owned = not lazy
+            values = None  # Release the interpolated factor before interpolating the next one
+        if reduce_axis is not None:
+            chunk_weights = reduce_weights[chunk] if chunk_axis == reduce_axis else reduce_weights
+            product = tensordot(product, chunk_weights, axes=([out_dims.index(reduce_axis)], [0]))
+        if chunk_axis is None:
+            result = product
+        elif chunk_axis == reduce_axis:  # Accumulate the integral over the chunks
+            result = product if result is None else result + product
+        else:
+            i_chunk_axis = result_dims.index(chunk_axis)
+            if result is None:
+                result_shape = list(product.shape)
+                result_shape[i_chunk_axis] = index_vals[chunk_axis].size
+                result = np.empty(result_shape, dtype=product.dtype)
+            chunk_index = [slice(None)] * result.ndim
+            chunk_index[i_chunk_axis] = chunk
+            result[tuple(chunk_index)] = product
+    names = set([xd_arr.name for xd_arr in xd_list])
+    xd_product = xray.DataArray(result, [(axis, index_vals[axis]) for axis in result_dims],
+                                name=names.pop() if len(names) == 1 else None)
     #xd_product.attrs = main_attrs
     for axis in xd_product.dims:  # Put the merged attributes into each of the axes
         xd_product[axis].attrs = axis_attrs[axis]
@@ -191,13 +457,13 @@ def check_convert_units(value_with_units, preferred_units):
     :return: Value expressed in the preferred units
     """
 
-    # Use pint to convert
+    # Use pint to convert, if necessary (see moglo.convert_units)
     try:
-        value = Q_(np.asarray(value_with_units[0], dtype=np.float64), value_with_units[1])  # Will blow up if units not recognised
+        value = np.asarray(value_with_units[0], dtype=np.float64)
+        units = value_with_units[1]
     except TypeError:
         warnings.warn('A scalar value was supplied without units. Example of correct scalar input is [40.0, "degC"]')
-    value = value.to(preferred_units)
-    return value.magnitude
+    return convert_units(value, units, preferred_units)  # Will blow up if units not recognised
 
 
 def xd_check_convert_units(xd, axis_name, preferred_units):
@@ -213,14 +479,10 @@ def xd_check_convert_units(xd, axis_name, preferred_units):
     # Create a pint.Quantity object using the data from the named array and use that to convert to
     # preferred units
     if axis_name == xd.name:  # The primary data must be converted
-        Q_values = Q_(xd.data, xd.units)  # Can fetch units this way, but not set them
-        Q_values = Q_values.to(preferred_units)
-        xd.data = Q_values.magnitude
+        xd.data = convert_units(xd.data, xd.units, preferred_units)  # Can fetch units this way, but not set them
         xd.attrs['units'] = preferred_units
     else:  # Convert units of the named axis
-        Q_values = Q_(xd[axis_name].data, xd[axis_name].units)
-        Q_values = Q_values.to(preferred_units)
-        xd[axis_name].data = Q_values.magnitude
+        xd[axis_name].data = convert_units(xd[axis_name].data, xd[axis_name].units, preferred_units)
         xd[axis_name].attrs['units'] = preferred_units
 
 
@@ -236,6 +498,292 @@ def xd_attrs_update(xd_list):
             xd_arr[axis].attrs['units'] = default_units[axis]  # Likewise if units not found for this axis name
 
 
+# The following functions perform linear interpolation by means of precomputed index and weight tables. The tables
+# for each axis are computed once, after which interpolation of any number of data values reduces to weighted
+# gathers with numpy fancy indexing, avoiding construction of scipy interpolator objects.
+
+def axis_interp_weights(from_coords, to_coords, method='linear'):
+    """ Compute index and weight tables for one-dimensional interpolation from one set of axis coordinates to
+    another. The interpolated value at each of the `to_coords` is then
+    ``(1 - weight) * data[index] + weight * data[index + 1]`` along the axis in question.
+
+    If the source coordinates are equi-spaced, the indices are computed arithmetically, otherwise by bisection using
+    `np.searchsorted`. Source coordinates may be in increasing or decreasing order.
+
+    :param from_coords: Vector of source axis coordinates, which must be monotonic.
+    :param to_coords: Numpy array (any shape) of coordinates at which interpolated values are required.
+    :param method: 'linear' (default) or 'nearest'. For 'nearest', the weights are rounded to 0.0 or 1.0.
+    :return: Tuple (index, weight, in_bounds) of numpy arrays, all having the same shape as `to_coords`. The
+        `in_bounds` boolean array is False for coordinates lying outside the range of the source coordinates.
+    """
+    from_coords = np.asarray(from_coords, dtype=np.float64).ravel()
+    to_coords = np.asarray(to_coords, dtype=np.float64)
+    n_from = from_coords.size
+    finite = np.isfinite(to_coords)
+    if n_from == 1:  # Single point axis, only exact matches are in bounds
+        return np.zeros(to_coords.shape, dtype=np.intp), np.zeros(to_coords.shape), to_coords == from_coords[0]
+    to_coords = np.where(finite, to_coords, from_coords[0])
+    step = (from_coords[-1] - from_coords[0]) / (n_from - 1.0)
+    if step != 0.0 and np.allclose(np.diff(from_coords), step, rtol=1.0e-9, atol=0.0):  # Equi-spaced axis
+        position = (to_coords - from_coords[0]) / step
+        index = np.clip(np.floor(position), 0, n_from - 2).astype(np.intp)
+        weight = position - index
+    elif from_coords[-1] < from_coords[0]:  # Decreasing coordinates, bisect on the reversed axis
+        ascending = from_coords[::-1]
+        index = np.clip(np.searchsorted(ascending, to_coords, side='right') - 1, 0, n_from - 2)
+        weight = (to_coords - ascending[index]) / (ascending[index + 1] - ascending[index])
+        index = n_from - 2 - index  # Map back to the original (decreasing) order
+        weight = 1.0 - weight
+    else:
+        index = np.clip(np.searchsorted(from_coords, to_coords, side='right') - 1, 0, n_from - 2)
+        weight = (to_coords - from_coords[index]) / (from_coords[index + 1] - from_coords[index])
+    in_bounds = finite & (weight >= -1.0e-9) & (weight <= 1.0 + 1.0e-9)
+    weight = np.clip(weight, 0.0, 1.0)
+    if method == 'nearest':
+        weight = np.round(weight)
+    elif method != 'linear':
+        raise ValueError('Unknown interpolation method ' + method + ' in axis_interp_weights.')
+    return index, weight, in_bounds
+
+
+def gather_multilinear(data, axis_weights, fill_value=np.nan):
+    """ Perform multilinear interpolation of an N-dimensional numpy array using index and weight tables for each
+    axis, as computed by `axis_interp_weights`. All the sample points are evaluated together, so that there is no
+    Python overhead per point. The number of gathers is 2 to the power of the number of interpolated axes.
+
+    :param data: Numpy array with N dimensions.
+    :param axis_weights: List of N entries, one for each axis of `data`. Each entry is either None, in which case the
+        axis is retained as is, or an (index, weight, in_bounds) tuple for the axis. The tables for different axes
+        must be broadcastable against each other.
+    :param fill_value: Value to assign to points lying outside the bounds of any of the interpolated axes.
+        Default is np.nan.
+    :return: Numpy array having the broadcast shape of the sample points, followed by the retained axes in
+        their original order.
+    """
+    data = np.asarray(data)
+    interp_axes = [i_axis for i_axis, table in enumerate(axis_weights) if table is not None]
+    kept_axes = [i_axis for i_axis, table in enumerate(axis_weights) if table is None]
+    if not interp_axes:
+        return data.copy()
+    # Bring the interpolated axes to the front so that fancy indexing places the sample points first
+    data = np.transpose(data, interp_axes + kept_axes)
+    tables = [axis_weights[i_axis] for i_axis in interp_axes]
+    broadcast = np.broadcast_arrays(*([table[0] for table in tables] + [table[1] for table in tables] +
+                                      [table[2] for table in tables]))
+    n_tables = len(tables)
+    indices, weights, in_bounds = broadcast[:n_tables], broadcast[n_tables:2*n_tables], broadcast[2*n_tables:]
+    expand = (Ellipsis,) + (np.newaxis,) * len(kept_axes)  # Broadcast weights over retained axes
+    result = 0.0
+    for corner in np.ndindex(*((2,) * n_tables)):
+        corner_index = tuple(np.minimum(indices[i_table] + corner[i_table], data.shape[i_table] - 1)
+                             for i_table in range(n_tables))
+        corner_weight = 1.0
+        for i_table in range(n_tables):
+            corner_weight = corner_weight * (weights[i_table] if corner[i_table] else 1.0 - weights[i_table])
+        result = result + data[corner_index] * corner_weight[expand]
+    valid = np.logical_and.reduce(in_bounds)
+    if not np.all(valid):
+        result[~valid] = fill_value
+    return result
+
+
+class LRUCache(object):
+    """ A bounded cache which discards the least recently used entries when full. Hit and miss counts are kept
+    for diagnostic purposes.
+    """
+
+    def __init__(self, maxsize=128):
+        """ Create an empty cache.
+
+        :param maxsize: Maximum number of entries in the cache. Default 128.
+        :return:
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """ Fetch an entry from the cache, marking it as the most recently used.
+
+        :param key: Hashable key of the entry.
+        :param default: Value to return if the key is not in the cache. Default None.
+        :return: The cached value, or the default.
+        """
+        if key in self._entries:
+            value = self._entries.pop(key)
+            self._entries[key] = value  # Reinsert as most recently used
+            self.hits += 1
+            return value
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """ Add an entry to the cache, discarding the least recently used entries if the cache is full.
+
+        :param key: Hashable key of the entry.
+        :param value: Value to store.
+        :return:
+        """
+        if key in self._entries:
+            del self._entries[key]
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """ Remove all entries and reset the hit and miss counts.
+
+        :return:
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """ Report cache statistics.
+
+        :return: Dictionary with 'hits', 'misses', 'size' and 'maxsize'.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Cache of interpolation index and weight tables, shared by xd_harmonise_interp, xd_interp_axis_to and
+# xd_harmonised_product
+_interp_weights_cache = LRUCache(maxsize=256)
+
+
+def _coords_key(coords):
+    """ Construct a hashable key from a coordinate vector.
+    """
+    coords = np.asarray(coords)
+    if coords.dtype.kind == 'O':
+        return ('O', coords.shape, tuple(coords.ravel().tolist()))
+    return (coords.dtype.str, coords.shape, coords.tobytes())
+
+
+def axis_interp_weights_cached(from_coords, to_coords, method='linear'):
+    """ Obtain index and weight tables for one-dimensional interpolation as for `axis_interp_weights`, from a bounded
+    least-recently-used cache keyed on the source coordinates, target coordinates and method. Repeated
+    interpolation between the same pairs of grids (e.g. in Monte Carlo loops) then skips computation of the tables.
+    The tables do not depend on the fill value, which is applied when the tables are used.
+
+    The returned tables are shared and are therefore read-only.
+
+    :param from_coords: Vector of source axis coordinates.
+    :param to_coords: Numpy array of coordinates at which interpolated values are required.
+    :param method: 'linear' (default) or 'nearest' as for `axis_interp_weights`, or 'label' for non-numeric
+        coordinates, which are matched by label.
+    :return: Tuple (index, weight, in_bounds) of numpy arrays, all having the same shape as `to_coords`.
+    """
+    cache_key = (method, _coords_key(from_coords), _coords_key(to_coords))
+    table = _interp_weights_cache.get(cache_key)
+    if table is None:
+        if method == 'label':
+            table = _axis_label_weights(np.asarray(from_coords).ravel(), np.asarray(to_coords).ravel())
+        else:
+            table = axis_interp_weights(from_coords, to_coords, method=method)
+        for table_array in table:
+            table_array.flags.writeable = False
+        _interp_weights_cache.put(cache_key, table)
+    return table
+
+
+def interp_weights_cache_clear():
+    """ Clear the cache of interpolation index and weight tables.
+
+    :return:
+    """
+    _interp_weights_cache.clear()
+
+
+def interp_weights_cache_info():
+    """ Report statistics of the cache of interpolation index and weight tables.
+
+    :return: Dictionary with 'hits', 'misses', 'size' and 'maxsize'.
+    """
+    return _interp_weights_cache.info()
+
+
+def _axis_label_weights(from_labels, to_labels):
+    """ Compute index and weight tables (as for `axis_interp_weights`) for an axis having non-numeric coordinates,
+    by matching labels. Labels not found in the source coordinates are out of bounds.
+
+    :param from_labels: Vector of source axis labels.
+    :param to_labels: Vector of labels at which values are required.
+    :return: Tuple (index, weight, in_bounds) of numpy arrays, all having the same shape as `to_labels`.
+    """
+    label_index = dict((label, i_label) for i_label, label in enumerate(from_labels))
+    index = np.array([label_index.get(label, 0) for label in to_labels], dtype=np.intp)
+    in_bounds = np.array([label in label_index for label in to_labels], dtype=bool)
+    return index, np.zeros(index.shape), in_bounds
+
+
+def _interp_along_axis(data, axis, table, fill_value=np.nan, out=None):
+    """ Interpolate a numpy array along a single axis using an (index, weight, in_bounds) table from
+    `axis_interp_weights`. The table must be one-dimensional.
+
+    :param data: Numpy array.
+    :param axis: The axis number along which to interpolate.
+    :param table: Tuple (index, weight, in_bounds) for the axis.
+    :param fill_value: Value to assign to points lying outside the bounds of the axis. Default is np.nan.
+    :param out: Optional preallocated array for the result.
+    :return: Numpy array having the axis replaced by the interpolation points.
+    """
+    index, weight, in_bounds = table
+    return _gather_along_axis(data, axis, index, np.minimum(index + 1, data.shape[axis] - 1), weight, in_bounds,
+                              fill_value=fill_value, out=out)
+
+
+def _gather_along_axis(data, axis, lower, upper, weight, in_bounds, fill_value=np.nan, out=None):
+    """ Compute the weighted combination ``(1 - weight) * data[lower] + weight * data[upper]`` along a single axis
+    of a numpy array, with fill values where points are out of bounds.
+
+    :param data: Numpy array.
+    :param axis: The axis number along which to interpolate.
+    :param lower: Indices of the lower points along the axis.
+    :param upper: Indices of the upper points along the axis.
+    :param weight: Weights of the upper points.
+    :param in_bounds: Boolean array, False for points to be set to the fill_value.
+    :param fill_value: Value to assign to points lying outside the bounds of the axis. Default is np.nan.
+    :param out: Optional preallocated array for the result, which must have a floating point dtype if the weights
+        are not all zero.
+    :return: Numpy array having the axis replaced by the interpolation points (`out` if provided).
+    """
+    shape = [1] * data.ndim
+    shape[axis] = lower.size
+    weighted = np.any(weight)  # Otherwise only the lower points are needed (exact matches, labels or nearest)
+    if out is None:
+        result = np.take(data, lower, axis=axis)
+        if weighted and np.result_type(result, weight) != result.dtype:
+            result = result.astype(np.result_type(result, weight))
+    else:
+        result = np.take(data, lower, axis=axis, out=out, mode='clip')
+    # The weighted combination is formed in place, so that at most two arrays of the result size are allocated
+    if weighted:
+        weight = weight.reshape(shape)
+        result *= 1.0 - weight
+        upper_data = np.take(data, upper, axis=axis)
+        if np.result_type(upper_data, weight) == upper_data.dtype:
+            upper_data *= weight
+        else:
+            upper_data = upper_data * weight
+        result += upper_data
+        upper_data = None
+    if not np.all(in_bounds):
+        if out is None and np.result_type(result, np.asarray(fill_value)) != result.dtype:
+            result = np.where(in_bounds.reshape(shape), result, fill_value)
+        else:
+            np.copyto(result, fill_value, where=np.logical_not(in_bounds.reshape(shape)))
+    return result
+
+
 # Want univariate, bivariate and multivariate basis functions and functional bases.
 # For multivariate basis functions, the only interpolator currently is scipy.interpolate.RegularGridInterpolator
 # For bivariate basis functions, there are only 2 interpolators currently available, being
@@ -320,23 +868,175 @@ class BasisFunction(object):
         return str(self.samples)
 
 
+def _trapz_weights(coords):
+    """ Compute trapezoidal quadrature weights for a vector of (possibly non-uniform) coordinates.
+
+    :param coords: Vector of monotonic coordinates.
+    :return: Vector of weights. A single coordinate has a weight of 1.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    if coords.size < 2:
+        return np.ones(coords.size)
+    steps = np.abs(np.diff(coords))
+    weights = np.zeros(coords.size)
+    weights[:-1] += steps / 2.0
+    weights[1:] += steps / 2.0
+    return weights
+
+
 class FunctionalBasis(object):
     """
     A FunctionalBasis is an ordered list of BasisFunctions defined on the same or overlapping domain. All functions
     in the basis must have the same domain axes. The functions are harmonised such that they have the same domain
-    sample points. For multivariate BasisFunctions, the domain sample points are harmonised using the scipy
-    RegularGridInterpolator by default.
+    sample points, by linear interpolation with zero values outside the domain of each function.
+
+    The harmonised samples of all the basis functions are held as a single matrix (one row per basis function, one
+    column per point of the flattened domain grid), so that evaluation of the basis at any number of points and
+    projection of DataArrays onto the basis are each a single matrix product. For band-limited basis functions
+    (which are zero over much of the domain), the matrix can be stored in scipy.sparse CSR format.
     """
-    def __init__(self, basisfunction_list):
+    _n_dims = None  # Required number of domain axes, None for any number
+
+    def __init__(self, basisfunction_list, sparse_storage=False):
+        """ Construct a FunctionalBasis from a list of BasisFunction objects (or xray.DataArray objects of samples).
+
+        :param basisfunction_list: List of BasisFunction or xray.DataArray objects, all having the same set of domain
+            axes.
+        :param sparse_storage: Store the basis matrix in scipy.sparse CSR format. True, False (default) or 'auto',
+            which uses sparse storage if less than a quarter of the samples are non-zero.
+        :return:
+        """
         if len(basisfunction_list) < 2:
             raise ValueError('More than 1 basis function require to form basis')
-        dimset = basisfunction_list[0].dimset
-        for basisfunction in basisfunction_list:
-            if dimset != basisfunction.dimset:
+        samples_list = [basisfunction.samples if isinstance(basisfunction, BasisFunction) else basisfunction
+                        for basisfunction in basisfunction_list]
+        dims = samples_list[0].dims
+        dimset = set(dims)
+        for samples in samples_list:
+            if dimset != set(samples.dims):
                 raise ValueError('All basis functions for a functional basis must have the same domain coordinate '
                                  'axes.')
-        self.basisfunction_list = xd_harmonise_interp(basisfunction_list)
+        if self._n_dims is not None and len(dims) != self._n_dims:
+            raise ValueError(type(self).__name__ + ' requires basis functions with ' + str(self._n_dims) +
+                             ' domain axes.')
+        samples_list = [samples.transpose(*dims) for samples in samples_list]
+        self.basisfunction_list = xd_harmonise_interp(samples_list)
+        self.dims = dims
+        self.dimset = dimset
+        self.coords = OrderedDict((axis, self.basisfunction_list[0][axis].values) for axis in dims)
+        self.shape = tuple(coords.size for coords in self.coords.values())
+        self.n_basis = len(self.basisfunction_list)
+        matrix = np.vstack([basisfunction.values.ravel() for basisfunction in self.basisfunction_list])
+        if sparse_storage == 'auto':
+            sparse_storage = np.count_nonzero(matrix) < 0.25 * matrix.size
+        self.sparse = bool(sparse_storage)
+        self.matrix = sparse.csr_matrix(matrix) if self.sparse else matrix
+        # Quadrature weights for inner products over the domain grid (trapezoidal rule on each axis)
+        weights = np.ones(())
+        for coords in self.coords.values():
+            weights = np.multiply.outer(weights, _trapz_weights(coords))
+        self.weights = weights.ravel()
+        self._gram = None
+
+    def interp_matrix(self, points):
+        """ Build the sparse matrix which performs multilinear interpolation from the domain grid of the basis to a
+        set of points. Points outside the domain have zero values.
 
+        :param points: Dictionary of coordinate arrays for each of the domain axes. The arrays are broadcast against
+            one another.
+        :return: scipy.sparse.csr_matrix of shape (n_points, n_grid), together with the broadcast shape of the
+            points.
+        """
+        missing = [axis for axis in self.dims if axis not in points]
+        if missing:
+            raise ValueError('Coordinates for domain axes ' + str(missing) + ' not provided to FunctionalBasis.')
+        point_coords = np.broadcast_arrays(*[np.asarray(points[axis], dtype=np.float64) for axis in self.dims])
+        point_shape = point_coords[0].shape
+        tables = [axis_interp_weights(self.coords[axis], coords.ravel())
+                  for axis, coords in zip(self.dims, point_coords)]
+        strides = np.cumprod((self.shape[1:] + (1,))[::-1])[::-1]
+        n_points = int(np.prod(point_shape))
+        valid = np.logical_and.reduce([table[2] for table in tables])
+        rows, cols, vals = [], [], []
+        for corner in np.ndindex(*((2,) * len(tables))):
+            col = np.zeros(n_points, dtype=np.intp)
+            val = valid.astype(np.float64)
+            for i_axis, (index, weight, in_bounds) in enumerate(tables):
+                col += np.minimum(index + corner[i_axis], self.shape[i_axis] - 1) * strides[i_axis]
+                val = val * (weight if corner[i_axis] else 1.0 - weight)
+            nonzero = val != 0.0
+            rows.append(np.nonzero(nonzero)[0])
+            cols.append(col[nonzero])
+            vals.append(val[nonzero])
+        interp_matrix = sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                                          shape=(n_points, int(np.prod(self.shape))))
+        return interp_matrix, point_shape
+
+    def evaluate(self, points, coefficients=None):
+        """ Evaluate the basis functions, or a linear combination of the basis functions, at a set of points.
+
+        :param points: Dictionary of coordinate arrays for each of the domain axes. The arrays are broadcast against
+            one another.
+        :param coefficients: Optional expansion coefficients. A numpy array with the basis functions in the leading
+            axis, or a BasisVector.
+        :return: If coefficients is None, a numpy array of shape (points shape) + (n_basis,), with the value of each
+            basis function at each point. Otherwise the linear combination of basis functions, having shape
+            (points shape) + (trailing shape of the coefficients).
+        """
+        interp_matrix, point_shape = self.interp_matrix(points)
+        values = interp_matrix.dot(self.matrix.T)
+        if sparse.issparse(values):
+            values = values.toarray()
+        if coefficients is None:
+            return values.reshape(point_shape + (self.n_basis,))
+        if isinstance(coefficients, BasisVector):
+            coefficients = coefficients.coefficients.values
+        coefficients = np.asarray(coefficients)
+        result = values.dot(coefficients.reshape((self.n_basis, -1)))
+        return result.reshape(point_shape + coefficients.shape[1:])
+
+    def gram(self):
+        """ Compute the Gram matrix of inner products of the basis functions with each other. The result is cached.
+
+        :return: Numpy array of shape (n_basis, n_basis).
+        """
+        if self._gram is None:
+            weighted = self.matrix.multiply(self.weights) if self.sparse else self.matrix * self.weights
+            gram = weighted.dot(self.matrix.T)
+            self._gram = gram.toarray() if sparse.issparse(gram) else gram
+        return self._gram
+
+    def project(self, xd_arr, expansion=False):
+        """ Project a DataArray onto the basis, computing the inner product of the DataArray with each of the basis
+        functions over the domain of the basis (trapezoidal integration). The DataArray is interpolated onto the
+        domain grid of the basis, with zeros outside the domain of the DataArray. Any axes of the DataArray not in
+        the domain of the basis are retained, so that many functions can be projected in one operation.
+
+        :param xd_arr: xray.DataArray having all the domain axes of the basis and possibly other axes.
+        :param expansion: If True, compute the least-squares expansion coefficients (by solving with the Gram matrix)
+            rather than the inner products. Default False.
+        :return: BasisVector with coefficients having a leading `basis` axis followed by the retained axes.
+        """
+        missing = [axis for axis in self.dims if axis not in xd_arr.dims]
+        if missing:
+            raise ValueError('DataArray lacks domain axes ' + str(missing) + ' for projection onto FunctionalBasis.')
+        other_dims = [axis for axis in xd_arr.dims if axis not in self.dimset]
+        xd_arr = xd_arr.transpose(*(list(self.dims) + other_dims))
+        index_vals = dict(self.coords)
+        index_float = dict((axis, True) for axis in self.dims)
+        for axis in other_dims:
+            index_vals[axis] = xd_arr[axis].values
+            index_float[axis] = False
+        values = _interp_to_coords(xd_arr, index_vals, index_float)
+        other_shape = values.shape[len(self.dims):]
+        values = values.reshape((-1, int(np.prod(other_shape))))
+        coefficients = self.matrix.dot(values * self.weights[:, np.newaxis])
+        if expansion:
+            coefficients = np.linalg.solve(self.gram(), coefficients)
+        coefficients = coefficients.reshape((self.n_basis,) + other_shape)
+        xd_coefficients = xray.DataArray(coefficients, [('basis', np.arange(self.n_basis))] +
+                                         [xd_arr[axis] for axis in other_dims], name=xd_arr.name)
+        return BasisVector(self, xd_coefficients, expansion=expansion)
 
 
 class BasisVector(object):
@@ -344,7 +1044,39 @@ class BasisVector(object):
     A basis vector arises from the inner product of a BasisFunction with a FunctionalBasis. Two BasisVectors can only
     be added if they arose from the identical FunctionalBasis
     """
-    pass
+    def __init__(self, basis, coefficients, expansion=False):
+        """ Construct a BasisVector.
+
+        :param basis: The FunctionalBasis object.
+        :param coefficients: xray.DataArray of coefficients with a leading `basis` axis.
+        :param expansion: True if the coefficients are expansion coefficients, False if they are inner products.
+        :return:
+        """
+        self.basis = basis
+        self.coefficients = coefficients
+        self.expansion = expansion
+
+    def __add__(self, other):
+        if not isinstance(other, BasisVector) or other.basis is not self.basis or other.expansion != self.expansion:
+            raise ValueError('BasisVectors can only be added if they arose from the identical FunctionalBasis.')
+        return BasisVector(self.basis, self.coefficients + other.coefficients, self.expansion)
+
+    def reconstruct(self):
+        """ Reconstruct the function(s) on the domain grid of the basis from expansion coefficients.
+
+        :return: xray.DataArray with the domain axes of the basis followed by any retained axes.
+        """
+        if not self.expansion:
+            raise ValueError('Only BasisVectors of expansion coefficients can be reconstructed.')
+        coefficients = self.coefficients.values.reshape((self.basis.n_basis, -1))
+        values = self.basis.matrix.T.dot(coefficients)
+        values = values.reshape(self.basis.shape + self.coefficients.shape[1:])
+        return xray.DataArray(values, list(self.basis.coords.items()) +
+                              [self.coefficients[axis] for axis in self.coefficients.dims[1:]],
+                              name=self.coefficients.name)
+
+    def __str__(self):
+        return str(self.coefficients)
 
 
 class MultivarBasisFunction(BasisFunction):
@@ -364,7 +1096,7 @@ class BivarBasisFunction(BasisFunction):
 
 
 class BivarFunctionalBasis(FunctionalBasis):
-    pass
+    _n_dims = 2
 
 
 class BivarBasisVector(BasisVector):
@@ -376,7 +1108,7 @@ class UnivarBasisFunction(BasisFunction):
 
 
 class UnivarFunctionalBasis(FunctionalBasis):
-    pass
+    _n_dims = 1
 
 
 class UnivarBasisVector(BasisVector):